@@ -0,0 +1,77 @@
+"""
+Buffered lecture file access counters.
+
+Opens of lecture files are counted in memory per (file, student, day) and
+written to lecture_file_access in one batch every few seconds (and at exit),
+so the download path never waits on a write. Each app process keeps its own
+buffer; the batch upsert adds to whatever other processes wrote.
+"""
+import atexit
+import threading
+import time
+from datetime import datetime
+
+import db
+
+FLUSH_INTERVAL = 5  # seconds
+# Stop buffering new keys if the database stays unreachable
+MAX_PENDING = 50000
+
+_lock = threading.Lock()
+_pending = {}
+_flusher = None
+
+
+def record_access(file_id, user_id):
+    """Count one open of a file by a user"""
+    now = datetime.now()
+    key = (file_id, user_id, now.date())
+    with _lock:
+        entry = _pending.get(key)
+        if entry:
+            entry[0] += 1
+            entry[2] = now
+        elif len(_pending) < MAX_PENDING:
+            _pending[key] = [1, now, now]
+    _ensure_flusher()
+
+
+def flush():
+    """Write the buffered counts; they are kept for the next try if that fails"""
+    global _pending
+    with _lock:
+        batch, _pending = _pending, {}
+    if not batch:
+        return 0
+
+    rows = [(file_id, user_id, day, hits, first_at, last_at)
+            for (file_id, user_id, day), (hits, first_at, last_at) in batch.items()]
+    if db.record_file_access(rows) is None:
+        with _lock:
+            for key, (hits, first_at, last_at) in batch.items():
+                entry = _pending.get(key)
+                if entry:
+                    entry[0] += hits
+                    entry[1] = min(entry[1], first_at)
+                elif len(_pending) < MAX_PENDING:
+                    _pending[key] = [hits, first_at, last_at]
+        return 0
+    return len(rows)
+
+
+def _run():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+
+def _ensure_flusher():
+    """Start the flush thread in this process on first use (after any fork)"""
+    global _flusher
+    if _flusher is not None:
+        return
+    with _lock:
+        if _flusher is None:
+            _flusher = threading.Thread(target=_run, name='file-access-flush', daemon=True)
+            _flusher.start()
+            atexit.register(flush)
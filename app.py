@@ -9,6 +9,13 @@ from functools import wraps
 from datetime import datetime, date
 import os
 import db
+import storage
+import previews
+import extraction
+import analytics
+import student_import
+import topic_plan
+import purge
 from config import config
 
 # Initialize Flask app
@@ -19,13 +26,29 @@ app.secret_key = config.SECRET_KEY
 UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
 ALLOWED_EXTENSIONS = {'pdf', 'doc', 'docx', 'ppt', 'pptx', 'xls', 'xlsx', 'txt', 'zip', 'rar', 'jpg', 'jpeg', 'png', 'gif'}
 MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB
+MAX_RESUMABLE_FILE_SIZE = 500 * 1024 * 1024  # 500MB, sent in chunks
+UPLOAD_CHUNK_SIZE = 5 * 1024 * 1024  # 5MB
 
 app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 app.config['MAX_CONTENT_LENGTH'] = MAX_FILE_SIZE
+app.config['USE_X_SENDFILE'] = config.FILE_DELIVERY == 'x-sendfile'
 
 # Ensure upload folder exists
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
+# Where lecture files are stored (config.STORAGE_BACKEND: local folder or S3 bucket)
+file_store = storage.create_backend(config, UPLOAD_FOLDER)
+
+def stored_key(file_path):
+    """Storage key of a lecture_files.file_path"""
+    return storage.to_key(file_path, UPLOAD_FOLDER)
+
+def remove_stored_file(file_path):
+    """Delete a stored lecture file and its preview"""
+    key = stored_key(file_path)
+    storage.remove_blob(file_store, key)
+    previews.remove_preview(file_store, key)
+
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
@@ -40,6 +63,11 @@ def login_required(f):
         if 'user_id' not in session:
             flash('Please log in to access this page.', 'warning')
             return redirect(url_for('login'))
+        # A deleted student's user account lives until the purge; end their session now
+        if session.get('role') == 'student' and db.is_deleted_student(session['user_id']):
+            session.clear()
+            flash('Your account has been removed.', 'danger')
+            return redirect(url_for('login'))
         return f(*args, **kwargs)
     return decorated_function
 
@@ -184,7 +212,7 @@ def admin_dashboard():
     teachers = db.get_all_teachers() or []
     
     # Get total student count directly from students table
-    student_count_result = db.execute_query("SELECT COUNT(*) as count FROM students", fetch_one=True)
+    student_count_result = db.execute_query("SELECT COUNT(*) as count FROM students WHERE graduated_at IS NULL AND deleted_at IS NULL", fetch_one=True)
     total_students = student_count_result['count'] if student_count_result else 0
     
     # Get total unique subject count (count unique subject names)
@@ -257,6 +285,7 @@ def student_dashboard():
     homework = []
     weekly_topics = []
     schedule_data = None
+    calendar_url = None
     
     if student['class_id']:
         homework = db.get_homework_by_class(student['class_id']) or []
@@ -271,6 +300,7 @@ def student_dashboard():
                 class_info['shift'],
                 class_info['section']
             )
+            calendar_url = calendar_feed_url('class', class_info['semester'], class_info['shift'], class_info['section'])
     
     today = date.today().isoformat()
     return render_template('student/dashboard.html',
@@ -280,6 +310,7 @@ def student_dashboard():
                          homework=homework,
                          weekly_topics=weekly_topics,
                          schedule_data=schedule_data,
+                         calendar_url=calendar_url,
                          today=today)
 
 
@@ -441,80 +472,16 @@ def admin_assign_subject_to_teacher(teacher_id):
         flash('Please enter subject name and select at least one class.', 'warning')
         return redirect(url_for('admin_teachers'))
     
-    # Get the subject's actual semester from the subjects table
-    conn = db.get_db_connection()
-    semester = None
-    if conn:
-        cur = conn.cursor()
-        # Look up the subject's semester
-        cur.execute("""
-            SELECT semester FROM subjects
-            WHERE LOWER(name) = LOWER(%s) AND semester IS NOT NULL
-            LIMIT 1
-        """, (subject_name,))
-        subj_row = cur.fetchone()
-        if subj_row:
-            semester = subj_row[0]
-        
-        if semester:
-            # VALIDATION: Ensure all selected classes belong to this semester
-            cur.execute("""
-                SELECT id FROM classes 
-                WHERE id = ANY(%s) AND semester != %s
-            """, (class_ids, semester))
-            wrong_classes = cur.fetchall()
-            if wrong_classes:
-                cur.close()
-                conn.close()
-                flash(f'⚠️ ERROR: "{subject_name}" belongs to Semester {semester}. You can only assign it to Semester {semester} classes!', 'danger')
-                return redirect(url_for('admin_teachers'))
-        
-        cur.close()
-        conn.close()
-    
-    if not semester:
-        # Subject doesn't exist yet — derive semester from selected classes
-        conn2 = db.get_db_connection()
-        if conn2:
-            cur2 = conn2.cursor()
-            cur2.execute("SELECT DISTINCT semester FROM classes WHERE id = ANY(%s)", (class_ids,))
-            rows = cur2.fetchall()
-            if len(rows) == 1:
-                semester = rows[0][0]
-            else:
-                cur2.close()
-                conn2.close()
-                flash('⚠️ ERROR: Select classes from only ONE semester!', 'danger')
-                return redirect(url_for('admin_teachers'))
-            cur2.close()
-            conn2.close()
-    
-    if not semester:
-        flash('Error determining semester for classes.', 'danger')
-        return redirect(url_for('admin_teachers'))
-    
-    success_count = 0
-    for class_id in class_ids:
-        # Create or get the subject for this semester
-        subject_id = db.create_subject(subject_name, semester)
-        if subject_id:
-            # Check if assignment already exists
-            existing = db.get_subject_by_name_and_class(subject_name, class_id)
-            if existing and existing.get('assignment_id'):
-                # Update the existing assignment's teacher
-                result = db.update_subject_teacher(existing['assignment_id'], teacher_id)
-                if result:
-                    success_count += 1
-            else:
-                # Assign teacher to this subject for this class
-                assignment_id = db.assign_teacher_to_subject(teacher_id, subject_id, class_id)
-                if assignment_id:
-                    success_count += 1
+    # Validates the semester, upserts the subject and writes every
+    # assignment in one transaction
+    result = db.assign_subject_to_classes(teacher_id, subject_name, class_ids)
     
-    if success_count > 0:
-        flash(f'Subject "{subject_name}" assigned to {success_count} class(es) in Semester {semester} successfully!', 'success')
-    else:
+    if result is None:
         flash('Error assigning subject.', 'danger')
+    elif result.get('error'):
+        flash(f'⚠️ ERROR: {result["error"]}', 'danger')
+    else:
+        flash(f'Subject "{subject_name}" assigned to {result["assigned"]} class(es) in Semester {result["semester"]} successfully!', 'success')
     
     return redirect(url_for('admin_teachers'))
 
@@ -600,6 +567,17 @@ def admin_add_class():
     return render_template('admin/add_class.html')
 
 
+
+@app.route('/admin/classes/<int:class_id>/delete', methods=['POST'])
+@admin_required
+def admin_delete_class(class_id):
+    """Delete class (hidden now, records removed in the background)"""
+    if queue_purge('class', class_id):
+        flash('Class deleted successfully.', 'success')
+    else:
+        flash('Error deleting class.', 'danger')
+    return redirect(url_for('admin_classes'))
+
 @app.route('/admin/classes/<int:class_id>/students')
 @admin_required
 def admin_class_students(class_id):
@@ -645,16 +623,39 @@ def admin_students():
     return render_template('admin/students.html', students=students)
 
 
+def parse_section_form(form, allowed=('A', 'B', 'C')):
+    """
+    Read the section_<student_id> fields of an allocation form.
+    
+    Returns:
+        ({student_id: section}, None), or (None, error message) if a field
+        name or section is not valid
+    """
+    assignments = {}
+    for key, value in form.items():
+        if not key.startswith('section_') or not value:
+            continue
+        student_id = key[len('section_'):]
+        if not student_id.isdigit():
+            return None, 'Invalid student in the form.'
+        if value not in allowed:
+            return None, f'Section "{value}" has no class to assign students to.'
+        assignments[int(student_id)] = value
+    return assignments, None
+
+
 @app.route('/admin/students/assign-sections', methods=['GET', 'POST'])
 @admin_required
 def admin_assign_sections():
     """Assign classes to students who don't have one"""
     if request.method == 'POST':
+        assignments, error = parse_section_form(request.form)
+        if error:
+            flash(error, 'danger')
+            return redirect(url_for('admin_assign_sections'))
         # Process class assignments
-        for key, value in request.form.items():
-            if key.startswith('section_') and value:
-                student_id = int(key.replace('section_', ''))
-                db.assign_student_section(student_id, value)
+        for student_id, section in assignments.items():
+            db.assign_student_section(student_id, section)
         flash('Classes assigned successfully!', 'success')
         return redirect(url_for('admin_students'))
     
@@ -672,6 +673,130 @@ def admin_assign_sections():
     return render_template('admin/assign_sections.html', grouped_students=grouped)
 
 
+
+def balance_sections(students, counts, groups=None):
+    """
+    Spread students over sections so section sizes end up as even as possible.
+    
+    Args:
+        students: Dicts with 'id', in a stable order
+        counts: {section: students already in it}
+        groups: Optional {student_id: label}; students sharing a label stay together
+    
+    Returns:
+        {student_id: section}
+    """
+    groups = groups or {}
+    units = {}
+    for s in students:
+        label = groups.get(s['id'])
+        units.setdefault(('group', label) if label else ('student', s['id']), []).append(s['id'])
+    
+    sizes = dict(counts)
+    plan = {}
+    # Largest groups first, each into the currently smallest section
+    for members in sorted(units.values(), key=len, reverse=True):
+        section = min(sizes, key=lambda sec: (sizes[sec], sec))
+        for student_id in members:
+            plan[student_id] = section
+        sizes[section] += len(members)
+    return plan
+
+
+@app.route('/admin/students/auto-sections', methods=['GET', 'POST'])
+@admin_required
+def admin_auto_sections():
+    """Balance students without a section across the sections of a semester/shift"""
+    semester = request.values.get('semester', type=int)
+    shift = request.values.get('shift')
+    if not semester or shift not in ('morning', 'night'):
+        return render_template('admin/auto_sections.html', semester=semester, shift=shift, allocation=None)
+    
+    if request.method == 'POST' and request.form.get('action') == 'apply':
+        # Only sections that have an active class for this semester/shift
+        allocation = db.get_section_allocation(semester, shift)
+        assignments, error = parse_section_form(request.form, allowed=allocation['counts'])
+        if error:
+            flash(error, 'danger')
+            return redirect(url_for('admin_auto_sections', semester=semester, shift=shift))
+        updated = db.apply_section_allocation(semester, shift, list(assignments), list(assignments.values()))
+        if updated is None:
+            flash('Error assigning sections.', 'danger')
+        else:
+            flash(f'Assigned sections to {updated} students.', 'success')
+        return redirect(url_for('admin_auto_sections', semester=semester, shift=shift))
+    
+    allocation = db.get_section_allocation(semester, shift)
+    if not allocation['counts']:
+        flash(f'No active classes for semester {semester} ({shift}). Create the classes first.', 'warning')
+        return render_template('admin/auto_sections.html', semester=semester, shift=shift, allocation=None)
+    
+    groups = {}
+    if request.method == 'POST':
+        for key, value in request.form.items():
+            student_id = key[len('group_'):]
+            if key.startswith('group_') and student_id.isdigit() and value.strip():
+                groups[int(student_id)] = value.strip().lower()
+    plan = balance_sections(allocation['students'], allocation['counts'], groups)
+    
+    totals = dict(allocation['counts'])
+    for section in plan.values():
+        totals[section] += 1
+    
+    return render_template('admin/auto_sections.html', semester=semester, shift=shift,
+                           allocation=allocation, plan=plan, groups=groups, totals=totals)
+
+
+@app.route('/admin/students/duplicates')
+@admin_required
+def admin_duplicates():
+    """Review queue of likely duplicate students"""
+    candidates = db.get_duplicate_candidates() or []
+    return render_template('admin/duplicates.html', candidates=candidates)
+
+
+@app.route('/admin/students/duplicates/scan', methods=['POST'])
+@admin_required
+def admin_scan_duplicates():
+    """Look for new duplicate candidates"""
+    pending = db.find_duplicate_students()
+    if pending is None:
+        flash('Error scanning for duplicates. Has add_duplicate_detection.sql been run?', 'danger')
+    else:
+        flash(f'Scan complete: {pending} possible duplicates to review.', 'info')
+    return redirect(url_for('admin_duplicates'))
+
+
+@app.route('/admin/students/duplicates/<int:candidate_id>/merge', methods=['POST'])
+@admin_required
+def admin_merge_duplicate(candidate_id):
+    """Merge one student of a candidate pair into the other"""
+    candidate = db.get_duplicate_candidate(candidate_id)
+    if not candidate:
+        flash('This pair has already been handled.', 'warning')
+        return redirect(url_for('admin_duplicates'))
+    
+    if request.form.get('keep') == 'b':
+        keep_id, drop_id = candidate['student_b_id'], candidate['student_a_id']
+    else:
+        keep_id, drop_id = candidate['student_a_id'], candidate['student_b_id']
+    
+    moved = db.merge_students(keep_id, drop_id)
+    if moved is None:
+        flash('Error merging students. Nothing was changed.', 'danger')
+    else:
+        flash(f"Students merged: moved {moved['attendance']} attendance records and {moved['grades']} grades.", 'success')
+    return redirect(url_for('admin_duplicates'))
+
+
+@app.route('/admin/students/duplicates/<int:candidate_id>/dismiss', methods=['POST'])
+@admin_required
+def admin_dismiss_duplicate(candidate_id):
+    """Mark a candidate pair as two different students"""
+    db.dismiss_duplicate_candidate(candidate_id)
+    flash('Marked as not a duplicate.', 'info')
+    return redirect(url_for('admin_duplicates'))
+
 @app.route('/admin/students/add', methods=['GET', 'POST'])
 @admin_required
 def admin_add_student():
@@ -694,27 +819,11 @@ def admin_add_student():
         year = 1 if semester <= 2 else 2
         
         # Auto-generate unique student number (MIS + year + 5-digit sequence)
-        import datetime
-        current_year = datetime.datetime.now().year
-        
-        # Get the highest student number to generate next one
-        result = db.execute_query(
-            "SELECT student_number FROM students WHERE student_number LIKE %s ORDER BY student_number DESC LIMIT 1",
-            (f'MIS{current_year}%',),
-            fetch_one=True
-        )
-        
-        if result and result['student_number']:
-            # Extract the sequence number and increment
-            last_num = result['student_number']
-            try:
-                seq = int(last_num[-5:]) + 1
-            except:
-                seq = 1
-        else:
-            seq = 1
-        
-        student_number = f"MIS{current_year}{seq:05d}"
+        numbers = db.allocate_student_numbers(1)
+        if not numbers:
+            flash('Error generating unique student ID. Please try again.', 'danger')
+            return render_template('admin/add_student.html')
+        student_number = numbers[0]
         
         # Auto-generate username from student number
         username = student_number.lower()
@@ -761,24 +870,10 @@ def admin_add_student_ajax():
             return jsonify({'success': False, 'message': 'Please fill in all required fields.'})
         
         # Auto-generate unique student number
-        import datetime
-        current_year = datetime.datetime.now().year
-        
-        result = db.execute_query(
-            "SELECT student_number FROM students WHERE student_number LIKE %s ORDER BY student_number DESC LIMIT 1",
-            (f'MIS{current_year}%',),
-            fetch_one=True
-        )
-        
-        if result and result.get('student_number'):
-            try:
-                seq = int(result['student_number'][-5:]) + 1
-            except:
-                seq = 1
-        else:
-            seq = 1
-        
-        student_number = f"MIS{current_year}{seq:05d}"
+        numbers = db.allocate_student_numbers(1)
+        if not numbers:
+            return jsonify({'success': False, 'message': 'Error generating unique student ID. Please try again.'})
+        student_number = numbers[0]
         username = student_number.lower()
         
         if db.get_user_by_username(username):
@@ -810,6 +905,32 @@ def admin_add_student_ajax():
         return jsonify({'success': False, 'message': f'Server error: {str(e)}'})
 
 
+
+@app.route('/admin/students/import', methods=['GET', 'POST'])
+@admin_required
+def admin_import_students():
+    """Import a whole intake of students from a CSV or XLSX file"""
+    if request.method == 'POST':
+        upload = request.files.get('file')
+        if not upload or not upload.filename:
+            flash('Please choose a CSV or XLSX file.', 'warning')
+            return render_template('admin/import_students.html', report=None)
+
+        dry_run = request.form.get('action') == 'validate'
+        skip_invalid = request.form.get('skip_invalid') == 'on'
+        report = student_import.import_file(upload.stream, upload.filename,
+                                            dry_run=dry_run, skip_invalid=skip_invalid)
+
+        if report['failed']:
+            flash(report['failed'], 'danger')
+        elif dry_run:
+            flash(f"{report['total'] - len(report['errors'])} of {report['total']} rows are valid.", 'info')
+        else:
+            flash(f"Imported {len(report['imported'])} students.", 'success')
+        return render_template('admin/import_students.html', report=report, dry_run=dry_run)
+
+    return render_template('admin/import_students.html', report=None)
+
 @app.route('/admin/students/<int:student_id>/edit', methods=['GET', 'POST'])
 @admin_required
 def admin_edit_student(student_id):
@@ -901,9 +1022,8 @@ def admin_edit_student_ajax(student_id):
 @app.route('/admin/students/<int:student_id>/delete', methods=['POST'])
 @admin_required
 def admin_delete_student(student_id):
-    """Delete student"""
-    result = db.delete_student(student_id)
-    if result:
+    """Delete student (hidden now, records removed in the background)"""
+    if queue_purge('student', student_id):
         flash('Student deleted successfully.', 'success')
     else:
         flash('Error deleting student.', 'danger')
@@ -977,9 +1097,8 @@ def admin_edit_subject(subject_id):
 @app.route('/admin/subjects/<int:subject_id>/delete', methods=['POST'])
 @admin_required
 def admin_delete_subject(subject_id):
-    """Delete subject"""
-    result = db.delete_subject(subject_id)
-    if result:
+    """Delete subject (hidden now, records removed in the background)"""
+    if queue_purge('subject', subject_id):
         flash('Subject deleted successfully.', 'success')
     else:
         flash('Error deleting subject.', 'danger')
@@ -988,6 +1107,29 @@ def admin_delete_subject(subject_id):
     return render_template('admin/add_subject.html', classes=classes, teachers=teachers)
 
 
+# =============================================
+# ADMIN - DELETIONS
+# =============================================
+
+def queue_purge(entity_type, entity_id):
+    """Hide a student/subject/class and start removing its records in the background"""
+    job_id = db.soft_delete(entity_type, entity_id, session.get('user_id'))
+    if job_id:
+        purge.start(file_store)
+    return job_id
+
+
+@app.route('/admin/deletions')
+@admin_required
+def admin_deletions():
+    """Progress of background deletions"""
+    jobs = db.get_purge_jobs() or []
+    if any(job['status'] in ('pending', 'running') for job in jobs):
+        # Picks up jobs left behind by a restart
+        purge.start(file_store)
+    return render_template('admin/deletions.html', jobs=jobs)
+
+
 # =============================================
 # ADMIN - GRADE COMPONENTS (Grading Rubric)
 # =============================================
@@ -1004,13 +1146,6 @@ def admin_subject_grading(subject_id):
     # Get grade components for this subject
     components = db.get_grade_components_by_subject(subject_id) or []
     
-    # DEBUG: Print component order
-    print(f"\n=== Loading grading page for subject {subject_id} ===")
-    print("Components in order retrieved:")
-    for comp in components:
-        print(f"  [{comp['display_order']}] {comp['component_type']}: {comp['component_name']}")
-    print("=== End component list ===\n")
-    
     # Calculate total weight
     total_weight = db.get_subject_total_weight(subject_id)
     
@@ -1025,7 +1160,9 @@ def admin_subject_grading(subject_id):
                          components=components,
                          total_weight=total_weight,
                          is_valid=is_valid,
-                         summary=summary)
+                         summary=summary,
+                         rubric_template=db.get_subject_rubric_template(subject_id),
+                         templates=db.get_rubric_templates() or [])
 
 
 @app.route('/admin/subjects/<int:subject_id>/grading/add', methods=['POST'])
@@ -1066,42 +1203,24 @@ def admin_add_grade_component(subject_id):
             flash('Both practical and theoretical weights are required for split midterm!', 'danger')
             return redirect(url_for('admin_subject_grading', subject_id=subject_id))
         
-        total_midterm_weight = practical_weight + theoretical_weight
-        
-        # Check if adding this would exceed 100%
-        current_total = db.get_subject_total_weight(subject_id)
-        if current_total + total_midterm_weight > 100.01:
-            flash(f'Cannot add! Total weight would be {current_total + total_midterm_weight:.2f}% (max 100%)', 'danger')
-            return redirect(url_for('admin_subject_grading', subject_id=subject_id))
-        
         # Max score equals weight for split midterm
         practical_max = practical_weight
         theoretical_max = theoretical_weight
         
-        # Add Midterm Practical
-        practical_id = db.add_grade_component(
-            subject_id,
-            'midterm',
-            'Midterm Practical',
-            practical_max,
-            practical_weight,
-            display_order
-        )
-        
-        # Add Midterm Theoretical
-        theoretical_id = db.add_grade_component(
-            subject_id,
-            'midterm',
-            'Midterm Theoretical',
-            theoretical_max,
-            theoretical_weight,
-            display_order + 1
-        )
-        
-        if practical_id and theoretical_id:
-            flash(f'Midterm split added! Practical: {practical_weight}% ({practical_max} pts), Theoretical: {theoretical_weight}% ({theoretical_max} pts)', 'success')
-        else:
+        # Both halves are added together; the 100% limit is checked in the same transaction
+        result = db.apply_rubric_diff(subject_id, add=[
+            {'component_type': 'midterm', 'component_name': 'Midterm Practical',
+             'max_score': practical_max, 'weight_percentage': practical_weight, 'display_order': display_order},
+            {'component_type': 'midterm', 'component_name': 'Midterm Theoretical',
+             'max_score': theoretical_max, 'weight_percentage': theoretical_weight, 'display_order': display_order + 1},
+        ])
+        
+        if result is None:
             flash('Error adding split midterm!', 'danger')
+        elif result.get('error'):
+            flash(f'Cannot add! {result["error"]}', 'danger')
+        else:
+            flash(f'Midterm split added! Practical: {practical_weight}% ({practical_max} pts), Theoretical: {theoretical_weight}% ({theoretical_max} pts)', 'success')
         
         return redirect(url_for('admin_subject_grading', subject_id=subject_id))
     
@@ -1119,12 +1238,6 @@ def admin_add_grade_component(subject_id):
         flash('Weight percentage must be between 0 and 100!', 'danger')
         return redirect(url_for('admin_subject_grading', subject_id=subject_id))
     
-    # Check if adding this would exceed 100%
-    current_total = db.get_subject_total_weight(subject_id)
-    if current_total + total_weight > 100.01:
-        flash(f'Cannot add! Total weight would be {current_total + total_weight:.2f}% (max 100%)', 'danger')
-        return redirect(url_for('admin_subject_grading', subject_id=subject_id))
-    
     # Get existing count of this type for numbering
     existing_count = db.get_component_count_by_type(subject_id, component_type)
     
@@ -1161,10 +1274,10 @@ def admin_add_grade_component(subject_id):
         flash(f'ERROR: Weight calculation mismatch! Expected {total_weight}%, got {actual_total}%. Please report this bug!', 'danger')
         return redirect(url_for('admin_subject_grading', subject_id=subject_id))
     
-    # Add components
-    added_count = 0
+    # Add all components in one statement
     type_display = type_names.get(component_type, component_type.title())
     
+    components = []
     for i in range(quantity):
         component_number = existing_count + i + 1
         if quantity == 1:
@@ -1174,25 +1287,25 @@ def admin_add_grade_component(subject_id):
             # Multiple items - numbered
             component_name = f"{type_display} {component_number}"
         
-        component_id = db.add_grade_component(
-            subject_id, 
-            component_type, 
-            component_name, 
-            max_scores[i], 
-            weights[i], 
-            display_order + i
-        )
-        
-        if component_id:
-            added_count += 1
+        components.append({
+            'component_type': component_type,
+            'component_name': component_name,
+            'max_score': max_scores[i],
+            'weight_percentage': weights[i],
+            'display_order': display_order + i
+        })
     
-    if added_count == quantity:
-        if quantity == 1:
-            flash(f'Component "{type_display}" added! Weight: {total_weight}%, Max Score: {total_weight} pts', 'success')
-        else:
-            flash(f'{quantity} {type_display} components added! Total: {total_weight}%, Each max: {total_weight} pts. Average of scores → final {total_weight}%', 'success')
+    # The 100% limit is checked in the same transaction as the insert
+    result = db.apply_rubric_diff(subject_id, add=components)
+    
+    if result is None:
+        flash('Error adding components!', 'danger')
+    elif result.get('error'):
+        flash(f'Cannot add! {result["error"]}', 'danger')
+    elif quantity == 1:
+        flash(f'Component "{type_display}" added! Weight: {total_weight}%, Max Score: {total_weight} pts', 'success')
     else:
-        flash(f'Error: Only {added_count} of {quantity} components were added!', 'warning')
+        flash(f'{quantity} {type_display} components added! Total: {total_weight}%, Each max: {total_weight} pts. Average of scores → final {total_weight}%', 'success')
     
     return redirect(url_for('admin_subject_grading', subject_id=subject_id))
 
@@ -1225,13 +1338,22 @@ def admin_edit_grade_component(subject_id, component_id):
         flash('All fields are required!', 'danger')
         return redirect(url_for('admin_subject_grading', subject_id=subject_id))
     
-    # Update component
-    result = db.update_grade_component(component_id, component_type, component_name, max_score, weight_percentage, display_order)
-    
-    if result:
-        flash('Component updated successfully!', 'success')
-    else:
+    # Update component (rejected if the rubric would exceed 100%)
+    result = db.apply_rubric_diff(subject_id, update=[{
+        'id': component_id,
+        'component_type': component_type,
+        'component_name': component_name,
+        'max_score': max_score,
+        'weight_percentage': weight_percentage,
+        'display_order': display_order
+    }])
+    
+    if result is None:
         flash('Error updating component!', 'danger')
+    elif result.get('error'):
+        flash(f'Cannot update! {result["error"]}', 'danger')
+    else:
+        flash('Component updated successfully!', 'success')
     
     return redirect(url_for('admin_subject_grading', subject_id=subject_id))
 
@@ -1278,16 +1400,7 @@ def admin_edit_grade_category(subject_id, component_type):
         flash('Invalid weight value!', 'danger')
         return redirect(url_for('admin_subject_grading', subject_id=subject_id))
     
-    # Get current weight of this type
-    components = db.get_grade_components_by_subject(subject_id)
-    current_type_weight = float(sum(c['weight_percentage'] for c in components if c['component_type'] == component_type))
-    other_weight = float(sum(c['weight_percentage'] for c in components if c['component_type'] != component_type))
-    
-    # Check if new total would exceed 100%
-    if other_weight + new_total_weight > 100.01:
-        flash(f'Cannot update! Total would be {other_weight + new_total_weight:.2f}% (max 100%)', 'danger')
-        return redirect(url_for('admin_subject_grading', subject_id=subject_id))
-    
+    # Rejected inside the transaction if the total would exceed 100%
     result = db.update_grade_components_by_type(subject_id, component_type, new_total_weight)
     
     type_names = {
@@ -1305,10 +1418,12 @@ def admin_edit_grade_category(subject_id, component_type):
     
     type_display = type_names.get(component_type, component_type.title())
     
-    if result:
-        flash(f'{type_display} category updated! New total: {new_total_weight}%', 'success')
-    else:
+    if result is None:
         flash(f'Error updating {type_display} category!', 'danger')
+    elif result.get('error'):
+        flash(f'Cannot update! {result["error"]}', 'danger')
+    else:
+        flash(f'{type_display} category updated! New total: {new_total_weight}%', 'success')
     
     return redirect(url_for('admin_subject_grading', subject_id=subject_id))
 
@@ -1330,9 +1445,6 @@ def admin_reorder_grade_components(subject_id):
         flash('Invalid order data!', 'danger')
         return redirect(url_for('admin_subject_grading', subject_id=subject_id))
     
-    # Debug output
-    print(f"Reordering categories for subject {subject_id}: {categories}")
-    
     # Update display order for all components based on category position
     result = db.reorder_categories_by_type(subject_id, categories)
     
@@ -1344,6 +1456,233 @@ def admin_reorder_grade_components(subject_id):
     return redirect(url_for('admin_subject_grading', subject_id=subject_id))
 
 
+@app.route('/admin/api/subjects/<int:subject_id>/rubric', methods=['GET'])
+@admin_required
+def api_get_rubric(subject_id):
+    """API: A subject's grade components and total weight"""
+    components = db.get_grade_components_by_subject(subject_id) or []
+    return {
+        'success': True,
+        'components': components,
+        'total_weight': db.get_subject_total_weight(subject_id)
+    }
+
+
+@app.route('/admin/api/subjects/<int:subject_id>/rubric', methods=['POST'])
+@admin_required
+def api_save_rubric(subject_id):
+    """API: Apply a rubric diff in one transaction.
+    Expects {'add': [...], 'update': [{'id', ...changed fields}], 'delete': [ids]};
+    the result must total 100% unless {'require_complete': false}."""
+    data = request.get_json(silent=True) or {}
+    fields = {'component_type': str, 'component_name': str, 'max_score': float,
+              'weight_percentage': float, 'display_order': int}
+    
+    try:
+        add = []
+        for entry in data.get('add', []):
+            component = {f: cast(entry[f]) for f, cast in fields.items() if f != 'display_order'}
+            component['display_order'] = int(entry.get('display_order') or 0)
+            add.append(component)
+        update = []
+        for entry in data.get('update', []):
+            component = {f: cast(entry[f]) for f, cast in fields.items() if entry.get(f) is not None}
+            component['id'] = int(entry['id'])
+            update.append(component)
+        delete = [int(cid) for cid in data.get('delete', [])]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return {'success': False, 'message': 'Invalid rubric data'}, 400
+    
+    for component in add + update:
+        weight = component.get('weight_percentage')
+        if weight is not None and not 0 <= weight <= 100:
+            return {'success': False, 'message': 'Weight percentage must be between 0 and 100'}, 400
+        if component.get('max_score') is not None and component['max_score'] <= 0:
+            return {'success': False, 'message': 'Max score must be greater than 0'}, 400
+    
+    result = db.apply_rubric_diff(subject_id, add, update, delete,
+                                  require_complete=data.get('require_complete', True))
+    if result is None:
+        return {'success': False, 'message': 'Error saving rubric'}, 500
+    if result.get('error'):
+        return {'success': False, 'message': result['error']}, 400
+    return {
+        'success': True,
+        'message': 'Rubric saved successfully!',
+        'total_weight': result['total_weight'],
+        'added': result['added']
+    }
+
+
+# =============================================
+# ADMIN - RUBRIC TEMPLATES
+# =============================================
+
+def rubric_template_message(result):
+    """Flash/API summary of an apply_rubric_template result"""
+    message = f'Rubric applied to {len(result["applied"])} subject(s)'
+    skipped = []
+    if result['locked']:
+        skipped.append(f'{len(result["locked"])} with grades already entered')
+    if result['up_to_date']:
+        skipped.append(f'{len(result["up_to_date"])} already up to date')
+    if result['custom']:
+        skipped.append(f'{len(result["custom"])} with a hand-built rubric')
+    if result['other_template']:
+        skipped.append(f'{len(result["other_template"])} following another template')
+    if skipped:
+        message += ' (skipped ' + ', '.join(skipped) + ')'
+    return message + '.'
+
+
+@app.route('/admin/rubric-templates')
+@admin_required
+def admin_rubric_templates():
+    """Rubric templates and applying them to subjects"""
+    templates = db.get_rubric_templates() or []
+    return render_template('admin/rubric_templates.html', templates=templates)
+
+
+@app.route('/admin/rubric-templates/create', methods=['POST'])
+@admin_required
+def admin_create_rubric_template():
+    """Save a subject's rubric as a new template"""
+    name = request.form.get('name', '').strip()
+    subject_id = request.form.get('subject_id', type=int)
+    
+    if not name or not subject_id:
+        flash('Template name is required!', 'danger')
+        return redirect(url_for('admin_rubric_templates'))
+    
+    components = db.get_grade_components_by_subject(subject_id) or []
+    result = db.save_rubric_template(name, components, request.form.get('description', '').strip() or None)
+    
+    if result is None:
+        flash('Error saving template!', 'danger')
+    elif result.get('error'):
+        flash(result['error'], 'danger')
+    else:
+        # The subject itself now follows the template
+        db.apply_rubric_template(result['id'], subject_ids=[subject_id], overwrite=True)
+        flash(f'Template "{name}" saved with {len(components)} components!', 'success')
+    return redirect(url_for('admin_subject_grading', subject_id=subject_id))
+
+
+@app.route('/admin/rubric-templates/<int:template_id>/apply', methods=['POST'])
+@admin_required
+def admin_apply_rubric_template(template_id):
+    """Apply a template to a semester's subjects, or re-apply it to the subjects using it"""
+    semester = request.form.get('semester', type=int)
+    overwrite = request.form.get('overwrite') == 'on'
+    
+    if semester is not None and semester not in (1, 2, 3, 4):
+        flash('Invalid semester!', 'danger')
+        return redirect(url_for('admin_rubric_templates'))
+    
+    result = db.apply_rubric_template(template_id, semester=semester, overwrite=overwrite)
+    if result is None:
+        flash('Error applying template!', 'danger')
+    elif result.get('error'):
+        flash(result['error'], 'danger')
+    else:
+        flash(rubric_template_message(result), 'success' if result['applied'] else 'info')
+    return redirect(url_for('admin_rubric_templates'))
+
+
+@app.route('/admin/subjects/<int:subject_id>/grading/apply-template', methods=['POST'])
+@admin_required
+def admin_apply_subject_template(subject_id):
+    """Replace one subject's rubric with a template"""
+    template_id = request.form.get('template_id', type=int)
+    if not template_id:
+        flash('Select a template!', 'danger')
+        return redirect(url_for('admin_subject_grading', subject_id=subject_id))
+    
+    result = db.apply_rubric_template(template_id, subject_ids=[subject_id], overwrite=True)
+    if result is None:
+        flash('Error applying template!', 'danger')
+    elif result.get('error'):
+        flash(result['error'], 'danger')
+    elif result['locked']:
+        flash('Grades have already been entered for this subject, so its rubric cannot be replaced.', 'warning')
+    else:
+        flash(rubric_template_message(result), 'success')
+    return redirect(url_for('admin_subject_grading', subject_id=subject_id))
+
+
+@app.route('/admin/rubric-templates/<int:template_id>/delete', methods=['POST'])
+@admin_required
+def admin_delete_rubric_template(template_id):
+    """Delete a template; subjects keep their components"""
+    if db.delete_rubric_template(template_id):
+        flash('Template deleted. Subjects keep the components they got from it.', 'success')
+    else:
+        flash('Error deleting template!', 'danger')
+    return redirect(url_for('admin_rubric_templates'))
+
+
+@app.route('/admin/api/rubric-templates/<int:template_id>', methods=['GET'])
+@admin_required
+def api_get_rubric_template(template_id):
+    """API: A rubric template with its items"""
+    template = db.get_rubric_template(template_id)
+    if not template:
+        return {'success': False, 'message': 'Template not found'}, 404
+    return {'success': True, 'template': template}
+
+
+@app.route('/admin/api/rubric-templates', methods=['POST'])
+@admin_required
+def api_save_rubric_template():
+    """API: Create a template, or replace an existing one's items (bumps its version).
+    Expects {'id'?, 'name', 'description'?, 'items': [{component_type, component_name,
+    max_score, weight_percentage, display_order}]}"""
+    data = request.get_json(silent=True) or {}
+    name = str(data.get('name') or '').strip()
+    if not name:
+        return {'success': False, 'message': 'Template name is required'}, 400
+    
+    try:
+        items = [{
+            'component_type': str(item['component_type']),
+            'component_name': str(item['component_name']),
+            'max_score': float(item['max_score']),
+            'weight_percentage': float(item['weight_percentage']),
+            'display_order': int(item.get('display_order') or 0)
+        } for item in data.get('items', [])]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return {'success': False, 'message': 'Invalid template items'}, 400
+    
+    result = db.save_rubric_template(name, items, data.get('description'), data.get('id'))
+    if result is None:
+        return {'success': False, 'message': 'Error saving template'}, 500
+    if result.get('error'):
+        return {'success': False, 'message': result['error']}, 400
+    return {'success': True, 'message': 'Template saved successfully!', **result}
+
+
+@app.route('/admin/api/rubric-templates/<int:template_id>/apply', methods=['POST'])
+@admin_required
+def api_apply_rubric_template(template_id):
+    """API: Apply a template to {'semester'} and/or {'subject_ids'}, or with neither
+    re-apply it to the subjects already using it. {'dry_run': true} only reports."""
+    data = request.get_json(silent=True) or {}
+    try:
+        semester = int(data['semester']) if data.get('semester') is not None else None
+        subject_ids = [int(s) for s in data.get('subject_ids') or []]
+    except (TypeError, ValueError):
+        return {'success': False, 'message': 'Invalid semester or subject IDs'}, 400
+    
+    result = db.apply_rubric_template(template_id, semester, subject_ids,
+                                      overwrite=bool(data.get('overwrite')),
+                                      dry_run=bool(data.get('dry_run')))
+    if result is None:
+        return {'success': False, 'message': 'Error applying template'}, 500
+    if result.get('error'):
+        return {'success': False, 'message': result['error']}, 404
+    return {'success': True, 'message': rubric_template_message(result), 'result': result}
+
+
 # =============================================
 # TEACHER - ATTENDANCE
 # =============================================
@@ -1795,17 +2134,12 @@ def teacher_add_homework():
             flash('Please fill in all required fields.', 'warning')
             return render_template('teacher/add_homework.html', subjects=subjects, unique_subjects=unique_subjects)
         
-        # Create homework for each selected assignment (subject/class combination)
-        success_count = 0
-        for assignment_id in assignment_ids:
-            assignment = next((s for s in subjects if s['assignment_id'] == int(assignment_id)), None)
-            if assignment:
-                hw_id = db.create_homework(assignment['class_id'], assignment['id'], teacher['id'], title, description, due_date)
-                if hw_id:
-                    success_count += 1
-        
-        if success_count > 0:
-            flash(f'Homework created successfully for {success_count} class(es)!', 'success')
+        # Create homework for every selected assignment (subject/class combination) at once
+        selected = resolve_upload_assignments(subjects, assignment_ids)
+        homework_ids = db.create_homework_bulk(teacher['id'], selected, title, description, due_date) if selected else None
+        
+        if homework_ids:
+            flash(f'Homework created successfully for {len(homework_ids)} class(es)!', 'success')
             return redirect(url_for('teacher_homework'))
         else:
             flash('Error creating homework.', 'danger')
@@ -1813,6 +2147,41 @@ def teacher_add_homework():
     return render_template('teacher/add_homework.html', subjects=subjects, unique_subjects=unique_subjects)
 
 
+@app.route('/teacher/api/homework/bulk', methods=['POST'])
+@teacher_required
+def api_publish_homework():
+    """API: Publish one homework to many of the teacher's classes.
+    Expects {'assignment_ids': [...], 'title', 'description'?, 'due_date': 'YYYY-MM-DD'}"""
+    teacher = db.get_teacher_by_user_id(session['user_id'])
+    if not teacher:
+        return {'success': False, 'message': 'Teacher profile not found'}, 403
+    
+    data = request.get_json(silent=True) or {}
+    title = str(data.get('title') or '').strip()
+    description = str(data.get('description') or '').strip()
+    try:
+        due_date = date.fromisoformat(str(data.get('due_date') or '')).isoformat()
+        assignment_ids = [int(a) for a in data.get('assignment_ids') or []]
+    except (TypeError, ValueError):
+        return {'success': False, 'message': 'A due_date (YYYY-MM-DD) and assignment IDs are required'}, 400
+    if not title or not assignment_ids:
+        return {'success': False, 'message': 'A title and at least one assignment are required'}, 400
+    
+    subjects = db.get_subjects_by_teacher(teacher['id']) or []
+    selected = resolve_upload_assignments(subjects, set(assignment_ids))
+    if len(selected) != len(set(assignment_ids)):
+        return {'success': False, 'message': 'Subject not found or access denied'}, 403
+    
+    homework_ids = db.create_homework_bulk(teacher['id'], selected, title, description, due_date)
+    if homework_ids is None:
+        return {'success': False, 'message': 'Error creating homework'}, 500
+    return {
+        'success': True,
+        'message': f'Homework created successfully for {len(homework_ids)} class(es)!',
+        'ids': homework_ids
+    }
+
+
 @app.route('/teacher/homework/delete/<int:homework_id>', methods=['POST'])
 @teacher_required
 def teacher_delete_homework(homework_id):
@@ -1841,7 +2210,9 @@ def teacher_delete_homework(homework_id):
 @teacher_required
 def teacher_schedule():
     """View class schedules (read-only)"""
-    return render_template('teacher/schedule.html')
+    teacher = db.get_teacher_by_user_id(session['user_id'])
+    calendar_url = calendar_feed_url('teacher', teacher['id']) if teacher else None
+    return render_template('teacher/schedule.html', calendar_url=calendar_url)
 
 
 @app.route('/teacher/api/schedule/<int:semester>/<shift>/<section>', methods=['GET'])
@@ -1858,6 +2229,211 @@ def teacher_api_get_schedule(semester, shift, section):
     return {'success': True, 'data': []}
 
 
+# =============================================
+# CALENDAR FEEDS (iCalendar subscriptions)
+# =============================================
+
+# (kind, key) -> (etag, body); entries are replaced when schedule versions change
+_calendar_cache = {}
+
+
+def _calendar_serializer():
+    """Signs feed tokens with the app secret so links can't be guessed"""
+    from itsdangerous import URLSafeSerializer
+    return URLSafeSerializer(app.secret_key, salt='calendar-feed')
+
+
+def calendar_feed_url(kind, *key):
+    """Signed, login-free URL a calendar app can subscribe to"""
+    token = _calendar_serializer().dumps([kind, *key])
+    return url_for('calendar_feed', token=token, _external=True)
+
+
+def _calendar_anchor():
+    """First Sunday on/after September 1 of the current academic year.
+    Weekly events recur from here, so the feed body stays stable all year."""
+    from datetime import timedelta
+    today = date.today()
+    start = date(today.year if today.month >= 9 else today.year - 1, 9, 1)
+    return start + timedelta(days=(6 - start.weekday()) % 7)
+
+
+def _ics_escape(text):
+    """Escape text values for iCalendar"""
+    return (text or '').replace('\\', '\\\\').replace(';', '\\;').replace(',', '\\,').replace('\n', '\\n')
+
+
+def _ics_fold(line):
+    """Fold content lines longer than 75 octets (RFC 5545), never inside a UTF-8 character"""
+    parts = []
+    current, size = '', 0
+    for ch in line:
+        width = len(ch.encode('utf-8'))
+        if size + width > 75:
+            parts.append(current)
+            # The leading space of a continuation line counts towards its 75 octets
+            current, size = ' ', 1
+        current += ch
+        size += width
+    parts.append(current)
+    return '\r\n'.join(parts)
+
+
+def _ics_offset(delta):
+    """UTC offset as +HHMM"""
+    minutes = int(delta.total_seconds() // 60)
+    sign = '+' if minutes >= 0 else '-'
+    return f'{sign}{abs(minutes) // 60:02d}{abs(minutes) % 60:02d}'
+
+
+def _ics_vtimezone(tz_name, year):
+    """VTIMEZONE for tz_name with the offset changes from year to the end of
+    the following year (the academic year the feed covers)"""
+    from datetime import timedelta, timezone
+    from zoneinfo import ZoneInfo
+    tz = ZoneInfo(tz_name)
+    
+    # Find offset changes day by day, then narrow each one down to the hour
+    transitions = []
+    moment = datetime(year, 1, 1, tzinfo=timezone.utc)
+    end = datetime(year + 2, 1, 1, tzinfo=timezone.utc)
+    offset = moment.astimezone(tz).utcoffset()
+    while moment < end:
+        next_day = moment + timedelta(days=1)
+        if next_day.astimezone(tz).utcoffset() != offset:
+            hour = moment
+            while hour.astimezone(tz).utcoffset() == offset:
+                hour += timedelta(hours=1)
+            new_offset = hour.astimezone(tz).utcoffset()
+            transitions.append((hour, offset, new_offset))
+            offset = new_offset
+        moment = next_day
+    
+    lines = ['BEGIN:VTIMEZONE', f'TZID:{tz_name}']
+    if not transitions:
+        local = datetime(year, 1, 1, tzinfo=timezone.utc).astimezone(tz)
+        transitions = [(None, local.utcoffset(), local.utcoffset())]
+    for instant, before, after in transitions:
+        local = instant.astimezone(tz) if instant else datetime(year, 1, 1, tzinfo=timezone.utc).astimezone(tz)
+        kind = 'DAYLIGHT' if local.dst() else 'STANDARD'
+        # DTSTART is the wall-clock time of the change in the offset it changes from
+        onset = (instant + before).strftime('%Y%m%dT%H%M%S') if instant else '19700101T000000'
+        lines += [
+            f'BEGIN:{kind}',
+            f'DTSTART:{onset}',
+            f'TZOFFSETFROM:{_ics_offset(before)}',
+            f'TZOFFSETTO:{_ics_offset(after)}',
+            f'TZNAME:{local.tzname()}',
+            f'END:{kind}',
+        ]
+    lines.append('END:VTIMEZONE')
+    return lines
+
+
+def _build_ics(calendar_name, entries):
+    """Render schedule entries as weekly recurring VEVENTs in the timetable's time zone"""
+    from datetime import timedelta, timezone
+    anchor = _calendar_anchor()
+    tz_name = config.CALENDAR_TIMEZONE
+    stamp = datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%SZ')
+    lines = [
+        'BEGIN:VCALENDAR',
+        'VERSION:2.0',
+        'PRODID:-//MIS Institute//Schedule//EN',
+        'CALSCALE:GREGORIAN',
+        'METHOD:PUBLISH',
+        f'X-WR-CALNAME:{_ics_escape(calendar_name)}',
+        f'X-WR-TIMEZONE:{tz_name}',
+    ]
+    lines += _ics_vtimezone(tz_name, anchor.year)
+    for e in entries:
+        if e['col'] >= len(db.SCHEDULE_DAY_NAMES):
+            continue
+        try:
+            start_h, start_m = (int(x) for x in e['start_time'].split(':')[:2])
+            end_h, end_m = (int(x) for x in e['end_time'].split(':')[:2])
+        except (ValueError, AttributeError):
+            continue
+        day = anchor + timedelta(days=e['col'])
+        teacher = e['practical_teacher'] if e['lecture_type'] == 'practical' else e['teacher']
+        summary = f"{e['subject_name']} ({e['lecture_type'].title()})"
+        lines += [
+            'BEGIN:VEVENT',
+            f"UID:sem{e['semester']}-{e['shift']}-{e['section']}-r{e['row']}c{e['col']}-{e['lecture_type']}@mis",
+            f'DTSTAMP:{stamp}',
+            f"DTSTART;TZID={tz_name}:{day.strftime('%Y%m%d')}T{start_h:02d}{start_m:02d}00",
+            f"DTEND;TZID={tz_name}:{day.strftime('%Y%m%d')}T{end_h:02d}{end_m:02d}00",
+            'RRULE:FREQ=WEEKLY',
+            f'SUMMARY:{_ics_escape(summary)}',
+            f"DESCRIPTION:{_ics_escape(e['class_label'] + (' - ' + teacher if teacher else ''))}",
+        ]
+        if e['room']:
+            lines.append(f"LOCATION:{_ics_escape(e['room'])}")
+        lines.append('END:VEVENT')
+    lines.append('END:VCALENDAR')
+    return '\r\n'.join(_ics_fold(l) for l in lines) + '\r\n'
+
+
+@app.route('/calendar/<token>.ics')
+def calendar_feed(token):
+    """Subscribable iCalendar feed for a teacher, class or room.
+    Polls cost one small versions query; the feed is only rebuilt when a schedule changes."""
+    import hashlib
+    from itsdangerous import BadSignature
+    try:
+        kind, *key = _calendar_serializer().loads(token)
+    except (BadSignature, ValueError):
+        return 'Invalid calendar link', 404
+    
+    versions = db.get_schedule_versions()
+    if kind == 'class':
+        semester, shift, section = key
+        versions = [v for v in versions
+                    if (v['semester'], v['shift'], v['section']) == (semester, shift, section)]
+    elif kind not in ('teacher', 'room'):
+        return 'Invalid calendar link', 404
+    
+    version_key = ','.join(f"{v['semester']}{v['shift']}{v['section']}:{v['version']}" for v in versions)
+    etag = hashlib.md5(f"{kind}:{key}:{version_key}:{_calendar_anchor()}".encode('utf-8')).hexdigest()
+    
+    cached = _calendar_cache.get((kind, tuple(key)))
+    if etag in request.if_none_match:
+        body = ''
+    elif cached and cached[0] == etag:
+        body = cached[1]
+    else:
+        if kind == 'teacher':
+            teacher = db.get_teacher_by_id(key[0])
+            if not teacher:
+                return 'Calendar not found', 404
+            name = f"{teacher['full_name']} - Teaching Schedule"
+            entries = db.get_teacher_schedule_from_builder(teacher['full_name'])
+        elif kind == 'class':
+            name = f"Sem {semester} - {shift.title()} - Class {section}"
+            entries = db.get_class_schedule_entries(semester, shift, section)
+        else:
+            name = f"Room {key[0]}"
+            entries = db.get_room_schedule_from_builder(key[0])
+        body = _build_ics(name, entries)
+        _calendar_cache[(kind, tuple(key))] = (etag, body)
+    
+    response = app.response_class(body, mimetype='text/calendar')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = 'private, max-age=300'
+    return response.make_conditional(request)
+
+
+@app.route('/admin/api/calendar-feeds')
+@admin_required
+def api_calendar_feeds():
+    """API: Subscription links for every class section and room"""
+    classes = [{'semester': sem, 'shift': shift, 'section': section,
+                'url': calendar_feed_url('class', sem, shift, section)}
+               for sem in (1, 2, 3, 4) for shift in ('morning', 'night') for section in ('A', 'B', 'C')]
+    rooms = [{'room': room, 'url': calendar_feed_url('room', room)} for room in db.get_schedule_rooms()]
+    return {'success': True, 'classes': classes, 'rooms': rooms}
+
+
 # =============================================
 # TEACHER - WEEKLY TOPICS
 # =============================================
@@ -1932,6 +2508,87 @@ def teacher_manage_topics(subject_id):
     return render_template('teacher/manage_topics.html', subject=subject, topics=topics)
 
 
+@app.route('/teacher/topics/plan', methods=['POST'])
+@teacher_required
+def teacher_upload_topic_plan():
+    """Publish a semester topic plan file to every class of one subject"""
+    teacher = db.get_teacher_by_user_id(session['user_id'])
+    if not teacher:
+        flash('Teacher profile not found.', 'danger')
+        return redirect(url_for('dashboard'))
+    
+    subject_name = request.form.get('subject_name', '')
+    file = request.files.get('plan')
+    if not subject_name or not file or not file.filename:
+        flash('Please choose a subject and a plan file.', 'warning')
+        return redirect(url_for('teacher_topics'))
+    
+    subjects = db.get_subjects_by_teacher(teacher['id']) or []
+    selected = [(s['id'], s['class_id']) for s in subjects if s['name'] == subject_name]
+    if not selected:
+        flash('Subject not found or access denied.', 'danger')
+        return redirect(url_for('teacher_topics'))
+    
+    try:
+        weeks, errors = topic_plan.read_plan(file.stream, file.filename)
+    except Exception as e:
+        flash(f'Could not read file: {e}', 'danger')
+        return redirect(url_for('teacher_topics'))
+    
+    if errors or not weeks:
+        flash('Nothing was published. ' + ('; '.join(errors[:5]) if errors else 'The plan has no weeks.'), 'danger')
+        return redirect(url_for('teacher_topics'))
+    
+    topics = db.create_weekly_topics_bulk(teacher['id'], selected, weeks)
+    if topics is None:
+        flash('Error publishing topic plan.', 'danger')
+    else:
+        flash(f'{len(weeks)} week(s) of {subject_name} published to {len(set(selected))} class(es)!', 'success')
+    return redirect(url_for('teacher_topics'))
+
+
+@app.route('/teacher/api/topics/bulk', methods=['POST'])
+@teacher_required
+def api_publish_topic_plan():
+    """API: Publish a multi-week topic plan to many of the teacher's classes.
+    Send JSON {'assignment_ids': [...], 'weeks': [{'week', 'topic', 'description'?, 'date'?}]}
+    or a form with assignment_ids and a 'plan' CSV/XLSX file (columns week, topic, description, date)."""
+    teacher = db.get_teacher_by_user_id(session['user_id'])
+    if not teacher:
+        return {'success': False, 'message': 'Teacher profile not found'}, 403
+    
+    try:
+        if 'plan' in request.files:
+            file = request.files['plan']
+            assignment_ids = [int(a) for a in request.form.getlist('assignment_ids')]
+            weeks, errors = topic_plan.read_plan(file.stream, file.filename)
+        else:
+            data = request.get_json(silent=True) or {}
+            assignment_ids = [int(a) for a in data.get('assignment_ids') or []]
+            weeks, errors = topic_plan.parse_plan(enumerate(data.get('weeks') or [], 1))
+    except (AttributeError, TypeError, ValueError) as e:
+        return {'success': False, 'message': f'Invalid topic plan: {e}'}, 400
+    
+    if errors:
+        return {'success': False, 'message': 'Nothing was published', 'errors': errors}, 400
+    if not weeks or not assignment_ids:
+        return {'success': False, 'message': 'At least one week and one assignment are required'}, 400
+    
+    subjects = db.get_subjects_by_teacher(teacher['id']) or []
+    selected = resolve_upload_assignments(subjects, set(assignment_ids))
+    if len(selected) != len(set(assignment_ids)):
+        return {'success': False, 'message': 'Subject not found or access denied'}, 403
+    
+    topics = db.create_weekly_topics_bulk(teacher['id'], selected, weeks)
+    if topics is None:
+        return {'success': False, 'message': 'Error publishing topic plan'}, 500
+    return {
+        'success': True,
+        'message': f'{len(weeks)} week(s) published to {len(set(selected))} class(es)!',
+        'topics': topics
+    }
+
+
 # =============================================
 # TEACHER - LECTURE FILES MANAGEMENT
 # =============================================
@@ -1950,6 +2607,17 @@ def teacher_files():
     return render_template('teacher/files.html', files=files, subjects=subjects)
 
 
+def resolve_upload_assignments(subjects, assignment_ids):
+    """Resolve the selected assignment ids to (subject_id, class_id) pairs the
+    teacher actually teaches"""
+    selected = []
+    for assignment_id in assignment_ids:
+        assignment = next((s for s in subjects if s['assignment_id'] == int(assignment_id)), None)
+        if assignment:
+            selected.append((assignment['id'], assignment['class_id']))
+    return selected
+
+
 @app.route('/teacher/files/upload', methods=['GET', 'POST'])
 @teacher_required
 def teacher_upload_file():
@@ -1982,62 +2650,192 @@ def teacher_upload_file():
         
         if not assignment_ids or not title:
             flash('Please fill in all required fields.', 'warning')
-            return render_template('teacher/upload_file.html', subjects=subjects, unique_subjects=unique_subjects)
+            return render_template('teacher/upload_file.html', subjects=subjects, unique_subjects=unique_subjects,
+                                   upload_chunk_size=UPLOAD_CHUNK_SIZE, max_resumable_file_size=MAX_RESUMABLE_FILE_SIZE,
+                                   max_resumable_mb=MAX_RESUMABLE_FILE_SIZE // (1024 * 1024))
         
         if file and allowed_file(file.filename):
-            # Create unique filename
             original_filename = secure_filename(file.filename)
-            timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
-            filename = f"{timestamp}_{original_filename}"
-            
-            # Read file content once to avoid permission issues
-            file_content = file.read()
-            file_size = len(file_content)
             file_type = original_filename.rsplit('.', 1)[1].lower() if '.' in original_filename else 'unknown'
             week_num = int(week_number) if week_number else None
             
-            # Upload to each selected subject/class
-            success_count = 0
-            for assignment_id in assignment_ids:
-                # Find the assignment (subject/class combination)
-                assignment = next((s for s in subjects if s['assignment_id'] == int(assignment_id)), None)
-                if not assignment:
-                    continue
-                    
-                subject_id = assignment['id']
-                class_id = assignment['class_id']
-                
-                # Create subject subfolder
-                subject_folder = os.path.join(app.config['UPLOAD_FOLDER'], f"subject_{subject_id}")
-                os.makedirs(subject_folder, exist_ok=True)
-                
-                file_path_individual = os.path.join(subject_folder, filename)
-                
-                # Write file content to each location
-                with open(file_path_individual, 'wb') as f:
-                    f.write(file_content)
-                
-                # Save to database with class_id
-                db.create_lecture_file(
-                    subject_id=subject_id,
-                    teacher_id=teacher['id'],
-                    class_id=class_id,
-                    title=title,
-                    description=description,
-                    file_name=original_filename,
-                    file_path=file_path_individual,
-                    file_size=file_size,
-                    file_type=file_type,
-                    week_number=week_num
+            selected = resolve_upload_assignments(subjects, assignment_ids)
+            if not selected:
+                flash('Subject not found or access denied.', 'danger')
+                return redirect(request.url)
+            
+            # Stream to disk once while hashing; identical content is stored only once
+            with storage.staged_stream(file_store, file.stream) as staged:
+                created = db.create_lecture_files_for_blob(
+                    staged['sha256'], staged['size'],
+                    lambda existing: storage.store_file(file_store, staged, file_type, existing),
+                    teacher['id'], selected, title, description,
+                    original_filename, file_type, week_num
                 )
-                success_count += 1
             
-            flash(f'File "{original_filename}" uploaded successfully to {success_count} class(es)!', 'success')
+            if created is None:
+                flash('Error saving file.', 'danger')
+                return redirect(request.url)
+            
+            blob, file_ids = created['blob'], created['file_ids']
+            previews.schedule_preview(file_store, blob['key'], file_type)
+            extraction.schedule_extraction(blob, file_type)
+            flash(f'File "{original_filename}" uploaded successfully to {len(file_ids)} class(es)!', 'success')
             return redirect(url_for('teacher_upload_file'))
         else:
             flash('File type not allowed. Allowed: PDF, DOC, DOCX, PPT, PPTX, XLS, XLSX, TXT, ZIP, RAR, Images', 'danger')
     
-    return render_template('teacher/upload_file.html', subjects=subjects, unique_subjects=unique_subjects)
+    return render_template('teacher/upload_file.html', subjects=subjects, unique_subjects=unique_subjects,
+                           upload_chunk_size=UPLOAD_CHUNK_SIZE, max_resumable_file_size=MAX_RESUMABLE_FILE_SIZE,
+                           max_resumable_mb=MAX_RESUMABLE_FILE_SIZE // (1024 * 1024))
+
+
+@app.route('/teacher/files/<int:file_id>/access')
+@teacher_required
+def teacher_file_access(file_id):
+    """Which students of the class have opened a lecture file"""
+    teacher = db.get_teacher_by_user_id(session['user_id'])
+    file_info = db.get_lecture_file_by_id(file_id)
+    if not teacher or not file_info or file_info['teacher_id'] != teacher['id']:
+        flash('File not found or access denied.', 'danger')
+        return redirect(url_for('teacher_files'))
+    
+    # Include opens still sitting in this process's buffer
+    analytics.flush()
+    report = db.get_file_access_report(file_id)
+    opened = sum(1 for s in report['students'] if s['hits'])
+    return render_template('teacher/file_access.html', file=file_info, report=report, opened=opened)
+
+
+# =============================================
+# TEACHER - RESUMABLE UPLOADS
+# =============================================
+
+def get_teacher_upload(upload_id):
+    """Load a resumable upload owned by the logged-in teacher, or None"""
+    teacher = db.get_teacher_by_user_id(session['user_id'])
+    upload = storage.get_upload(file_store, upload_id)
+    if not teacher or not upload or upload['teacher_id'] != teacher['id']:
+        return None
+    return upload
+
+
+@app.route('/teacher/api/uploads', methods=['POST'])
+@teacher_required
+def api_create_upload():
+    """API: Start a chunked upload. Takes the same fields as the upload form plus
+    file_size, and returns the upload id and chunk size to use."""
+    data = request.get_json(silent=True) or {}
+    teacher = db.get_teacher_by_user_id(session['user_id'])
+    if not teacher:
+        return {'success': False, 'message': 'Teacher profile not found'}, 404
+    
+    file_name = secure_filename(data.get('file_name', ''))
+    title = (data.get('title') or '').strip()
+    file_size = data.get('file_size')
+    if not file_name or not allowed_file(file_name):
+        return {'success': False, 'message': 'File type not allowed'}, 400
+    if not title:
+        return {'success': False, 'message': 'Please fill in all required fields'}, 400
+    if not isinstance(file_size, int) or not 0 < file_size <= MAX_RESUMABLE_FILE_SIZE:
+        return {'success': False, 'message': 'File is empty or too large'}, 400
+    
+    week_number = data.get('week_number') or None
+    if week_number is not None:
+        try:
+            week_number = int(week_number)
+        except (TypeError, ValueError):
+            week_number = 0
+        if not 1 <= week_number <= 16:
+            return {'success': False, 'message': 'Week number must be between 1 and 16'}, 400
+    
+    subjects = db.get_subjects_by_teacher(teacher['id']) or []
+    selected = resolve_upload_assignments(subjects, data.get('assignment_ids') or [])
+    if not selected:
+        return {'success': False, 'message': 'Subject not found or access denied'}, 400
+    
+    upload_id = storage.create_upload(file_store, {
+        'teacher_id': teacher['id'],
+        'file_name': file_name,
+        'file_type': file_name.rsplit('.', 1)[1].lower(),
+        'file_size': file_size,
+        'assignments': selected,
+        'title': title,
+        'description': (data.get('description') or '').strip(),
+        'week_number': week_number
+    })
+    return {'success': True, 'upload_id': upload_id, 'offset': 0, 'chunk_size': UPLOAD_CHUNK_SIZE}, 201
+
+
+@app.route('/teacher/api/uploads/<upload_id>', methods=['GET'])
+@teacher_required
+def api_get_upload(upload_id):
+    """API: How much of an upload has arrived, so the client can resume"""
+    upload = get_teacher_upload(upload_id)
+    if not upload:
+        return {'success': False, 'message': 'Upload not found'}, 404
+    return {'success': True, 'offset': upload['offset'], 'file_size': upload['file_size']}
+
+
+@app.route('/teacher/api/uploads/<upload_id>', methods=['PUT'])
+@teacher_required
+def api_append_upload(upload_id):
+    """API: Append the request body at ?offset=N. A mismatched offset returns
+    409 with the offset to continue from."""
+    upload = get_teacher_upload(upload_id)
+    if not upload:
+        return {'success': False, 'message': 'Upload not found'}, 404
+    
+    offset = request.args.get('offset', type=int)
+    try:
+        new_offset = storage.append_upload(file_store, upload_id, offset, request.stream, upload['file_size'])
+    except ValueError as e:
+        return {'success': False, 'message': 'Offset mismatch', 'offset': e.args[0]}, 409
+    return {'success': True, 'offset': new_offset}
+
+
+@app.route('/teacher/api/uploads/<upload_id>/finalize', methods=['POST'])
+@teacher_required
+def api_finalize_upload(upload_id):
+    """API: Verify a complete upload against its SHA-256 checksum and attach it
+    to the selected classes"""
+    upload = get_teacher_upload(upload_id)
+    if not upload:
+        return {'success': False, 'message': 'Upload not found'}, 404
+    if upload['offset'] != upload['file_size']:
+        return {'success': False, 'message': 'Upload is incomplete', 'offset': upload['offset']}, 409
+    
+    data = request.get_json(silent=True) or {}
+    staged = storage.check_upload(file_store, upload_id, data.get('sha256'))
+    if staged is None:
+        storage.abort_upload(file_store, upload_id)
+        return {'success': False, 'message': 'Checksum mismatch, please upload the file again'}, 422
+    
+    created = db.create_lecture_files_for_blob(
+        staged['sha256'], staged['size'],
+        lambda existing: storage.store_file(file_store, staged, upload['file_type'], existing),
+        upload['teacher_id'], upload['assignments'], upload['title'], upload['description'],
+        upload['file_name'], upload['file_type'], upload['week_number']
+    )
+    if created is None:
+        return {'success': False, 'message': 'Error saving file'}, 500
+    storage.abort_upload(file_store, upload_id)
+    
+    blob, file_ids = created['blob'], created['file_ids']
+    previews.schedule_preview(file_store, blob['key'], upload['file_type'])
+    extraction.schedule_extraction(blob, upload['file_type'])
+    flash(f'File "{upload["file_name"]}" uploaded successfully to {len(file_ids)} class(es)!', 'success')
+    return {'success': True, 'file_ids': file_ids}
+
+
+@app.route('/teacher/api/uploads/<upload_id>', methods=['DELETE'])
+@teacher_required
+def api_abort_upload(upload_id):
+    """API: Cancel an upload and discard what has arrived"""
+    if not get_teacher_upload(upload_id):
+        return {'success': False, 'message': 'Upload not found'}, 404
+    storage.abort_upload(file_store, upload_id)
+    return {'success': True}
 
 
 @app.route('/teacher/files/delete/<int:file_id>', methods=['POST'])
@@ -2051,11 +2849,10 @@ def teacher_delete_file(file_id):
     
     file_info = db.get_lecture_file_by_id(file_id)
     if file_info and file_info['teacher_id'] == teacher['id']:
-        # Delete physical file
-        if os.path.exists(file_info['file_path']):
-            os.remove(file_info['file_path'])
-        # Delete from database
-        db.delete_lecture_file(file_id)
+        # The file goes only when no other row shares it
+        if db.delete_lecture_file(file_id, remove_stored_file) is None:
+            flash('Error deleting file.', 'danger')
+            return redirect(url_for('teacher_files'))
         flash('File deleted successfully!', 'success')
     else:
         flash('File not found or access denied.', 'danger')
@@ -2067,64 +2864,219 @@ def teacher_delete_file(file_id):
 # FILE DOWNLOAD (For both teachers and students)
 # =============================================
 
-@app.route('/files/download/<int:file_id>')
-@login_required
-def download_file(file_id):
-    """Download a lecture file"""
-    file_info = db.get_lecture_file_by_id(file_id)
+def send_lecture_file(file_info, as_attachment):
+    """
+    Send a stored lecture file.
+    
+    Stored files never change (blobs are content-addressed, legacy files are
+    timestamped), so they are cacheable forever. Files in object storage are
+    redirected to a presigned URL. For local files, depending on FILE_DELIVERY the
+    transfer is handed to the front-end server, which also handles Range
+    requests; otherwise Flask serves it with Range support. Blobs kept gzipped
+    at rest are always sent by the app.
+    """
+    import mimetypes
+    from urllib.parse import quote
+    from flask import Response, stream_with_context
+    key = stored_key(file_info['file_path'])
+    mimetype = mimetypes.guess_type(file_info['file_name'])[0] or 'application/octet-stream'
+    disposition = 'attachment' if as_attachment else 'inline'
+    
+    # Object storage serves the bytes itself through a short-lived presigned URL
+    remote_url = file_store.url(key, file_info['file_name'], as_attachment, mimetype,
+                                expires=config.SIGNED_URL_MAX_AGE)
+    if remote_url:
+        return redirect(remote_url)
+    
+    path = file_store.local_path(key)
+    directory, filename = os.path.dirname(path), os.path.basename(path)
+    
+    # Gzipped blobs go out in two encodings, which must not share a cache entry or ETag
+    gzip_variant = False
+    if file_info.get('blob_compressed'):
+        gzip_variant = 'gzip' in request.accept_encodings
+        if gzip_variant:
+            # Let the client inflate it - the stored bytes go out unchanged
+            response = send_from_directory(directory, filename, as_attachment=as_attachment,
+                                           download_name=file_info['file_name'], conditional=False)
+            response.headers['Content-Encoding'] = 'gzip'
+        else:
+            response = Response(stream_with_context(storage.iter_blob(file_store, key, compressed=True)),
+                                mimetype=mimetype)
+            response.headers.set('Content-Disposition', disposition, filename=file_info['file_name'])
+    elif config.FILE_DELIVERY == 'x-accel':
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = config.FILE_ACCEL_PREFIX + quote(key)
+        response.headers.set('Content-Disposition', disposition, filename=file_info['file_name'])
+    else:
+        # With FILE_DELIVERY = 'x-sendfile' Flask emits X-Sendfile here (USE_X_SENDFILE)
+        response = send_from_directory(directory, filename, as_attachment=as_attachment,
+                                       download_name=file_info['file_name'])
+    
+    if file_info.get('blob_compressed'):
+        response.vary.add('Accept-Encoding')
+    if file_info.get('blob_hash'):
+        response.set_etag(file_info['blob_hash'].strip() + ('-gzip' if gzip_variant else ''))
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+def load_lecture_file_for_user(file_id):
+    """Look up and authorize a lecture file for the logged-in user in one query.
+    Returns (file_info, None) or (None, redirect response)."""
+    file_info = db.get_lecture_file_for_user(file_id, session['user_id'], session.get('role'))
     
     if not file_info:
         flash('File not found.', 'danger')
-        return redirect(url_for('dashboard'))
+        return None, redirect(url_for('dashboard'))
     
-    # Check access rights
-    user_role = session.get('role')
-    
-    if user_role == 'student':
-        student = db.get_student_by_user_id(session['user_id'])
-        if student:
-            # Check if student's class_id matches the file's class_id
-            if student['class_id'] != file_info['class_id']:
-                flash('Access denied. This file is not for your class.', 'danger')
-                return redirect(url_for('student_files'))
-    
-    if os.path.exists(file_info['file_path']):
-        directory = os.path.dirname(file_info['file_path'])
-        filename = os.path.basename(file_info['file_path'])
-        return send_from_directory(directory, filename, as_attachment=True, download_name=file_info['file_name'])
-    else:
+    if not file_info['allowed']:
+        flash('Access denied. This file is not for your class.', 'danger')
+        return None, redirect(url_for('student_files'))
+    
+    if not file_store.exists(stored_key(file_info['file_path'])):
         flash('File not found on server.', 'danger')
-        return redirect(url_for('dashboard'))
+        return None, redirect(url_for('dashboard'))
+    
+    return file_info, None
+
+
+def count_student_access(file_id):
+    """Count an open of a lecture file by the logged-in student (buffered, no write here)"""
+    if session.get('role') == 'student':
+        analytics.record_access(file_id, session['user_id'])
+
+
+def _file_link_serializer():
+    """Signs short-lived download links"""
+    from itsdangerous import URLSafeTimedSerializer
+    return URLSafeTimedSerializer(app.secret_key, salt='file-link')
+
+
+@app.route('/files/download/<int:file_id>')
+@login_required
+def download_file(file_id):
+    """Download a lecture file"""
+    file_info, error = load_lecture_file_for_user(file_id)
+    if error:
+        return error
+    count_student_access(file_id)
+    return send_lecture_file(file_info, as_attachment=True)
 
 
 @app.route('/files/view/<int:file_id>')
 @login_required
 def view_file(file_id):
     """View a lecture file (for PDFs and images)"""
-    file_info = db.get_lecture_file_by_id(file_id)
-    
-    if not file_info:
-        flash('File not found.', 'danger')
-        return redirect(url_for('dashboard'))
+    file_info, error = load_lecture_file_for_user(file_id)
+    if error:
+        return error
+    count_student_access(file_id)
+    return send_lecture_file(file_info, as_attachment=False)
+
+
+@app.route('/files/preview/<int:file_id>')
+@login_required
+def file_preview(file_id):
+    """Thumbnail of a lecture file for the files listings"""
+    file_info = db.get_lecture_file_for_user(file_id, session['user_id'], session.get('role'))
+    if not file_info or not file_info['allowed'] or not previews.can_preview(file_info['file_type']):
+        return '', 404
+    
+    key = stored_key(file_info['file_path'])
+    preview = previews.preview_key(key)
+    if not file_store.exists(preview):
+        # Files uploaded before previews existed get one on first request;
+        # files that cannot be rendered (or failed before) are not queued again
+        if (previews.can_render(key, file_info['file_type'])
+                and not file_store.exists(previews.failed_key(key)) and file_store.exists(key)):
+            previews.schedule_preview(file_store, key, file_info['file_type'])
+        return '', 404
+    
+    remote_url = file_store.url(preview, content_type='image/jpeg', expires=config.SIGNED_URL_MAX_AGE)
+    if remote_url:
+        return redirect(remote_url)
+    
+    path = file_store.local_path(preview)
+    response = send_from_directory(os.path.dirname(path), os.path.basename(path), mimetype='image/jpeg')
+    response.headers['Cache-Control'] = 'private, max-age=31536000, immutable'
+    return response
+
+
+@app.route('/files/subject/<int:subject_id>/download-all')
+@login_required
+def download_subject_files(subject_id):
+    """Download every lecture file of a subject (or one week with ?week=N) as a ZIP
+    that is built while it is sent"""
+    from flask import Response, stream_with_context
+    week_number = request.args.get('week', type=int)
+    files = db.get_lecture_files_for_archive(subject_id, session['user_id'], session.get('role'), week_number) or []
+    files = [f for f in files if file_store.exists(stored_key(f['file_path']))]
+    
+    if not files:
+        flash('No files available to download.', 'warning')
+        return redirect(url_for('student_files') if session.get('role') == 'student' else url_for('dashboard'))
+    
+    entries = []
+    used_names = set()
+    for f in files:
+        folder = f"Week {f['week_number']}" if f['week_number'] else 'General'
+        base, ext = os.path.splitext(f['file_name'])
+        arcname = f"{folder}/{base}{ext}"
+        counter = 2
+        while arcname in used_names:
+            arcname = f"{folder}/{base} ({counter}){ext}"
+            counter += 1
+        used_names.add(arcname)
+        uploaded = f['uploaded_at'] or datetime.now()
+        entries.append((arcname, stored_key(f['file_path']), f['blob_compressed'], uploaded.timetuple()[:6]))
+        count_student_access(f['id'])
+    
+    archive_name = files[0]['subject_name'] + (f' - Week {week_number}' if week_number else '') + '.zip'
+    response = Response(stream_with_context(storage.iter_zip(file_store, entries)), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=archive_name)
+    # The archive has no known length up front, so ranges cannot be offered;
+    # tell nginx not to buffer it either
+    response.headers['Accept-Ranges'] = 'none'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+@app.route('/files/link/<int:file_id>')
+@login_required
+def file_signed_link(file_id):
+    """API: Authorize once and return a short-lived link that needs no session,
+    so downloads can be fetched (or resumed) without re-checking access"""
+    file_info, error = load_lecture_file_for_user(file_id)
+    if error:
+        return {'success': False, 'message': 'File not found or access denied.'}, 404
+    
+    as_attachment = request.args.get('download', '1') == '1'
+    # Remember the student so opening the link later still counts
+    student_user_id = session['user_id'] if session.get('role') == 'student' else None
+    token = _file_link_serializer().dumps([file_id, as_attachment, student_user_id])
+    return {
+        'success': True,
+        'url': url_for('signed_file', token=token, _external=True),
+        'expires_in': config.SIGNED_URL_MAX_AGE
+    }
+
+
+@app.route('/files/signed/<token>')
+def signed_file(token):
+    """Serve a file from a signed link created by file_signed_link"""
+    from itsdangerous import BadSignature
+    try:
+        file_id, as_attachment, student_user_id = _file_link_serializer().loads(token, max_age=config.SIGNED_URL_MAX_AGE)
+    except (BadSignature, ValueError):
+        return 'This download link is invalid or has expired.', 403
     
-    # Check access rights
-    user_role = session.get('role')
-    
-    if user_role == 'student':
-        student = db.get_student_by_user_id(session['user_id'])
-        if student:
-            # Check if student's class_id matches the file's class_id
-            if student['class_id'] != file_info['class_id']:
-                flash('Access denied. This file is not for your class.', 'danger')
-                return redirect(url_for('student_files'))
-    
-    if os.path.exists(file_info['file_path']):
-        directory = os.path.dirname(file_info['file_path'])
-        filename = os.path.basename(file_info['file_path'])
-        return send_from_directory(directory, filename)
-    else:
-        flash('File not found on server.', 'danger')
-        return redirect(url_for('dashboard'))
+    file_info = db.get_lecture_file_by_id(file_id)
+    if not file_info or not file_store.exists(stored_key(file_info['file_path'])):
+        return 'File not found.', 404
+    if student_user_id:
+        analytics.record_access(file_id, student_user_id)
+    return send_lecture_file(file_info, as_attachment=as_attachment)
 
 
 # =============================================
@@ -2157,6 +3109,51 @@ def student_files():
     return render_template('student/files.html', files=files, grouped_files=grouped_files, student=student)
 
 
+# =============================================
+# SEARCH
+# =============================================
+
+SEARCH_MIN_LENGTH = 2
+
+
+def highlight_snippet(snippet):
+    """Escape a search snippet and turn its match markers into <mark> tags"""
+    from markupsafe import Markup, escape
+    html = str(escape(snippet or ''))
+    html = html.replace(db.SEARCH_MATCH_START, '<mark>').replace(db.SEARCH_MATCH_STOP, '</mark>')
+    return Markup(html)
+
+
+def run_search(text):
+    """Search what the logged-in user may see; short queries return nothing"""
+    if len(text) < SEARCH_MIN_LENGTH:
+        return []
+    return db.search_content(session['user_id'], session.get('role'), text) or []
+
+
+@app.route('/search')
+@login_required
+def search():
+    """Search lecture files, homework and weekly topics"""
+    text = request.args.get('q', '').strip()
+    results = run_search(text)
+    for r in results:
+        r['snippet'] = highlight_snippet(r['snippet'])
+    return render_template('search.html', q=text, results=results)
+
+
+@app.route('/api/search')
+@login_required
+def api_search():
+    """API: Search results as JSON (snippets are HTML-escaped with <mark> matches)"""
+    results = run_search(request.args.get('q', '').strip())
+    for r in results:
+        r['snippet'] = str(highlight_snippet(r['snippet']))
+        r['due_date'] = r['due_date'].isoformat() if r['due_date'] else None
+        r['rank'] = float(r['rank'])
+    return {'success': True, 'results': results}
+
+
 # =============================================
 # INITIALIZE DEFAULT ADMIN
 # =============================================
@@ -2175,10 +3172,10 @@ def api_get_schedule(semester, shift, section):
         data = schedule['schedule_data']
         # If it's already a list/dict, return as-is
         if isinstance(data, (list, dict)):
-            return {'success': True, 'data': data}
+            return {'success': True, 'data': data, 'version': schedule.get('version', 0)}
         # If it's a string, parse it
-        return {'success': True, 'data': json.loads(data)}
-    return {'success': True, 'data': []}
+        return {'success': True, 'data': json.loads(data), 'version': schedule.get('version', 0)}
+    return {'success': True, 'data': [], 'version': schedule.get('version', 0) if schedule else 0}
 
 
 @app.route('/admin/api/schedule/<int:semester>/<shift>/<section>', methods=['POST'])
@@ -2195,90 +3192,68 @@ def api_save_schedule(semester, shift, section):
     return {'success': False, 'message': 'Error saving schedule'}, 500
 
 
+@app.route('/admin/api/schedule/<int:semester>/<shift>/<section>', methods=['PATCH'])
+@admin_required
+def api_patch_schedule(semester, shift, section):
+    """API: Apply only the changed blocks (JSON Patch) to a schedule.
+    Expects {'version': <version the edit started from>, 'patch': [...]}"""
+    data = request.get_json(silent=True) or {}
+    patch = data.get('patch')
+    base_version = data.get('version')
+    
+    if not isinstance(patch, list) or not isinstance(base_version, int):
+        return {'success': False, 'message': 'A patch list and base version are required'}, 400
+    
+    result = db.patch_schedule(semester, shift, section, patch, base_version)
+    if result is None:
+        return {'success': False, 'message': 'Error saving schedule'}, 400
+    if result['status'] == 'conflict':
+        return {
+            'success': False,
+            'conflict': True,
+            'message': 'This timetable was changed by someone else. Reloaded the latest version.',
+            'version': result['version'],
+            'data': result['data']
+        }, 409
+    return {'success': True, 'message': 'Schedule saved successfully!', 'version': result['version']}
+
+
 @app.route('/admin/api/teachers-subjects/<int:semester>')
 @admin_required
 def api_get_teachers_subjects_by_semester(semester):
-    """API: Get subjects for this semester + their teacher assignments"""
-    conn = db.get_db_connection()
-    if not conn:
+    """API: Get subjects for this semester + their teacher assignments (legacy shape)"""
+    bootstrap = db.get_schedule_builder_bootstrap(semester)
+    if not bootstrap:
         return {'subjects': [], 'assignments': []}
     
-    cur = conn.cursor()
+    # Older clients expect one entry per section, since assignments are per shift
+    assignment_list = []
+    for a in bootstrap['assignments']:
+        for section in ['A', 'B', 'C']:
+            assignment_list.append(dict(a, section=section))
     
-    try:
-        # 1) Get all subjects for this semester
-        cur.execute("""
-            SELECT id, name, description
-            FROM subjects
-            WHERE semester = %s
-            ORDER BY name
-        """, (semester,))
-        sem_subjects = cur.fetchall()
-        
-        print(f"Found {len(sem_subjects)} subjects for semester {semester}")
-        
-        # 2) Build subjects list
-        subject_list = []
-        for row in sem_subjects:
-            subject_list.append({
-                'id': row[0],
-                'name': row[1],
-                'description': row[2] or ''
-            })
-        
-        # 3) Get actual teacher assignments from teacher_assignments table
-        subject_ids = [s[0] for s in sem_subjects]
-        assignment_list = []
-        
-        if subject_ids:
-            cur.execute("""
-                SELECT
-                    ta.id AS assignment_id,
-                    ta.subject_id,
-                    s.name AS subject_name,
-                    ta.shift,
-                    t.id AS teacher_id,
-                    u.full_name AS teacher_name
-                FROM teacher_assignments ta
-                JOIN subjects s ON ta.subject_id = s.id
-                JOIN teachers t ON ta.teacher_id = t.id
-                JOIN users u ON t.user_id = u.id
-                WHERE ta.subject_id = ANY(%s)
-                ORDER BY s.name, ta.shift
-            """, (subject_ids,))
-            assignments = cur.fetchall()
-            
-            print(f"Found {len(assignments)} teacher assignments")
-            
-            # Build assignment list - expand to all sections (A, B, C) since assignments are per shift
-            for row in assignments:
-                # Each teacher assignment is for a shift, apply to all sections
-                for section in ['A', 'B', 'C']:
-                    assignment_list.append({
-                        'assignment_id': row[0],
-                        'subject_id': row[1],
-                        'subject_name': row[2],
-                        'shift': row[3] or '',
-                        'section': section,
-                        'teacher_id': row[4],
-                        'teacher_name': row[5] or ''
-                    })
-        
-        print(f"API Response: {len(subject_list)} subjects, {len(assignment_list)} assignment entries (expanded) for semester {semester}")
-        
-        return {
-            'subjects': subject_list,
-            'assignments': assignment_list
-        }
-        
-    except Exception as e:
-        print(f"ERROR in api_get_teachers_subjects_by_semester: {e}")
-        import traceback
-        traceback.print_exc()
-        return {'subjects': [], 'assignments': [], 'error': str(e)}
-    finally:
-        cur.close()
-        conn.close()
+    return {
+        'subjects': bootstrap['subjects'],
+        'assignments': assignment_list
+    }
+
+
+@app.route('/admin/api/schedule-bootstrap/<int:semester>')
+@admin_required
+def api_schedule_bootstrap(semester):
+    """API: Subjects, assignments, teachers and all six schedules for the builder.
+    Served with an ETag so switching back to a semester revalidates with a 304."""
+    import hashlib
+    import json
+    bootstrap = db.get_schedule_builder_bootstrap(semester)
+    if not bootstrap:
+        return {'success': False, 'message': 'Error loading schedule builder data'}, 500
+    
+    body = json.dumps({'success': True, **bootstrap}, sort_keys=True, default=str)
+    response = app.response_class(body, mimetype='application/json')
+    response.set_etag(hashlib.md5(body.encode('utf-8')).hexdigest())
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response.make_conditional(request)
 
 
 @app.route('/admin/api/teachers-subjects')
@@ -2301,6 +3276,87 @@ def api_get_teachers_subjects():
     }
 
 
+@app.route('/admin/api/assignments/<int:semester>', methods=['GET'])
+@admin_required
+def api_get_assignment_matrix(semester):
+    """API: Subjects x classes of a semester with their current teachers"""
+    return {'success': True, **db.get_assignment_matrix(semester)}
+
+
+@app.route('/admin/api/assignments', methods=['POST'])
+@admin_required
+def api_save_assignment_matrix():
+    """API: Assign many teachers x subjects x sections in one call.
+    Expects {'assignments': [{'subject_id', 'class_id', 'teacher_id'}, ...]};
+    a null teacher_id clears that cell. All cells are saved or none are."""
+    data = request.get_json(silent=True) or {}
+    entries = data.get('assignments')
+    if not isinstance(entries, list) or not entries:
+        return {'success': False, 'message': 'An assignments list is required'}, 400
+    
+    cells = {}
+    try:
+        for entry in entries:
+            teacher_id = entry.get('teacher_id')
+            cells[(int(entry['subject_id']), int(entry['class_id']))] = (
+                int(teacher_id) if teacher_id is not None else None
+            )
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return {'success': False, 'message': 'Each assignment needs a subject_id, class_id and teacher_id'}, 400
+    
+    result = db.set_teacher_assignments(cells)
+    if result is None:
+        return {'success': False, 'message': 'Error saving assignments'}, 500
+    if result.get('errors'):
+        return {'success': False, 'message': 'No assignments were saved', 'errors': result['errors']}, 400
+    return {'success': True, 'message': f'{result["assigned"]} assignment(s) saved successfully!'}
+
+
+@app.route('/admin/api/cycle/rollover', methods=['POST'])
+@admin_required
+def api_cycle_rollover():
+    """API: Clone schedules, rubrics and topic plans into the other cycle.
+    Defaults to a dry run returning the diff; {'dry_run': false} applies it and
+    {'activate': true} also switches the current cycle."""
+    data = request.get_json(silent=True) or {}
+    source_cycle = db.get_current_cycle()
+    target_cycle = data.get('target_cycle', 2 if source_cycle == 1 else 1)
+    dry_run = data.get('dry_run', True)
+    
+    if target_cycle not in (1, 2) or target_cycle == source_cycle:
+        return {'success': False, 'message': 'Target cycle must be the other cycle (1 or 2)'}, 400
+    
+    diff = db.rollover_cycle(source_cycle, target_cycle, dry_run=dry_run)
+    if diff is None:
+        return {'success': False, 'message': 'Error rolling over cycle'}, 500
+    
+    if not dry_run and data.get('activate'):
+        db.set_current_cycle(target_cycle)
+    
+    return {'success': True, 'diff': diff}
+
+
+@app.route('/admin/api/students/promote', methods=['POST'])
+@admin_required
+def api_promote_students():
+    """API: Promote every cohort into the current cycle (after switching it).
+    Defaults to a dry run returning per-class counts; {'dry_run': false} applies it.
+    Runs once per cycle switch; repeating it changes nothing."""
+    data = request.get_json(silent=True) or {}
+    
+    result = db.promote_students(dry_run=data.get('dry_run', True))
+    if result is None:
+        return {'success': False, 'message': 'Error promoting students'}, 500
+    if result['already_promoted']:
+        return {
+            'success': False,
+            'message': f'Students were already promoted into cycle {result["target_cycle"]}. '
+                       'Switch the cycle first.',
+            'result': result
+        }, 409
+    return {'success': True, 'result': result}
+
+
 def init_admin():
     """Create default admin user if not exists"""
     admin = db.get_user_by_username('admin')
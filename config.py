@@ -23,6 +23,27 @@ class Config:
     # Session configuration
     SESSION_TYPE = 'filesystem'
     PERMANENT_SESSION_LIFETIME = 3600  # 1 hour
+    
+    # File delivery: 'app' streams through Flask, 'x-accel' hands the transfer
+    # to nginx (X-Accel-Redirect), 'x-sendfile' to Apache/lighttpd (X-Sendfile)
+    FILE_DELIVERY = os.environ.get('FILE_DELIVERY') or 'app'
+    # nginx internal location that maps to the uploads folder (x-accel only)
+    FILE_ACCEL_PREFIX = os.environ.get('FILE_ACCEL_PREFIX') or '/protected-uploads/'
+    # Lifetime of signed download links, in seconds
+    SIGNED_URL_MAX_AGE = int(os.environ.get('SIGNED_URL_MAX_AGE') or 300)
+    
+    # Time zone of the timetable (IANA name), used by the calendar feeds
+    CALENDAR_TIMEZONE = os.environ.get('CALENDAR_TIMEZONE') or 'Asia/Baghdad'
+    
+    # Lecture file storage: 'local' (uploads folder) or 's3' (any S3-compatible
+    # bucket such as AWS S3 or MinIO, needed to run more than one app node)
+    STORAGE_BACKEND = os.environ.get('STORAGE_BACKEND') or 'local'
+    S3_BUCKET = os.environ.get('S3_BUCKET') or 'mis-uploads'
+    S3_ENDPOINT_URL = os.environ.get('S3_ENDPOINT_URL')  # e.g. http://localhost:9000 for MinIO
+    S3_REGION = os.environ.get('S3_REGION')
+    S3_ACCESS_KEY = os.environ.get('S3_ACCESS_KEY')
+    S3_SECRET_KEY = os.environ.get('S3_SECRET_KEY')
+    S3_PREFIX = os.environ.get('S3_PREFIX') or ''
 
 
 class DevelopmentConfig(Config):
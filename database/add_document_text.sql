@@ -0,0 +1,19 @@
+-- =============================================
+-- Add Document Text
+-- Migration: Text extracted from uploaded documents, stored once per blob
+-- and indexed for full-text search. Run after add_file_blobs.sql.
+-- Requires PostgreSQL 12+
+-- =============================================
+
+-- NULL until extracted; '' when there was nothing to extract
+ALTER TABLE file_blobs ADD COLUMN IF NOT EXISTS content_text TEXT;
+-- Set when a worker claims the blob, so it is only extracted once
+ALTER TABLE file_blobs ADD COLUMN IF NOT EXISTS extracted_at TIMESTAMP;
+
+-- Document text ranks below titles (A) and descriptions (B)
+ALTER TABLE file_blobs ADD COLUMN IF NOT EXISTS content_vector tsvector
+    GENERATED ALWAYS AS (setweight(to_tsvector('english', coalesce(content_text, '')), 'C')) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_file_blobs_content_search ON file_blobs USING GIN (content_vector);
+
+SELECT 'Document text added successfully!' as status;
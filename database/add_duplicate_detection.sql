@@ -0,0 +1,33 @@
+-- =============================================
+-- Add Duplicate Student Detection
+-- Migration: Indexes for finding likely duplicate students by email, phone
+-- and similar names, plus a review queue of candidate pairs
+-- =============================================
+
+-- Trigram similarity for names ("Ahmad Karim" vs "Ahmed Kareem")
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+-- Blocking keys: only records sharing a key are ever compared
+CREATE INDEX IF NOT EXISTS idx_users_full_name_trgm ON users USING GIN (lower(full_name) gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_users_email_lower ON users (lower(trim(email))) WHERE email IS NOT NULL;
+CREATE INDEX IF NOT EXISTS idx_students_phone_digits ON students (right(regexp_replace(phone, '\D', '', 'g'), 9)) WHERE phone IS NOT NULL;
+
+-- Candidate pairs waiting for an admin; student_a_id < student_b_id.
+-- Merged pairs disappear with the removed student; dismissed pairs stay so
+-- the next scan does not suggest them again.
+CREATE TABLE IF NOT EXISTS duplicate_candidates (
+    id SERIAL PRIMARY KEY,
+    student_a_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+    student_b_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+    reasons TEXT[] NOT NULL,
+    score REAL NOT NULL,
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'dismissed')),
+    detected_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    resolved_at TIMESTAMP,
+    UNIQUE(student_a_id, student_b_id),
+    CHECK (student_a_id < student_b_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_duplicate_candidates_pending ON duplicate_candidates(score DESC) WHERE status = 'pending';
+
+SELECT 'Duplicate detection added successfully!' as status;
@@ -0,0 +1,17 @@
+-- =============================================
+-- Add File Access Counters
+-- Migration: Per-file, per-student, per-day open counts. Rows are written
+-- in batches from an in-memory buffer, not once per download.
+-- =============================================
+
+CREATE TABLE IF NOT EXISTS lecture_file_access (
+    file_id INTEGER NOT NULL REFERENCES lecture_files(id) ON DELETE CASCADE,
+    user_id INTEGER NOT NULL REFERENCES users(id) ON DELETE CASCADE,
+    access_date DATE NOT NULL,
+    hits INTEGER NOT NULL DEFAULT 0,
+    first_at TIMESTAMP NOT NULL,
+    last_at TIMESTAMP NOT NULL,
+    PRIMARY KEY (file_id, user_id, access_date)
+);
+
+SELECT 'File access counters added successfully!' as status;
@@ -0,0 +1,20 @@
+-- =============================================
+-- Add File Blobs
+-- Migration: Store each unique upload once (content-addressed by SHA-256)
+-- and let lecture_files rows share it
+-- =============================================
+
+CREATE TABLE IF NOT EXISTS file_blobs (
+    sha256 CHAR(64) PRIMARY KEY,
+    size BIGINT NOT NULL,
+    compressed BOOLEAN NOT NULL DEFAULT false,
+    ref_count INTEGER NOT NULL DEFAULT 0 CHECK (ref_count >= 0),
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- NULL for files uploaded before the blob store (one copy per row in uploads/subject_<id>/)
+ALTER TABLE lecture_files ADD COLUMN IF NOT EXISTS blob_hash CHAR(64) REFERENCES file_blobs(sha256);
+
+CREATE INDEX IF NOT EXISTS idx_lecture_files_blob ON lecture_files(blob_hash);
+
+SELECT 'File blobs table created successfully!' as status;
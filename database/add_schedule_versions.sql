@@ -0,0 +1,25 @@
+-- =============================================
+-- Add Schedule Versions
+-- Migration: Track a version number per class schedule so the
+-- schedule builder can cache and detect concurrent edits
+-- =============================================
+
+-- Create class_schedules table if this database predates the builder
+CREATE TABLE IF NOT EXISTS class_schedules (
+    id SERIAL PRIMARY KEY,
+    semester INTEGER NOT NULL CHECK (semester IN (1, 2, 3, 4)),
+    shift VARCHAR(10) NOT NULL CHECK (shift IN ('morning', 'night')),
+    section VARCHAR(1) NOT NULL CHECK (section IN ('A', 'B', 'C')),
+    schedule_data JSONB DEFAULT '[]'::jsonb,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    UNIQUE(semester, shift, section)
+);
+
+-- Version is bumped on every save
+ALTER TABLE class_schedules ADD COLUMN IF NOT EXISTS version INTEGER NOT NULL DEFAULT 1;
+
+-- Bootstrap queries look up assignments by subject
+CREATE INDEX IF NOT EXISTS idx_teacher_assignments_subject ON teacher_assignments(subject_id);
+
+SELECT 'Schedule versions added successfully!' as status;
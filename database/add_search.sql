@@ -0,0 +1,31 @@
+-- =============================================
+-- Add Full-Text Search
+-- Migration: Search vectors for lecture files, homework and weekly topics.
+-- They are generated columns, so Postgres keeps them current on every write.
+-- Requires PostgreSQL 12+
+-- =============================================
+
+-- Titles weigh more than descriptions when ranking
+ALTER TABLE lecture_files ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B')
+    ) STORED;
+
+ALTER TABLE homework ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(title, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B')
+    ) STORED;
+
+ALTER TABLE weekly_topics ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('english', coalesce(topic, '')), 'A') ||
+        setweight(to_tsvector('english', coalesce(description, '')), 'B')
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_lecture_files_search ON lecture_files USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS idx_homework_search ON homework USING GIN (search_vector);
+CREATE INDEX IF NOT EXISTS idx_weekly_topics_search ON weekly_topics USING GIN (search_vector);
+
+SELECT 'Full-text search added successfully!' as status;
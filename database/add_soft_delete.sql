@@ -0,0 +1,42 @@
+-- =============================================
+-- Add Soft Delete and Background Purge
+-- Migration: Deleting a student, subject or class only marks it deleted
+-- (hidden at once); a background job then removes its attendance, grades,
+-- files etc. in small batches so teachers are never blocked by the locks
+-- of one huge cascading DELETE
+-- =============================================
+
+ALTER TABLE students ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+ALTER TABLE subjects ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+ALTER TABLE classes ADD COLUMN IF NOT EXISTS deleted_at TIMESTAMP;
+
+CREATE TABLE IF NOT EXISTS purge_jobs (
+    id SERIAL PRIMARY KEY,
+    entity_type VARCHAR(20) NOT NULL CHECK (entity_type IN ('student', 'subject', 'class')),
+    entity_id INTEGER NOT NULL,
+    entity_name VARCHAR(200),
+    status VARCHAR(20) NOT NULL DEFAULT 'pending' CHECK (status IN ('pending', 'running', 'done', 'failed')),
+    step VARCHAR(50),
+    rows_deleted INTEGER NOT NULL DEFAULT 0,
+    files_removed INTEGER NOT NULL DEFAULT 0,
+    error TEXT,
+    requested_by INTEGER REFERENCES users(id) ON DELETE SET NULL,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    finished_at TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_purge_jobs_open ON purge_jobs(id) WHERE status IN ('pending', 'running');
+
+-- The purge finds dependent rows by these columns
+CREATE INDEX IF NOT EXISTS idx_attendance_subject ON attendance(subject_id);
+CREATE INDEX IF NOT EXISTS idx_homework_subject ON homework(subject_id);
+CREATE INDEX IF NOT EXISTS idx_homework_class ON homework(class_id);
+CREATE INDEX IF NOT EXISTS idx_weekly_topics_subject ON weekly_topics(subject_id);
+CREATE INDEX IF NOT EXISTS idx_weekly_topics_class ON weekly_topics(class_id);
+CREATE INDEX IF NOT EXISTS idx_timetable_class ON timetable(class_id);
+CREATE INDEX IF NOT EXISTS idx_lecture_files_subject ON lecture_files(subject_id);
+CREATE INDEX IF NOT EXISTS idx_lecture_files_class ON lecture_files(class_id);
+CREATE INDEX IF NOT EXISTS idx_lecture_file_access_user ON lecture_file_access(user_id);
+
+SELECT 'Soft delete and purge jobs added successfully!' as status;
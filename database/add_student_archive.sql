@@ -0,0 +1,27 @@
+-- =============================================
+-- Add Student Archive
+-- Migration: Keep graduates out of the semester lists while
+-- preserving where they finished
+-- =============================================
+
+-- Set when a Semester 4 student graduates; semester/section/class_id are cleared
+ALTER TABLE students ADD COLUMN IF NOT EXISTS graduated_at TIMESTAMP;
+
+-- Snapshot of each graduate's final placement
+CREATE TABLE IF NOT EXISTS student_archive (
+    id SERIAL PRIMARY KEY,
+    student_id INTEGER NOT NULL REFERENCES students(id) ON DELETE CASCADE,
+    user_id INTEGER REFERENCES users(id) ON DELETE SET NULL,
+    student_number VARCHAR(50),
+    year INTEGER,
+    semester INTEGER,
+    shift VARCHAR(10),
+    section VARCHAR(1),
+    class_id INTEGER REFERENCES classes(id) ON DELETE SET NULL,
+    graduated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Promotion moves whole cohorts by semester
+CREATE INDEX IF NOT EXISTS idx_students_semester_shift_section ON students(semester, shift, section);
+
+SELECT 'Student archive created successfully!' as status;
@@ -1,6 +1,9 @@
 """
 Database connection and helper functions for MIS System
 """
+import re
+from decimal import Decimal, ROUND_HALF_UP
+
 import pg8000
 import pg8000.native
 from config import config
@@ -114,6 +117,45 @@ def execute_insert_returning(query, params=None):
         return None
 
 
+def rows_to_dicts(cursor):
+    """Fetch all remaining rows from a cursor as dictionaries"""
+    rows = cursor.fetchall()
+    return [row_to_dict(cursor, row) for row in rows] if rows else []
+
+
+def run_transaction(work, commit=True):
+    """
+    Run several statements in one transaction.
+    
+    Args:
+        work: Function taking a cursor; its return value is passed through
+        commit: Commit when work succeeds (False rolls back, e.g. for dry runs)
+    
+    Returns:
+        Result of work, or None if it raised (everything is rolled back)
+    """
+    conn = get_db_connection()
+    if not conn:
+        return None
+    
+    try:
+        cursor = conn.cursor()
+        result = work(cursor)
+        if commit:
+            conn.commit()
+        else:
+            conn.rollback()
+        cursor.close()
+        conn.close()
+        return result
+    
+    except Exception as e:
+        print(f"Transaction error: {e}")
+        conn.rollback()
+        conn.close()
+        return None
+
+
 # =============================================
 # SYSTEM SETTINGS
 # =============================================
@@ -156,7 +198,7 @@ def get_students_by_year_shift_section(year, shift, section):
         SELECT s.*, u.full_name, u.username, u.email
         FROM students s
         JOIN users u ON s.user_id = u.id
-        WHERE s.year = %s AND s.shift = %s AND s.section = %s
+        WHERE s.year = %s AND s.shift = %s AND s.section = %s AND s.deleted_at IS NULL AND s.graduated_at IS NULL
         ORDER BY u.full_name
     """
     return execute_query(query, (year, shift, section), fetch_all=True)
@@ -169,7 +211,7 @@ def get_students_by_semester(semester, shift, section):
         SELECT s.*, u.full_name, u.username, u.email
         FROM students s
         JOIN users u ON s.user_id = u.id
-        WHERE s.semester = %s AND s.shift = %s AND s.section = %s
+        WHERE s.semester = %s AND s.shift = %s AND s.section = %s AND s.deleted_at IS NULL AND s.graduated_at IS NULL
         ORDER BY u.full_name
     """
     return execute_query(query, (semester, shift, section), fetch_all=True)
@@ -179,7 +221,7 @@ def get_student_count_by_year_shift_section(year, shift, section):
     """Get count of students in a year/shift/section"""
     query = """
         SELECT COUNT(*) as count FROM students
-        WHERE year = %s AND shift = %s AND section = %s
+        WHERE year = %s AND shift = %s AND section = %s AND deleted_at IS NULL AND graduated_at IS NULL
     """
     result = execute_query(query, (year, shift, section), fetch_one=True)
     return result['count'] if result else 0
@@ -205,12 +247,109 @@ def create_student_with_semester(user_id, year, semester, shift, section, studen
     return execute_insert_returning(query, (user_id, year, semester, shift, section, student_number, phone, class_id))
 
 
+def _student_number_sequence(cursor, year):
+    """Name of the sequence for MIS<year> numbers, created on first use"""
+    name = f"student_number_seq_{int(year)}"
+    cursor.execute("SELECT to_regclass(%s)", (name,))
+    if cursor.fetchone()[0] is not None:
+        return name
+    
+    # First allocation of the year: make a concurrent first allocation wait,
+    # then check again so the sequence is only created and seeded once
+    cursor.execute("SELECT pg_advisory_xact_lock(hashtext(%s))", (name,))
+    cursor.execute("SELECT to_regclass(%s)", (name,))
+    if cursor.fetchone()[0] is None:
+        prefix = f"MIS{int(year)}"
+        cursor.execute(f"CREATE SEQUENCE {name}")
+        # Continue after numbers handed out before the sequence existed
+        cursor.execute("""
+            SELECT COALESCE(MAX(substring(student_number FROM %s)::int), 0)
+            FROM students WHERE student_number ~ %s
+        """, (len(prefix) + 1, f'^{prefix}[0-9]{{5,}}$'))
+        last = cursor.fetchone()[0]
+        if last:
+            cursor.execute("SELECT setval(%s, %s)", (name, last))
+    return name
+
+
+def allocate_student_numbers(count=1, year=None, cursor=None):
+    """
+    Hand out unique MIS<year><seq> student numbers from a per-year sequence.
+    
+    Safe under concurrency: two admins (or an admin and an import) never get
+    the same number. Numbers taken by a transaction that later rolls back are
+    not reused, so there can be gaps.
+    
+    Args:
+        count: How many numbers to allocate
+        year: Intake year (default: current year)
+        cursor: Run inside the caller's transaction instead of a new one
+    
+    Returns:
+        List of student numbers in ascending order, or None on error
+    """
+    import datetime
+    year = year or datetime.datetime.now().year
+    
+    def work(cursor):
+        name = _student_number_sequence(cursor, year)
+        cursor.execute(f"SELECT nextval('{name}') FROM generate_series(1, %s)", (count,))
+        return [f"MIS{year}{row[0]:05d}" for row in sorted(cursor.fetchall())]
+    
+    if cursor is not None:
+        return work(cursor)
+    return run_transaction(work)
+
+
+def import_students(students):
+    """
+    Create users and students for a whole intake in one transaction.
+
+    Args:
+        students: List of dicts with full_name, password, password_hash, email,
+                  year, semester, shift, section, phone
+
+    Returns:
+        List of (student_number, username) in input order, or None on error
+        (nothing is written)
+    """
+    def work(cursor):
+        numbers = allocate_student_numbers(len(students), cursor=cursor)
+        usernames = [n.lower() for n in numbers]
+
+        cursor.execute("""
+            INSERT INTO users (username, password_hash, full_name, role, email, plain_password)
+            SELECT u.username, u.password_hash, u.full_name, 'student', u.email, u.password
+            FROM unnest(%s::varchar[], %s::varchar[], %s::varchar[], %s::varchar[], %s::varchar[])
+                 AS u(username, password_hash, full_name, email, password)
+        """, (usernames, [s['password_hash'] for s in students], [s['full_name'] for s in students],
+              [s['email'] for s in students], [s['password'] for s in students]))
+
+        # Class is linked the same way as create_student_with_semester
+        cursor.execute("""
+            INSERT INTO students (user_id, year, semester, shift, section, student_number, phone, class_id)
+            SELECT u.id, s.year, s.semester, s.shift, s.section, s.student_number, s.phone,
+                   (SELECT c.id FROM classes c
+                    WHERE c.semester = s.semester AND c.shift = s.shift AND c.section = s.section
+                      AND c.is_active = true
+                    LIMIT 1)
+            FROM unnest(%s::varchar[], %s::int[], %s::int[], %s::varchar[], %s::varchar[], %s::varchar[], %s::varchar[])
+                 AS s(username, year, semester, shift, section, student_number, phone)
+            JOIN users u ON u.username = s.username
+        """, (usernames, [s['year'] for s in students], [s['semester'] for s in students],
+              [s['shift'] for s in students], [s['section'] for s in students], numbers,
+              [s['phone'] for s in students]))
+        return list(zip(numbers, usernames))
+
+    return run_transaction(work)
+
+
 def get_student_counts_by_semester():
     """Get student counts grouped by semester, shift"""
     query = """
         SELECT semester, shift, section, COUNT(*) as count
         FROM students
-        WHERE semester IS NOT NULL
+        WHERE semester IS NOT NULL AND deleted_at IS NULL AND graduated_at IS NULL
         GROUP BY semester, shift, section
         ORDER BY semester, shift, section
     """
@@ -245,10 +384,20 @@ def get_user_by_username(username):
 
 def get_user_by_email(email):
     """Get user by email"""
-    query = "SELECT * FROM users WHERE email = %s"
+    query = """
+        SELECT * FROM users
+        WHERE email = %s
+          AND NOT EXISTS (SELECT 1 FROM students s WHERE s.user_id = users.id AND s.deleted_at IS NOT NULL)
+    """
     return execute_query(query, (email,), fetch_one=True)
 
 
+def is_deleted_student(user_id):
+    """Whether this user's student record has been deleted (their session must end)"""
+    query = "SELECT 1 FROM students WHERE user_id = %s AND deleted_at IS NOT NULL"
+    return execute_query(query, (user_id,), fetch_one=True) is not None
+
+
 def get_user_by_id(user_id):
     """Get user by ID"""
     query = "SELECT * FROM users WHERE id = %s"
@@ -303,6 +452,7 @@ def get_all_classes():
     """Get all classes ordered by year, semester, section, shift"""
     query = """
         SELECT * FROM classes 
+        WHERE deleted_at IS NULL
         ORDER BY year, semester, section, shift
     """
     return execute_query(query, fetch_all=True)
@@ -322,6 +472,8 @@ def get_class_student_counts():
         WHERE s.semester IS NOT NULL 
           AND s.shift IS NOT NULL 
           AND s.section IS NOT NULL
+          AND s.deleted_at IS NULL
+          AND s.graduated_at IS NULL
         GROUP BY s.semester, s.shift, s.section
         ORDER BY s.semester, s.shift, s.section
     """
@@ -341,7 +493,7 @@ def get_class_student_counts():
 
 def get_class_by_id(class_id):
     """Get class by ID"""
-    query = "SELECT * FROM classes WHERE id = %s"
+    query = "SELECT * FROM classes WHERE id = %s AND deleted_at IS NULL"
     return execute_query(query, (class_id,), fetch_one=True)
 
 
@@ -359,7 +511,7 @@ def get_classes_by_year_semester(year, semester):
     """Get classes for a specific year and semester"""
     query = """
         SELECT * FROM classes 
-        WHERE year = %s AND semester = %s
+        WHERE year = %s AND semester = %s AND deleted_at IS NULL
         ORDER BY section, shift
     """
     return execute_query(query, (year, semester), fetch_all=True)
@@ -422,6 +574,17 @@ def get_teacher_by_user_id(user_id):
     return execute_query(query, (user_id,), fetch_one=True)
 
 
+def get_teacher_by_id(teacher_id):
+    """Get teacher by teacher ID"""
+    query = """
+        SELECT t.*, u.full_name, u.username, u.email
+        FROM teachers t
+        JOIN users u ON t.user_id = u.id
+        WHERE t.id = %s
+    """
+    return execute_query(query, (teacher_id,), fetch_one=True)
+
+
 def get_all_teachers():
     """Get all teachers with user info"""
     query = """
@@ -455,7 +618,7 @@ def get_subjects_by_teacher_id(teacher_id):
         FROM teacher_assignments ta
         JOIN subjects s ON ta.subject_id = s.id
         JOIN classes c ON ta.class_id = c.id
-        WHERE ta.teacher_id = %s
+        WHERE ta.teacher_id = %s AND s.deleted_at IS NULL AND c.deleted_at IS NULL
         ORDER BY s.name, c.year, c.section
     """
     return execute_query(query, (teacher_id,), fetch_all=True)
@@ -482,7 +645,7 @@ def get_student_by_user_id(user_id):
         FROM students s
         JOIN users u ON s.user_id = u.id
         LEFT JOIN classes c ON s.class_id = c.id
-        WHERE s.user_id = %s
+        WHERE s.user_id = %s AND s.deleted_at IS NULL
     """
     return execute_query(query, (user_id,), fetch_one=True)
 
@@ -493,7 +656,7 @@ def get_students_by_class(class_id):
         SELECT s.*, u.full_name, u.username, u.email
         FROM students s
         JOIN users u ON s.user_id = u.id
-        WHERE s.class_id = %s
+        WHERE s.class_id = %s AND s.deleted_at IS NULL AND s.graduated_at IS NULL
         ORDER BY u.full_name
     """
     return execute_query(query, (class_id,), fetch_all=True)
@@ -506,6 +669,7 @@ def get_all_students():
         FROM students s
         JOIN users u ON s.user_id = u.id
         LEFT JOIN classes c ON s.class_id = c.id
+        WHERE s.deleted_at IS NULL AND s.graduated_at IS NULL
         ORDER BY u.full_name
     """
     return execute_query(query, fetch_all=True)
@@ -517,7 +681,7 @@ def get_student_by_id(student_id):
         SELECT s.*, u.full_name, u.username, u.email
         FROM students s
         JOIN users u ON s.user_id = u.id
-        WHERE s.id = %s
+        WHERE s.id = %s AND s.deleted_at IS NULL
     """
     return execute_query(query, (student_id,), fetch_one=True)
 
@@ -558,7 +722,7 @@ def get_students_filtered(year=None, class_id=None):
         FROM students s
         JOIN users u ON s.user_id = u.id
         LEFT JOIN classes c ON s.class_id = c.id
-        WHERE 1=1
+        WHERE s.deleted_at IS NULL AND s.graduated_at IS NULL
     """
     params = []
     
@@ -581,16 +745,17 @@ def get_students_filtered(year=None, class_id=None):
 
 def get_subject_count_by_class(class_id):
     """Get the number of subjects for a class (max should be 5)"""
-    query = "SELECT COUNT(*) as count FROM subjects WHERE class_id = %s"
+    query = "SELECT COUNT(*) as count FROM subjects WHERE class_id = %s AND deleted_at IS NULL"
     result = execute_query(query, (class_id,), fetch_one=True)
     return result['count'] if result else 0
 
 
 def create_subject(name, semester, description=None):
     """Create a new subject for a specific semester or return existing subject ID"""
-    # Check if subject with this name already exists in this semester
+    # Check if subject with this name already exists in this semester (a deleted
+    # one waiting for its purge does not count)
     existing = execute_query(
-        "SELECT id FROM subjects WHERE LOWER(name) = LOWER(%s) AND semester = %s",
+        "SELECT id FROM subjects WHERE LOWER(name) = LOWER(%s) AND semester = %s AND deleted_at IS NULL",
         (name, semester),
         fetch_one=True
     )
@@ -611,7 +776,7 @@ def get_subject_by_name_and_class(name, class_id):
         SELECT s.*, ta.id as assignment_id, ta.teacher_id
         FROM subjects s
         LEFT JOIN teacher_assignments ta ON s.id = ta.subject_id AND ta.class_id = %s
-        WHERE s.name = %s
+        WHERE s.name = %s AND s.deleted_at IS NULL
     """
     return execute_query(query, (class_id, name), fetch_one=True)
 
@@ -626,7 +791,7 @@ def get_subjects_by_class(class_id):
         JOIN teacher_assignments ta ON s.id = ta.subject_id
         LEFT JOIN teachers t ON  ta.teacher_id = t.id
         LEFT JOIN users u ON t.user_id = u.id
-        WHERE ta.class_id = %s
+        WHERE ta.class_id = %s AND s.deleted_at IS NULL
         ORDER BY s.name
     """
     return execute_query(query, (class_id,), fetch_all=True)
@@ -641,7 +806,7 @@ def get_subjects_by_teacher(teacher_id):
         FROM subjects s
         JOIN teacher_assignments ta ON s.id = ta.subject_id
         JOIN classes c ON ta.class_id = c.id
-        WHERE ta.teacher_id = %s
+        WHERE ta.teacher_id = %s AND s.deleted_at IS NULL AND c.deleted_at IS NULL
         ORDER BY c.year, c.semester, c.section, s.name
     """
     return execute_query(query, (teacher_id,), fetch_all=True)
@@ -660,6 +825,7 @@ def get_all_subjects():
         LEFT JOIN classes c ON ta.class_id = c.id
         LEFT JOIN teachers t ON ta.teacher_id = t.id
         LEFT JOIN users u ON t.user_id = u.id
+        WHERE s.deleted_at IS NULL
         ORDER BY s.name, c.year, c.semester, c.section
     """
     return execute_query(query, fetch_all=True)
@@ -672,7 +838,7 @@ def get_unique_subjects_by_semester():
                CASE WHEN s.semester IN (1,2) THEN 1 ELSE 2 END AS year,
                s.semester
         FROM subjects s
-        WHERE s.semester IS NOT NULL
+        WHERE s.semester IS NOT NULL AND s.deleted_at IS NULL
         ORDER BY s.semester, s.name
     """
     return execute_query(query, fetch_all=True)
@@ -690,7 +856,7 @@ def get_subjects_grouped_by_semester():
         LEFT JOIN classes c ON ta.class_id = c.id
         LEFT JOIN teachers t ON ta.teacher_id = t.id
         LEFT JOIN users u ON t.user_id = u.id
-        WHERE s.semester IS NOT NULL
+        WHERE s.semester IS NOT NULL AND s.deleted_at IS NULL
         ORDER BY c.year, s.semester, c.section, s.name
     """
     return execute_query(query, fetch_all=True)
@@ -710,7 +876,7 @@ def get_first_class_for_semester(year, semester):
     """Get the first class ID for a given year/semester (for subject creation)"""
     query = """
         SELECT id FROM classes 
-        WHERE year = %s AND semester = %s 
+        WHERE year = %s AND semester = %s AND deleted_at IS NULL
         ORDER BY id LIMIT 1
     """
     result = execute_query(query, (year, semester), fetch_one=True)
@@ -731,7 +897,7 @@ def get_subject_by_id(subject_id):
         LEFT JOIN classes c ON ta.class_id = c.id
         LEFT JOIN teachers t ON ta.teacher_id = t.id
         LEFT JOIN users u ON t.user_id = u.id
-        WHERE s.id = %s
+        WHERE s.id = %s AND s.deleted_at IS NULL
     """
     return execute_query(query, (subject_id,), fetch_one=True)
 
@@ -956,15 +1122,37 @@ def create_homework(class_id, subject_id, teacher_id, title, description, due_da
     return execute_insert_returning(query, (class_id, subject_id, teacher_id, title, description, due_date))
 
 
+def create_homework_bulk(teacher_id, pairs, title, description, due_date):
+    """
+    Publish one homework to many (subject_id, class_id) pairs in one statement.
+    
+    Returns:
+        List of new homework IDs, or None on error
+    """
+    pairs = list(dict.fromkeys(pairs))
+    
+    def work(cursor):
+        cursor.execute("""
+            INSERT INTO homework (class_id, subject_id, teacher_id, title, description, due_date)
+            SELECT p.class_id, p.subject_id, %s, %s, %s, %s::date
+            FROM unnest(%s::int[], %s::int[]) AS p(subject_id, class_id)
+            RETURNING id
+        """, (teacher_id, title, description, due_date, [p[0] for p in pairs], [p[1] for p in pairs]))
+        return [row[0] for row in cursor.fetchall()]
+    
+    return run_transaction(work)
+
+
 def get_homework_by_class(class_id):
     """Get all homework for a class"""
     query = """
         SELECT h.*, s.name as subject_name, u.full_name as teacher_name
         FROM homework h
         JOIN subjects s ON h.subject_id = s.id
+        JOIN classes c ON h.class_id = c.id
         LEFT JOIN teachers t ON h.teacher_id = t.id
         LEFT JOIN users u ON t.user_id = u.id
-        WHERE h.class_id = %s
+        WHERE h.class_id = %s AND s.deleted_at IS NULL AND c.deleted_at IS NULL
         ORDER BY h.due_date DESC
     """
     return execute_query(query, (class_id,), fetch_all=True)
@@ -977,7 +1165,7 @@ def get_homework_by_teacher(teacher_id):
         FROM homework h
         JOIN subjects s ON h.subject_id = s.id
         JOIN classes c ON h.class_id = c.id
-        WHERE h.teacher_id = %s
+        WHERE h.teacher_id = %s AND s.deleted_at IS NULL AND c.deleted_at IS NULL
         ORDER BY h.due_date DESC
     """
     return execute_query(query, (teacher_id,), fetch_all=True)
@@ -1045,46 +1233,56 @@ def update_grade_component(component_id, component_type, component_name, max_sco
 
 
 def delete_grade_component(component_id):
-    """Delete a grade component"""
-    query = "DELETE FROM grade_components WHERE id = %s RETURNING id"
+    """Delete a grade component (the subject's rubric no longer follows a template)"""
+    query = """
+        WITH removed AS (
+            DELETE FROM grade_components WHERE id = %s RETURNING id, subject_id
+        ), detached AS (
+            DELETE FROM subject_rubrics WHERE subject_id IN (SELECT subject_id FROM removed)
+        )
+        SELECT id FROM removed
+    """
     return execute_insert_returning(query, (component_id,))
 
 
 def delete_grade_components_by_type(subject_id, component_type):
     """Delete all grade components of a specific type for a subject"""
-    query = "DELETE FROM grade_components WHERE subject_id = %s AND component_type = %s RETURNING id"
-    return execute_query(query, (subject_id, component_type), fetch_all=True)
+    query = """
+        WITH removed AS (
+            DELETE FROM grade_components WHERE subject_id = %s AND component_type = %s RETURNING id
+        ), detached AS (
+            DELETE FROM subject_rubrics WHERE subject_id = %s AND EXISTS (SELECT 1 FROM removed)
+        )
+        SELECT id FROM removed
+    """
+    return execute_query(query, (subject_id, component_type, subject_id), fetch_all=True)
 
 
 def update_grade_components_by_type(subject_id, component_type, new_total_weight):
-    """Update weight for all components of a type (redistribute equally)"""
-    # Get all components of this type
-    components = execute_query(
-        "SELECT id, weight_percentage FROM grade_components WHERE subject_id = %s AND component_type = %s ORDER BY id",
-        (subject_id, component_type),
-        fetch_all=True
-    )
-    
-    if not components:
-        return False
-    
-    count = len(components)
-    individual_weight = round(new_total_weight / count, 2)
-    
-    # Handle rounding
-    weights = [individual_weight] * count
-    if sum(weights) != new_total_weight:
-        weights[-1] = round(new_total_weight - sum(weights[:-1]), 2)
+    """
+    Set the total weight of a category, split equally over its components
+    (the last one takes the rounding remainder).
     
-    # Update each component
-    for i, comp in enumerate(components):
-        execute_query(
-            "UPDATE grade_components SET weight_percentage = %s, max_score = %s WHERE id = %s",
-            (weights[i], weights[i], comp['id']),
-            fetch_one=False
-        )
+    Returns:
+        Same as apply_rubric_diff
+    """
+    def work(cursor):
+        current = _lock_rubric(cursor, subject_id)
+        if current is None:
+            return {'error': 'Subject not found'}
+        ids = sorted(cid for cid, c in current.items() if c['component_type'] == component_type)
+        if not ids:
+            return {'error': f'No {component_type} components to update'}
+        
+        total = Decimal(str(new_total_weight))
+        share = (total / len(ids)).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        weights = [share] * (len(ids) - 1)
+        weights.append(total - sum(weights))
+        
+        update = [{'id': cid, 'weight_percentage': w, 'max_score': w} for cid, w in zip(ids, weights)]
+        return _write_rubric_diff(cursor, subject_id, current, update=update)
     
-    return True
+    return run_transaction(work)
 
 
 def get_subject_total_weight(subject_id):
@@ -1130,48 +1328,324 @@ def update_component_display_order(component_id, new_order):
 
 def reorder_categories_by_type(subject_id, category_order_list):
     """
-    Reorder all components by category position
+    Reorder all components by category position in one statement.
     category_order_list: list of component_types in desired order
     Each category gets a base order (0, 100, 200...), components within are sequential
     """
-    try:
-        print(f"Reordering categories for subject {subject_id}")
-        print(f"New order: {category_order_list}")
+    query = """
+        UPDATE grade_components gc
+        SET display_order = (o.position - 1) * 100 + r.rn - 1
+        FROM (
+            SELECT id, component_type,
+                   ROW_NUMBER() OVER (PARTITION BY component_type ORDER BY display_order, id) AS rn
+            FROM grade_components
+            WHERE subject_id = %s
+        ) r
+        JOIN unnest(%s::text[]) WITH ORDINALITY AS o(component_type, position)
+          ON o.component_type = r.component_type
+        WHERE gc.id = r.id
+    """
+    return execute_query(query, (subject_id, list(category_order_list))) is not None
+
+
+def _lock_rubric(cursor, subject_id):
+    """
+    Lock a subject's rubric for editing and return its components by ID
+    (None if the subject does not exist). Rubric edits of the same subject
+    queue up behind this lock, so the weight check sees the final rubric.
+    """
+    cursor.execute("SELECT id FROM subjects WHERE id = %s FOR UPDATE", (subject_id,))
+    if not cursor.fetchone():
+        return None
+    cursor.execute("SELECT * FROM grade_components WHERE subject_id = %s", (subject_id,))
+    return {row['id']: row for row in rows_to_dicts(cursor)}
+
+
+def _write_rubric_diff(cursor, subject_id, current, add=(), update=(), delete=(), require_complete=False):
+    """Check the total weight of the rubric after the diff, then write it (see apply_rubric_diff)"""
+    delete = set(delete)
+    unknown = sorted(cid for cid in delete | {u['id'] for u in update} if cid not in current)
+    if unknown:
+        return {'error': f'Components {unknown} do not belong to this subject'}
+    update = [u for u in update if u['id'] not in delete]
+    
+    weights = {cid: Decimal(str(c['weight_percentage'])) for cid, c in current.items() if cid not in delete}
+    for u in update:
+        if u.get('weight_percentage') is not None:
+            weights[u['id']] = Decimal(str(u['weight_percentage']))
+    total = sum(weights.values(), Decimal('0')) + sum((Decimal(str(a['weight_percentage'])) for a in add), Decimal('0'))
+    
+    if total > Decimal('100.01'):
+        return {'error': f'Total weight would be {total:.2f}% (max 100%)'}
+    if require_complete and abs(total - 100) > Decimal('0.01'):
+        return {'error': f'Total weight must be 100% (this rubric totals {total:.2f}%)'}
+    
+    # A rubric edited by hand no longer follows its template
+    cursor.execute("DELETE FROM subject_rubrics WHERE subject_id = %s", (subject_id,))
+    
+    if delete:
+        cursor.execute(
+            "DELETE FROM grade_components WHERE subject_id = %s AND id = ANY(%s)",
+            (subject_id, list(delete))
+        )
+    
+    if update:
+        fields = ('component_type', 'component_name', 'max_score', 'weight_percentage', 'display_order')
+        values = ', '.join(['(%s::int, %s::text, %s::text, %s::numeric, %s::numeric, %s::int)'] * len(update))
+        params = [v for u in update for v in [u['id']] + [u.get(f) for f in fields]]
+        cursor.execute(f"""
+            UPDATE grade_components gc
+            SET component_type = COALESCE(v.component_type, gc.component_type),
+                component_name = COALESCE(v.component_name, gc.component_name),
+                max_score = COALESCE(v.max_score, gc.max_score),
+                weight_percentage = COALESCE(v.weight_percentage, gc.weight_percentage),
+                display_order = COALESCE(v.display_order, gc.display_order)
+            FROM (VALUES {values}) AS v(id, component_type, component_name, max_score, weight_percentage, display_order)
+            WHERE gc.id = v.id AND gc.subject_id = %s
+        """, params + [subject_id])
+    
+    added = []
+    if add:
+        cursor.execute("""
+            INSERT INTO grade_components
+            (subject_id, component_type, component_name, max_score, weight_percentage, display_order)
+            SELECT %s, * FROM unnest(%s::text[], %s::text[], %s::numeric[], %s::numeric[], %s::int[])
+            RETURNING id
+        """, (
+            subject_id,
+            [a['component_type'] for a in add],
+            [a['component_name'] for a in add],
+            [a['max_score'] for a in add],
+            [a['weight_percentage'] for a in add],
+            [a.get('display_order') or 0 for a in add],
+        ))
+        added = [row[0] for row in cursor.fetchall()]
+    
+    return {'total_weight': float(total), 'added': added}
+
+
+def apply_rubric_diff(subject_id, add=(), update=(), delete=(), require_complete=False):
+    """
+    Apply a rubric edit - new components, changed weights/names/order and
+    deletions - in one transaction. The total weight is checked against the
+    resulting rubric while the subject is locked, so two editors cannot push
+    it past 100% between them.
+    
+    Args:
+        add: Dicts with component_type, component_name, max_score,
+             weight_percentage and display_order
+        update: Dicts with id plus the fields to change
+        delete: Component IDs
+        require_complete: The total must be exactly 100% (else at most 100%)
+    
+    Returns:
+        Dict with 'total_weight' and 'added' (new IDs), or with 'error'
+        (nothing changed); None on database error
+    """
+    def work(cursor):
+        current = _lock_rubric(cursor, subject_id)
+        if current is None:
+            return {'error': 'Subject not found'}
+        return _write_rubric_diff(cursor, subject_id, current, add, update, delete, require_complete)
+    
+    return run_transaction(work)
+
+
+# =============================================
+# RUBRIC TEMPLATES
+# =============================================
+# A template is a named rubric that can be copied onto many subjects at once.
+# subject_rubrics records the template version each subject got, so
+# re-applying an edited template only rewrites subjects still on an older
+# version. Subjects that already have grades keep their rubric.
+
+def get_rubric_templates():
+    """All rubric templates with their components and how many subjects use them"""
+    query = """
+        SELECT rt.*,
+               COALESCE(items.count, 0) AS component_count,
+               COALESCE(items.total_weight, 0) AS total_weight,
+               items.summary,
+               COUNT(sr.subject_id) AS subject_count,
+               COUNT(sr.subject_id) FILTER (WHERE sr.template_version < rt.version) AS outdated_count
+        FROM rubric_templates rt
+        LEFT JOIN (
+            SELECT template_id, COUNT(*) AS count, SUM(weight_percentage) AS total_weight,
+                   STRING_AGG(component_name || ' (' || weight_percentage || ')', ', '
+                              ORDER BY display_order, id) AS summary
+            FROM rubric_template_items
+            GROUP BY template_id
+        ) items ON items.template_id = rt.id
+        LEFT JOIN subject_rubrics sr ON sr.template_id = rt.id
+        GROUP BY rt.id, items.count, items.total_weight, items.summary
+        ORDER BY rt.name
+    """
+    return execute_query(query, fetch_all=True)
+
+
+def get_rubric_template(template_id):
+    """A rubric template with its items (None if not found)"""
+    template = execute_query("SELECT * FROM rubric_templates WHERE id = %s", (template_id,), fetch_one=True)
+    if template:
+        template['items'] = execute_query("""
+            SELECT component_type, component_name, max_score, weight_percentage, display_order
+            FROM rubric_template_items
+            WHERE template_id = %s
+            ORDER BY display_order, id
+        """, (template_id,), fetch_all=True) or []
+    return template
+
+
+def save_rubric_template(name, items, description=None, template_id=None):
+    """
+    Create a rubric template, or replace the items of an existing one and
+    bump its version.
+    
+    Args:
+        items: Dicts with component_type, component_name, max_score,
+               weight_percentage and display_order; weights must total 100%
+    
+    Returns:
+        Dict with 'id' and 'version', or with 'error'; None on database error
+    """
+    total = sum((Decimal(str(i['weight_percentage'])) for i in items), Decimal('0'))
+    if not items or abs(total - 100) > Decimal('0.01'):
+        return {'error': f'Template weights must total 100% (they total {total:.2f}%)'}
+    
+    def work(cursor):
+        cursor.execute(
+            "SELECT id FROM rubric_templates WHERE LOWER(name) = LOWER(%s) AND id IS DISTINCT FROM %s",
+            (name, template_id)
+        )
+        if cursor.fetchone():
+            return {'error': f'A template named "{name}" already exists'}
         
-        for idx, component_type in enumerate(category_order_list):
-            base_order = idx * 100
-            print(f"Processing category {component_type} at position {idx} (base_order={base_order})")
-            
-            # Get all components of this type, ordered by current display_order
-            query_get = """
-                SELECT id, component_name, display_order FROM grade_components
-                WHERE subject_id = %s AND component_type = %s
-                ORDER BY display_order, id
-            """
-            components = execute_query(query_get, (subject_id, component_type), fetch_all=True)
-            print(f"  Found {len(components) if components else 0} components")
-            
-            if components:
-                # Update each component with sequential ordering
-                for i, comp in enumerate(components):
-                    new_order = base_order + i
-                    old_order = comp['display_order']
-                    print(f"    Updating {comp['component_name']}: {old_order} -> {new_order}")
-                    query_update = """
-                        UPDATE grade_components
-                        SET display_order = %s
-                        WHERE id = %s
-                    """
-                    result = execute_query(query_update, (new_order, comp['id']))
-                    print(f"      Update result: {result}")
+        if template_id:
+            cursor.execute("""
+                UPDATE rubric_templates
+                SET name = %s, description = %s, version = version + 1, updated_at = CURRENT_TIMESTAMP
+                WHERE id = %s
+                RETURNING id, version
+            """, (name, description, template_id))
+            row = cursor.fetchone()
+            if not row:
+                return {'error': 'Template not found'}
+            cursor.execute("DELETE FROM rubric_template_items WHERE template_id = %s", (template_id,))
+        else:
+            cursor.execute(
+                "INSERT INTO rubric_templates (name, description) VALUES (%s, %s) RETURNING id, version",
+                (name, description)
+            )
+            row = cursor.fetchone()
         
-        print("Reordering complete!")
-        return True
-    except Exception as e:
-        print(f"Error reordering categories: {e}")
-        import traceback
-        traceback.print_exc()
-        return False
+        cursor.execute("""
+            INSERT INTO rubric_template_items
+            (template_id, component_type, component_name, max_score, weight_percentage, display_order)
+            SELECT %s, * FROM unnest(%s::text[], %s::text[], %s::numeric[], %s::numeric[], %s::int[])
+        """, (
+            row[0],
+            [i['component_type'] for i in items],
+            [i['component_name'] for i in items],
+            [i['max_score'] for i in items],
+            [i['weight_percentage'] for i in items],
+            [i.get('display_order') or 0 for i in items],
+        ))
+        return {'id': row[0], 'version': row[1]}
+    
+    return run_transaction(work)
+
+
+def delete_rubric_template(template_id):
+    """Delete a rubric template (subjects keep the components they got from it)"""
+    query = "DELETE FROM rubric_templates WHERE id = %s RETURNING id"
+    return execute_insert_returning(query, (template_id,))
+
+
+def apply_rubric_template(template_id, semester=None, subject_ids=None, overwrite=False, dry_run=False):
+    """
+    Copy a template's components onto many subjects with set-based statements.
+    
+    Targets are the subjects of a semester and/or the given subject IDs; with
+    neither, the subjects already using this template (to push out an edit).
+    Skipped: subjects with grades (their rubric is locked), subjects already
+    on the current version, and - unless overwrite - subjects whose rubric was
+    built by hand or follows another template.
+    
+    Returns:
+        Dict with 'version' and lists of subject IDs under 'applied',
+        'locked', 'up_to_date', 'custom' and 'other_template'; None on
+        database error
+    """
+    subject_ids = [int(s) for s in subject_ids or []]
+    propagate = semester is None and not subject_ids
+    
+    def work(cursor):
+        cursor.execute("SELECT version FROM rubric_templates WHERE id = %s FOR SHARE", (template_id,))
+        row = cursor.fetchone()
+        if not row:
+            return {'error': 'Template not found'}
+        version = row[0]
+        
+        # Locking the subject rows queues this behind rubric edits (see _lock_rubric)
+        cursor.execute("""
+            SELECT s.id,
+                   CASE
+                       WHEN EXISTS (SELECT 1 FROM grades g WHERE g.subject_id = s.id) THEN 'locked'
+                       WHEN sr.template_id = %s AND sr.template_version = %s THEN 'up_to_date'
+                       WHEN sr.template_id <> %s AND NOT %s THEN 'other_template'
+                       WHEN sr.subject_id IS NULL AND NOT %s
+                            AND EXISTS (SELECT 1 FROM grade_components gc WHERE gc.subject_id = s.id) THEN 'custom'
+                       ELSE 'applied'
+                   END AS status
+            FROM subjects s
+            LEFT JOIN subject_rubrics sr ON sr.subject_id = s.id
+            WHERE s.deleted_at IS NULL
+              AND (s.semester = %s OR s.id = ANY(%s) OR (%s AND sr.template_id = %s))
+            ORDER BY s.id
+            FOR UPDATE OF s
+        """, (template_id, version, template_id, overwrite, overwrite,
+              semester, subject_ids, propagate, template_id))
+        
+        result = {'version': version, 'applied': [], 'locked': [], 'up_to_date': [], 'custom': [],
+                  'other_template': []}
+        for subject_id, status in cursor.fetchall():
+            result[status].append(subject_id)
+        targets = result['applied']
+        if not targets:
+            return result
+        
+        cursor.execute("DELETE FROM grade_components WHERE subject_id = ANY(%s)", (targets,))
+        cursor.execute("""
+            INSERT INTO grade_components
+            (subject_id, component_type, component_name, max_score, weight_percentage, display_order)
+            SELECT t.subject_id, i.component_type, i.component_name, i.max_score, i.weight_percentage, i.display_order
+            FROM unnest(%s::int[]) AS t(subject_id)
+            CROSS JOIN rubric_template_items i
+            WHERE i.template_id = %s
+            ORDER BY t.subject_id, i.display_order, i.id
+        """, (targets, template_id))
+        cursor.execute("""
+            INSERT INTO subject_rubrics (subject_id, template_id, template_version)
+            SELECT unnest(%s::int[]), %s, %s
+            ON CONFLICT (subject_id) DO UPDATE
+            SET template_id = EXCLUDED.template_id,
+                template_version = EXCLUDED.template_version,
+                applied_at = CURRENT_TIMESTAMP
+        """, (targets, template_id, version))
+        return result
+    
+    return run_transaction(work, commit=not dry_run)
+
+
+def get_subject_rubric_template(subject_id):
+    """The template a subject's rubric follows, with the version applied (None if hand-built)"""
+    query = """
+        SELECT rt.id, rt.name, rt.version, sr.template_version, sr.applied_at
+        FROM subject_rubrics sr
+        JOIN rubric_templates rt ON rt.id = sr.template_id
+        WHERE sr.subject_id = %s
+    """
+    return execute_query(query, (subject_id,), fetch_one=True)
 
 
 # =============================================
@@ -1190,15 +1664,53 @@ def create_weekly_topic(class_id, subject_id, teacher_id, week_number, topic, de
     return execute_insert_returning(query, (class_id, subject_id, teacher_id, week_number, topic, description, date_covered))
 
 
+def create_weekly_topics_bulk(teacher_id, pairs, weeks):
+    """
+    Publish a multi-week topic plan to many (subject_id, class_id) pairs in
+    one statement; weeks that already have a topic are overwritten.
+    
+    Args:
+        weeks: Dicts with week_number, topic, description and date_covered
+    
+    Returns:
+        List of {id, subject_id, class_id, week_number}, or None on error
+    """
+    pairs = list(dict.fromkeys(pairs))
+    
+    def work(cursor):
+        cursor.execute("""
+            INSERT INTO weekly_topics (class_id, subject_id, teacher_id, week_number, topic, description, date_covered)
+            SELECT p.class_id, p.subject_id, %s, w.week_number, w.topic,
+                   NULLIF(w.description, ''), NULLIF(w.date_covered, '')::date
+            FROM unnest(%s::int[], %s::int[]) AS p(subject_id, class_id)
+            CROSS JOIN unnest(%s::int[], %s::text[], %s::text[], %s::text[])
+                 AS w(week_number, topic, description, date_covered)
+            ON CONFLICT (class_id, subject_id, week_number)
+            DO UPDATE SET topic = EXCLUDED.topic, description = EXCLUDED.description, date_covered = EXCLUDED.date_covered
+            RETURNING id, subject_id, class_id, week_number
+        """, (
+            teacher_id,
+            [p[0] for p in pairs], [p[1] for p in pairs],
+            [w['week_number'] for w in weeks],
+            [w['topic'] for w in weeks],
+            [w.get('description') or '' for w in weeks],
+            [w.get('date_covered') or '' for w in weeks],
+        ))
+        return rows_to_dicts(cursor)
+    
+    return run_transaction(work)
+
+
 def get_weekly_topics_by_class(class_id):
     """Get all weekly topics for a class"""
     query = """
         SELECT wt.*, s.name as subject_name, u.full_name as teacher_name
         FROM weekly_topics wt
         JOIN subjects s ON wt.subject_id = s.id
+        JOIN classes c ON wt.class_id = c.id
         LEFT JOIN teachers t ON wt.teacher_id = t.id
         LEFT JOIN users u ON t.user_id = u.id
-        WHERE wt.class_id = %s
+        WHERE wt.class_id = %s AND s.deleted_at IS NULL AND c.deleted_at IS NULL
         ORDER BY s.name, wt.week_number
     """
     return execute_query(query, (class_id,), fetch_all=True)
@@ -1306,13 +1818,14 @@ def get_lecture_files_by_subject(subject_id):
 
 
 def get_lecture_files_by_teacher(teacher_id):
-    """Get all lecture files uploaded by a teacher"""
+    """Get all lecture files uploaded by a teacher, with how many students opened each"""
     query = """
-        SELECT lf.*, s.name as subject_name, c.name as class_name
+        SELECT lf.*, s.name as subject_name, c.name as class_name,
+               (SELECT COUNT(DISTINCT a.user_id) FROM lecture_file_access a WHERE a.file_id = lf.id) as opened_by
         FROM lecture_files lf
         JOIN subjects s ON lf.subject_id = s.id
         LEFT JOIN classes c ON lf.class_id = c.id
-        WHERE lf.teacher_id = %s
+        WHERE lf.teacher_id = %s AND s.deleted_at IS NULL AND c.deleted_at IS NULL
         ORDER BY lf.uploaded_at DESC
     """
     return execute_query(query, (teacher_id,), fetch_all=True)
@@ -1324,9 +1837,10 @@ def get_lecture_files_by_class(class_id):
         SELECT lf.*, s.name as subject_name, u.full_name as teacher_name
         FROM lecture_files lf
         JOIN subjects s ON lf.subject_id = s.id
+        JOIN classes c ON lf.class_id = c.id
         JOIN teachers t ON lf.teacher_id = t.id
         JOIN users u ON t.user_id = u.id
-        WHERE lf.class_id = %s
+        WHERE lf.class_id = %s AND s.deleted_at IS NULL AND c.deleted_at IS NULL
         ORDER BY s.name, lf.week_number NULLS LAST, lf.uploaded_at DESC
     """
     return execute_query(query, (class_id,), fetch_all=True)
@@ -1335,20 +1849,321 @@ def get_lecture_files_by_class(class_id):
 def get_lecture_file_by_id(file_id):
     """Get a specific lecture file"""
     query = """
-        SELECT lf.*, s.name as subject_name, u.full_name as teacher_name
+        SELECT lf.*, s.name as subject_name, u.full_name as teacher_name,
+               COALESCE(fb.compressed, false) as blob_compressed
         FROM lecture_files lf
         JOIN subjects s ON lf.subject_id = s.id
         JOIN teachers t ON lf.teacher_id = t.id
         JOIN users u ON t.user_id = u.id
+        LEFT JOIN file_blobs fb ON fb.sha256 = lf.blob_hash
         WHERE lf.id = %s
     """
     return execute_query(query, (file_id,), fetch_one=True)
 
 
-def delete_lecture_file(file_id):
-    """Delete a lecture file"""
-    query = "DELETE FROM lecture_files WHERE id = %s"
-    return execute_query(query, (file_id,))
+def get_lecture_file_for_user(file_id, user_id, role):
+    """Get the fields needed to deliver a lecture file plus whether this user may
+    read it, in one query. Students only see files for their own class."""
+    query = """
+        SELECT lf.id, lf.file_name, lf.file_path, lf.file_size, lf.file_type, lf.class_id, lf.blob_hash,
+               COALESCE(fb.compressed, false) as blob_compressed,
+               (%s <> 'student' OR EXISTS (
+                    SELECT 1 FROM students st
+                    WHERE st.user_id = %s AND st.class_id = lf.class_id AND st.deleted_at IS NULL
+               )) as allowed
+        FROM lecture_files lf
+        LEFT JOIN file_blobs fb ON fb.sha256 = lf.blob_hash
+        WHERE lf.id = %s
+    """
+    return execute_query(query, (role, user_id, file_id), fetch_one=True)
+
+
+def create_lecture_files_for_blob(blob_hash, size, store, teacher_id, assignments, title, description, file_name, file_type, week_number=None):
+    """
+    Register one blob and attach it to several subject/class assignments.
+    
+    The file_blobs reference is taken before anything is stored. The upsert
+    locks the row, so a concurrent delete cannot remove the stored copy, and
+    the stored copy is only reused when the row survived; otherwise (no row,
+    or one deleted by a delete we waited on) store writes it again.
+    
+    Args:
+        blob_hash: SHA-256 of the content
+        size: Size in bytes
+        store: Called with the stored compressed flag (None when the content
+               must be stored) and returning the dict from storage.store_file
+        assignments: List of (subject_id, class_id) pairs
+    
+    Returns:
+        Dict with 'blob' (from store) and 'file_ids' (new lecture_files IDs),
+        or None on error
+    """
+    if not assignments:
+        return {'blob': None, 'file_ids': []}
+    
+    def work(cursor):
+        cursor.execute("""
+            INSERT INTO file_blobs (sha256, size, compressed, ref_count)
+            VALUES (%s, %s, false, %s)
+            ON CONFLICT (sha256) DO UPDATE SET ref_count = file_blobs.ref_count + EXCLUDED.ref_count
+            RETURNING compressed, xmax = 0 AS inserted
+        """, (blob_hash, size, len(assignments)))
+        compressed, inserted = cursor.fetchone()
+        
+        blob = store(None if inserted else compressed)
+        if inserted and blob['compressed']:
+            cursor.execute("UPDATE file_blobs SET compressed = true WHERE sha256 = %s", (blob_hash,))
+        
+        cursor.execute("""
+            INSERT INTO lecture_files (subject_id, teacher_id, class_id, title, description, file_name,
+                                       file_path, file_size, file_type, week_number, blob_hash)
+            SELECT a.subject_id, %s, a.class_id, %s, %s, %s, %s, %s, %s, %s, %s
+            FROM unnest(%s::int[], %s::int[]) AS a(subject_id, class_id)
+            RETURNING id
+        """, (teacher_id, title, description, file_name, blob['key'], blob['size'], file_type,
+              week_number, blob_hash,
+              [a[0] for a in assignments], [a[1] for a in assignments]))
+        return {'blob': blob, 'file_ids': [row[0] for row in cursor.fetchall()]}
+    
+    return run_transaction(work)
+
+
+def get_lecture_files_for_archive(subject_id, user_id, role, week_number=None):
+    """Get the lecture files of a subject (optionally one week) that this user may
+    download, in one query. Students get their class's files, teachers their own
+    uploads and admins everything."""
+    query = """
+        SELECT lf.id, lf.file_name, lf.file_path, lf.week_number, lf.uploaded_at,
+               s.name as subject_name, COALESCE(fb.compressed, false) as blob_compressed
+        FROM lecture_files lf
+        JOIN subjects s ON lf.subject_id = s.id
+        LEFT JOIN file_blobs fb ON fb.sha256 = lf.blob_hash
+        WHERE lf.subject_id = %s
+          AND (CAST(%s AS INTEGER) IS NULL OR lf.week_number = %s)
+          AND (
+              %s = 'admin'
+              OR (%s = 'student' AND lf.class_id = (SELECT class_id FROM students WHERE user_id = %s AND deleted_at IS NULL))
+              OR (%s = 'teacher' AND lf.teacher_id = (SELECT id FROM teachers WHERE user_id = %s))
+          )
+        ORDER BY lf.week_number NULLS LAST, lf.uploaded_at
+    """
+    return execute_query(query, (subject_id, week_number, week_number, role, role, user_id, role, user_id), fetch_all=True)
+
+
+def delete_lecture_file(file_id, remove):
+    """
+    Delete a lecture file row and release its blob reference.
+    
+    When the last reference goes, remove(file_path) deletes the stored copy
+    before the transaction commits. The deleted file_blobs row stays locked
+    until then, so an upload of the same content waits and stores it anew
+    instead of reusing a copy that is about to disappear.
+    
+    Returns:
+        Dict with 'removed' (whether the stored copy was deleted), or None if
+        nothing was deleted or on error (then nothing changed)
+    """
+    def work(cursor):
+        cursor.execute("DELETE FROM lecture_files WHERE id = %s RETURNING file_path, blob_hash", (file_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        file_path, blob_hash = row
+        if blob_hash:
+            cursor.execute("""
+                UPDATE file_blobs SET ref_count = ref_count - 1
+                WHERE sha256 = %s
+                RETURNING ref_count
+            """, (blob_hash,))
+            if cursor.fetchone()[0] > 0:
+                return {'removed': False}
+            cursor.execute("DELETE FROM file_blobs WHERE sha256 = %s", (blob_hash,))
+        # Rows from before the blob store owned their own copy
+        remove(file_path)
+        return {'removed': True}
+    
+    return run_transaction(work)
+
+
+def get_lecture_file_paths():
+    """Get id and stored path of every lecture file (for the storage tools).
+    Unlike execute_query this returns None on error, never a misleading []."""
+    def work(cursor):
+        cursor.execute("SELECT id, file_path FROM lecture_files ORDER BY id")
+        return rows_to_dicts(cursor)
+    
+    return run_transaction(work, commit=False)
+
+
+def get_referenced_file_paths(paths):
+    """Return which of the given paths some lecture file currently uses, or None on error"""
+    def work(cursor):
+        cursor.execute("SELECT DISTINCT file_path FROM lecture_files WHERE file_path = ANY(%s)", (list(paths),))
+        return {row[0] for row in cursor.fetchall()}
+    
+    return run_transaction(work, commit=False)
+
+
+def update_lecture_file_paths(old_paths, new_paths):
+    """Point lecture files at new storage keys (old_paths[i] -> new_paths[i]).
+    Returns the number of rows updated, or None on error."""
+    def work(cursor):
+        cursor.execute("""
+            UPDATE lecture_files lf SET file_path = m.new_path
+            FROM unnest(%s::text[], %s::text[]) AS m(old_path, new_path)
+            WHERE lf.file_path = m.old_path
+        """, (list(old_paths), list(new_paths)))
+        return cursor.rowcount
+    
+    return run_transaction(work)
+
+
+def reconcile_file_blobs(dry_run=True):
+    """
+    Bring file_blobs.ref_count back in line with the lecture_files rows that use
+    each blob and drop blobs nothing uses any more. Cascading deletes (e.g. of a
+    subject) remove lecture_files rows without releasing their blobs.
+    
+    Returns:
+        Dict with 'recounted' (number of blobs whose count was off) and
+        'released' (list of {sha256, compressed} no longer referenced),
+        or None on error
+    """
+    def work(cursor):
+        cursor.execute("""
+            WITH actual AS (
+                SELECT fb.sha256, COUNT(lf.id) as refs
+                FROM file_blobs fb
+                LEFT JOIN lecture_files lf ON lf.blob_hash = fb.sha256
+                GROUP BY fb.sha256
+            ), recounted AS (
+                UPDATE file_blobs fb SET ref_count = a.refs
+                FROM actual a
+                WHERE fb.sha256 = a.sha256 AND fb.ref_count <> a.refs AND a.refs > 0
+                RETURNING fb.sha256
+            ), released AS (
+                DELETE FROM file_blobs fb
+                USING actual a
+                WHERE fb.sha256 = a.sha256 AND a.refs = 0
+                RETURNING fb.sha256, fb.compressed
+            )
+            SELECT (SELECT COUNT(*) FROM recounted),
+                   COALESCE((SELECT json_agg(json_build_object('sha256', sha256, 'compressed', compressed))
+                             FROM released), '[]'::json)
+        """)
+        recounted, released = cursor.fetchone()
+        return {'recounted': recounted, 'released': released}
+    
+    return run_transaction(work, commit=not dry_run)
+
+
+def claim_blob_extraction(sha256, max_attempts):
+    """
+    Claim a blob for text extraction. Only one caller gets True per blob; a
+    claim older than an hour without text (a crashed worker or a failed
+    attempt) can be taken again, until max_attempts attempts have failed.
+    """
+    query = """
+        UPDATE file_blobs SET extracted_at = CURRENT_TIMESTAMP
+        WHERE sha256 = %s AND content_text IS NULL AND extract_attempts < %s
+          AND (extracted_at IS NULL OR extracted_at < CURRENT_TIMESTAMP - INTERVAL '1 hour')
+        RETURNING sha256
+    """
+    return execute_query(query, (sha256, max_attempts), fetch_one=True) is not None
+
+
+def record_extraction_failure(sha256):
+    """Count a failed extraction; the text stays NULL so the blob is tried again later"""
+    query = "UPDATE file_blobs SET extract_attempts = extract_attempts + 1 WHERE sha256 = %s"
+    return execute_query(query, (sha256,))
+
+
+def save_blob_content(sha256, text):
+    """Store the extracted text of a blob"""
+    query = "UPDATE file_blobs SET content_text = %s, extracted_at = CURRENT_TIMESTAMP WHERE sha256 = %s"
+    return execute_query(query, (text, sha256))
+
+
+def get_blobs_pending_extraction(file_types, max_attempts, limit=500):
+    """Get blobs whose text has not been extracted yet (and that have not failed
+    max_attempts times), with a key and type to read them by"""
+    query = """
+        SELECT fb.sha256, fb.compressed, MIN(lf.file_path) as file_path, MIN(lf.file_type) as file_type
+        FROM file_blobs fb
+        JOIN lecture_files lf ON lf.blob_hash = fb.sha256
+        WHERE fb.content_text IS NULL AND fb.extract_attempts < %s
+          AND (fb.extracted_at IS NULL OR fb.extracted_at < CURRENT_TIMESTAMP - INTERVAL '1 hour')
+          AND lf.file_type = ANY(%s)
+        GROUP BY fb.sha256, fb.compressed
+        LIMIT %s
+    """
+    return execute_query(query, (max_attempts, list(file_types), limit), fetch_all=True)
+
+
+def record_file_access(rows):
+    """
+    Add a batch of buffered access counts to lecture_file_access.
+    
+    Args:
+        rows: List of (file_id, user_id, access_date, hits, first_at, last_at)
+    
+    Returns:
+        Number of rows written, or None on error
+    """
+    # Same key order in every process, so concurrent flushes cannot deadlock
+    rows = sorted(rows, key=lambda r: r[:3])
+    columns = list(zip(*rows))
+    
+    def work(cursor):
+        cursor.execute("""
+            INSERT INTO lecture_file_access AS a (file_id, user_id, access_date, hits, first_at, last_at)
+            SELECT b.file_id, b.user_id, b.access_date, b.hits, b.first_at, b.last_at
+            FROM unnest(%s::int[], %s::int[], %s::date[], %s::int[], %s::timestamp[], %s::timestamp[])
+                 AS b(file_id, user_id, access_date, hits, first_at, last_at)
+            WHERE EXISTS (SELECT 1 FROM lecture_files lf WHERE lf.id = b.file_id)
+              AND EXISTS (SELECT 1 FROM users u WHERE u.id = b.user_id)
+            ON CONFLICT (file_id, user_id, access_date) DO UPDATE
+            SET hits = a.hits + EXCLUDED.hits,
+                first_at = LEAST(a.first_at, EXCLUDED.first_at),
+                last_at = GREATEST(a.last_at, EXCLUDED.last_at)
+        """, tuple(list(c) for c in columns))
+        return cursor.rowcount
+    
+    return run_transaction(work)
+
+
+def get_file_access_report(file_id):
+    """
+    Who in the file's class has opened it, plus opens per day.
+    
+    Returns:
+        Dict with 'students' (every student of the class with hits, days,
+        first_opened and last_opened; zero/None if never) and 'daily'
+        (access_date, students, hits for the last 30 active days)
+    """
+    students = execute_query("""
+        SELECT st.id, st.student_number, u.full_name,
+               COALESCE(SUM(a.hits), 0) as hits, COUNT(a.access_date) as days,
+               MIN(a.first_at) as first_opened, MAX(a.last_at) as last_opened
+        FROM lecture_files lf
+        JOIN students st ON st.class_id = lf.class_id AND st.graduated_at IS NULL AND st.deleted_at IS NULL
+        JOIN users u ON u.id = st.user_id
+        LEFT JOIN lecture_file_access a ON a.file_id = lf.id AND a.user_id = st.user_id
+        WHERE lf.id = %s
+        GROUP BY st.id, st.student_number, u.full_name
+        ORDER BY MAX(a.last_at) DESC NULLS LAST, u.full_name
+    """, (file_id,), fetch_all=True)
+    
+    daily = execute_query("""
+        SELECT access_date, COUNT(*) as students, SUM(hits) as hits
+        FROM lecture_file_access
+        WHERE file_id = %s
+        GROUP BY access_date
+        ORDER BY access_date DESC
+        LIMIT 30
+    """, (file_id,), fetch_all=True)
+    
+    return {'students': students or [], 'daily': daily or []}
 
 
 # =============================================
@@ -1426,13 +2241,184 @@ def assign_teacher_to_subject(teacher_id, subject_id, class_id):
     return execute_insert_returning(query, (teacher_id, subject_id, class_id, class_info['shift']))
 
 
-def remove_teacher_assignment(assignment_id):
-    """Remove a teacher assignment"""
-    query = "DELETE FROM teacher_assignments WHERE id = %s"
-    return execute_query(query, (assignment_id,))
-
-
-def get_teachers_for_subject(subject_id, class_id=None):
+def _apply_assignment_cells(cursor, cells):
+    """
+    Set the teacher of many (subject, class) cells with set-based statements.
+    
+    cells maps (subject_id, class_id) to a teacher_id, or None to clear the
+    cell. A cell that already has an assignment has its teacher replaced
+    (the row already held by that teacher is preferred, so nothing
+    duplicates); other cells get a new assignment.
+    """
+    cleared = [key for key, teacher_id in cells.items() if teacher_id is None]
+    assigned = [(key, teacher_id) for key, teacher_id in cells.items() if teacher_id is not None]
+    
+    if cleared:
+        cursor.execute("""
+            DELETE FROM teacher_assignments ta
+            USING unnest(%s::int[], %s::int[]) AS cell(subject_id, class_id)
+            WHERE ta.subject_id = cell.subject_id AND ta.class_id = cell.class_id
+        """, ([k[0] for k in cleared], [k[1] for k in cleared]))
+    
+    if assigned:
+        cursor.execute("""
+            WITH cell AS (
+                SELECT * FROM unnest(%s::int[], %s::int[], %s::int[]) AS c(subject_id, class_id, teacher_id)
+            ), pick AS (
+                SELECT DISTINCT ON (ta.subject_id, ta.class_id) ta.id, cell.teacher_id
+                FROM teacher_assignments ta
+                JOIN cell ON ta.subject_id = cell.subject_id AND ta.class_id = cell.class_id
+                ORDER BY ta.subject_id, ta.class_id, (ta.teacher_id = cell.teacher_id) DESC, ta.id
+            ), updated AS (
+                UPDATE teacher_assignments ta SET teacher_id = pick.teacher_id
+                FROM pick WHERE ta.id = pick.id
+                RETURNING ta.subject_id, ta.class_id
+            )
+            INSERT INTO teacher_assignments (teacher_id, subject_id, class_id, shift)
+            SELECT cell.teacher_id, cell.subject_id, cell.class_id, c.shift
+            FROM cell
+            JOIN classes c ON c.id = cell.class_id
+            WHERE NOT EXISTS (SELECT 1 FROM updated u
+                              WHERE u.subject_id = cell.subject_id AND u.class_id = cell.class_id)
+            ON CONFLICT DO NOTHING
+        """, ([k[0] for k, _ in assigned], [k[1] for k, _ in assigned], [t for _, t in assigned]))
+    
+    return len(cells)
+
+
+def assign_subject_to_classes(teacher_id, subject_name, class_ids):
+    """
+    Assign a teacher to a subject for several classes in one transaction,
+    creating the subject if needed.
+    
+    The subject's semester is taken from an existing subject of that name,
+    else from the classes; all classes must be of that one semester.
+    
+    Returns:
+        Dict with 'semester' and 'assigned', or with 'error' (nothing changed);
+        None on database error
+    """
+    class_ids = [int(c) for c in class_ids]
+    
+    def work(cursor):
+        cursor.execute("""
+            SELECT semester FROM subjects
+            WHERE LOWER(name) = LOWER(%s) AND semester IS NOT NULL AND deleted_at IS NULL
+            LIMIT 1
+        """, (subject_name,))
+        row = cursor.fetchone()
+        subject_semester = row[0] if row else None
+        
+        cursor.execute(
+            "SELECT id, semester FROM classes WHERE id = ANY(%s) AND deleted_at IS NULL",
+            (class_ids,)
+        )
+        rows = cursor.fetchall()
+        found_ids = [r[0] for r in rows]
+        class_semesters = {r[1] for r in rows}
+        
+        if subject_semester and class_semesters - {subject_semester}:
+            return {'error': f'"{subject_name}" belongs to Semester {subject_semester}. '
+                             f'You can only assign it to Semester {subject_semester} classes!'}
+        if len(class_semesters) != 1:
+            return {'error': 'Select classes from only ONE semester!'}
+        semester = subject_semester or class_semesters.pop()
+        
+        cursor.execute("""
+            SELECT id FROM subjects
+            WHERE LOWER(name) = LOWER(%s) AND semester = %s AND deleted_at IS NULL
+            LIMIT 1
+        """, (subject_name, semester))
+        row = cursor.fetchone()
+        if row:
+            subject_id = row[0]
+        else:
+            cursor.execute(
+                "INSERT INTO subjects (name, semester) VALUES (%s, %s) RETURNING id",
+                (subject_name, semester)
+            )
+            subject_id = cursor.fetchone()[0]
+        
+        assigned = _apply_assignment_cells(cursor, {(subject_id, c): teacher_id for c in found_ids})
+        return {'semester': semester, 'assigned': assigned}
+    
+    return run_transaction(work)
+
+
+def set_teacher_assignments(cells):
+    """
+    Save a teachers x subjects x classes matrix in one transaction.
+    
+    Args:
+        cells: {(subject_id, class_id): teacher_id or None to clear}
+    
+    Returns:
+        Dict with 'assigned' (cells saved), or with 'errors' (nothing
+        changed); None on database error
+    """
+    keys = list(cells)
+    
+    def work(cursor):
+        cursor.execute("""
+            SELECT cell.subject_id, cell.class_id, s.id IS NULL, c.id IS NULL,
+                   s.semester, c.semester, cell.teacher_id IS NOT NULL AND t.id IS NULL
+            FROM unnest(%s::int[], %s::int[], %s::int[]) AS cell(subject_id, class_id, teacher_id)
+            LEFT JOIN subjects s ON s.id = cell.subject_id AND s.deleted_at IS NULL
+            LEFT JOIN classes c ON c.id = cell.class_id AND c.deleted_at IS NULL
+            LEFT JOIN teachers t ON t.id = cell.teacher_id
+            WHERE s.id IS NULL OR c.id IS NULL OR s.semester <> c.semester
+               OR (cell.teacher_id IS NOT NULL AND t.id IS NULL)
+        """, ([k[0] for k in keys], [k[1] for k in keys], [cells[k] for k in keys]))
+        
+        errors = []
+        for subject_id, class_id, no_subject, no_class, subject_sem, class_sem, no_teacher in cursor.fetchall():
+            if no_subject:
+                errors.append(f'Subject {subject_id} not found')
+            elif no_class:
+                errors.append(f'Class {class_id} not found')
+            elif no_teacher:
+                errors.append(f'Teacher {cells[(subject_id, class_id)]} not found')
+            else:
+                errors.append(f'Subject {subject_id} is Semester {subject_sem} but class {class_id} is Semester {class_sem}')
+        if errors:
+            return {'errors': errors}
+        
+        return {'assigned': _apply_assignment_cells(cursor, cells)}
+    
+    return run_transaction(work)
+
+
+def get_assignment_matrix(semester):
+    """Subjects, classes and current teacher assignments of a semester (for the matrix editor)"""
+    subjects = execute_query(
+        "SELECT id, name FROM subjects WHERE semester = %s AND deleted_at IS NULL ORDER BY name",
+        (semester,), fetch_all=True
+    ) or []
+    classes = execute_query("""
+        SELECT id, name, shift, section FROM classes
+        WHERE semester = %s AND is_active = true AND deleted_at IS NULL
+        ORDER BY shift, section
+    """, (semester,), fetch_all=True) or []
+    assignments = execute_query("""
+        SELECT ta.id, ta.subject_id, ta.class_id, ta.teacher_id, u.full_name AS teacher_name
+        FROM teacher_assignments ta
+        JOIN subjects s ON s.id = ta.subject_id
+        JOIN classes c ON c.id = ta.class_id
+        JOIN teachers t ON t.id = ta.teacher_id
+        JOIN users u ON u.id = t.user_id
+        WHERE s.semester = %s AND s.deleted_at IS NULL AND c.deleted_at IS NULL
+        ORDER BY ta.subject_id, ta.class_id, ta.id
+    """, (semester,), fetch_all=True) or []
+    return {'subjects': subjects, 'classes': classes, 'assignments': assignments}
+
+
+def remove_teacher_assignment(assignment_id):
+    """Remove a teacher assignment"""
+    query = "DELETE FROM teacher_assignments WHERE id = %s"
+    return execute_query(query, (assignment_id,))
+
+
+def get_teachers_for_subject(subject_id, class_id=None):
     """Get all teachers assigned to a subject"""
     query = """
         SELECT ta.*, t.id as teacher_id, u.full_name as teacher_name,
@@ -1489,7 +2475,7 @@ def get_students_by_year_shift(year, shift, section=None):
         SELECT s.*, u.full_name, u.username, u.email
         FROM students s
         JOIN users u ON s.user_id = u.id
-        WHERE s.year = %s AND s.shift = %s
+        WHERE s.year = %s AND s.shift = %s AND s.deleted_at IS NULL AND s.graduated_at IS NULL
     """
     params = [year, shift]
     if section:
@@ -1505,7 +2491,7 @@ def get_students_without_section(year=None, shift=None):
         SELECT s.*, u.full_name, u.username, u.email
         FROM students s
         JOIN users u ON s.user_id = u.id
-        WHERE s.section IS NULL
+        WHERE s.section IS NULL AND s.graduated_at IS NULL AND s.deleted_at IS NULL
     """
     params = []
     if year:
@@ -1524,6 +2510,65 @@ def assign_student_section(student_id, section):
     return execute_query(query, (section, student_id))
 
 
+def get_section_allocation(semester, shift):
+    """
+    Students of a semester/shift without a section, plus current section sizes.
+    
+    Returns:
+        Dict with 'students' (id, full_name, student_number) and 'counts'
+        ({section: students already in it} for every active class section)
+    """
+    students = execute_query("""
+        SELECT s.id, u.full_name, s.student_number
+        FROM students s
+        JOIN users u ON s.user_id = u.id
+        WHERE s.semester = %s AND s.shift = %s AND s.section IS NULL AND s.graduated_at IS NULL AND s.deleted_at IS NULL
+        ORDER BY u.full_name, s.id
+    """, (semester, shift), fetch_all=True) or []
+    
+    rows = execute_query("""
+        SELECT c.section, COUNT(s.id) AS count
+        FROM classes c
+        LEFT JOIN students s ON s.semester = c.semester AND s.shift = c.shift AND s.section = c.section
+                              AND s.graduated_at IS NULL AND s.deleted_at IS NULL
+        WHERE c.semester = %s AND c.shift = %s AND c.is_active = true
+        GROUP BY c.section
+        ORDER BY c.section
+    """, (semester, shift), fetch_all=True) or []
+    
+    return {'students': students, 'counts': {r['section']: r['count'] for r in rows}}
+
+
+def apply_section_allocation(semester, shift, student_ids, sections):
+    """
+    Set section and class_id for many students in one UPDATE.
+    
+    Students that got a section in the meantime, and sections without an
+    active class for the semester/shift, are left alone.
+    
+    Returns:
+        Number of students updated, or None on error
+    """
+    def work(cursor):
+        cursor.execute("""
+            UPDATE students s
+            SET section = a.section,
+                class_id = (SELECT c.id FROM classes c
+                            WHERE c.semester = s.semester AND c.shift = s.shift
+                              AND c.section = a.section AND c.is_active = true
+                            LIMIT 1)
+            FROM unnest(%s::int[], %s::varchar[]) AS a(id, section)
+            WHERE s.id = a.id AND s.section IS NULL AND s.semester = %s AND s.shift = %s
+              AND s.graduated_at IS NULL AND s.deleted_at IS NULL
+              AND EXISTS (SELECT 1 FROM classes c
+                          WHERE c.semester = s.semester AND c.shift = s.shift
+                            AND c.section = a.section AND c.is_active = true)
+        """, (list(student_ids), list(sections), semester, shift))
+        return cursor.rowcount
+    
+    return run_transaction(work)
+
+
 def update_student_v2(student_id, full_name, email, year, semester, shift, section, student_number, phone):
     """Update student with new year/semester/shift/section structure"""
     # Update student record
@@ -1549,6 +2594,7 @@ def get_all_students_v2():
         SELECT s.*, u.full_name, u.username, u.email
         FROM students s
         JOIN users u ON s.user_id = u.id
+        WHERE s.deleted_at IS NULL AND s.graduated_at IS NULL
         ORDER BY s.year, s.shift, s.section, u.full_name
     """
     return execute_query(query, fetch_all=True)
@@ -1560,7 +2606,7 @@ def get_student_by_id_v2(student_id):
         SELECT s.*, u.full_name, u.username, u.email
         FROM students s
         JOIN users u ON s.user_id = u.id
-        WHERE s.id = %s
+        WHERE s.id = %s AND s.deleted_at IS NULL
     """
     return execute_query(query, (student_id,), fetch_one=True)
 
@@ -1575,7 +2621,8 @@ def get_teacher_sections(teacher_id, year, semester, shift):
     query = """
         SELECT DISTINCT s.section
         FROM students s
-        WHERE s.year = %s AND s.shift = %s AND s.section IS NOT NULL
+        WHERE s.year = %s AND s.shift = %s AND s.section IS NOT NULL AND s.deleted_at IS NULL
+          AND s.graduated_at IS NULL
         ORDER BY s.section
     """
     # For year 1, semester is 1 or 2; for year 2, semester is 3 or 4
@@ -1587,7 +2634,8 @@ def get_teacher_current_context(teacher_id):
     query = """
         SELECT ta.shift, ss.year, ss.semester, ss.id as subject_id, ss.name as subject_name,
                (SELECT COUNT(DISTINCT s.section) FROM students s 
-                WHERE s.year = ss.year AND s.shift = ta.shift AND s.section IS NOT NULL) as section_count
+                WHERE s.year = ss.year AND s.shift = ta.shift AND s.section IS NOT NULL
+                  AND s.deleted_at IS NULL AND s.graduated_at IS NULL) as section_count
         FROM teacher_assignments ta
         JOIN semester_subjects ss ON ta.subject_id = ss.id
         WHERE ta.teacher_id = %s
@@ -1624,11 +2672,63 @@ def get_class_schedule_data(semester, shift, section):
     return data
 
 
+SCHEDULE_DAY_NAMES = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday']
+
+
+def _schedule_entries(row):
+    """Flatten one class_schedules row into lecture entries (breaks skipped)"""
+    import json
+    data = row['schedule_data']
+    if isinstance(data, str):
+        data = json.loads(data)
+    if not data:
+        return []
+    
+    entries = []
+    for entry in data:
+        if entry.get('isBreak'):
+            continue
+        col = entry.get('col', 0)
+        day = SCHEDULE_DAY_NAMES[col] if col < len(SCHEDULE_DAY_NAMES) else f'Day {col}'
+        
+        # Determine time based on lecture type
+        lecture_type = entry.get('lectureType', 'theory')
+        if lecture_type == 'practical':
+            start_time = entry.get('practicalStartTime') or entry.get('startTime', '')
+            end_time = entry.get('practicalEndTime') or entry.get('endTime', '')
+        else:
+            start_time = entry.get('theoryStartTime') or entry.get('startTime', '')
+            end_time = entry.get('theoryEndTime') or entry.get('endTime', '')
+        
+        entries.append({
+            'day_of_week': day,
+            'col': col,
+            'row': entry.get('row', 0),
+            'start_time': start_time,
+            'end_time': end_time,
+            'subject_name': entry.get('subject', ''),
+            'lecture_type': lecture_type,
+            'teacher': entry.get('teacher') or '',
+            'practical_teacher': entry.get('practicalTeacher') or '',
+            'room': entry.get('room', ''),
+            'semester': row['semester'],
+            'shift': row['shift'],
+            'section': row['section'],
+            'class_label': f"Sem {row['semester']} - {row['shift'].title()} - Class {row['section']}"
+        })
+    return entries
+
+
+def _sort_schedule_entries(entries):
+    """Sort entries by day order, then start_time"""
+    day_order = {d: i for i, d in enumerate(SCHEDULE_DAY_NAMES)}
+    entries.sort(key=lambda x: (day_order.get(x['day_of_week'], 99), x['start_time']))
+    return entries
+
+
 def get_teacher_schedule_from_builder(teacher_name):
     """Get a teacher's schedule entries from the class_schedules builder data.
     Searches all saved schedules for entries matching this teacher name."""
-    import json
-    
     query = """
         SELECT semester, shift, section, schedule_data 
         FROM class_schedules 
@@ -1638,56 +2738,60 @@ def get_teacher_schedule_from_builder(teacher_name):
     if not rows:
         return []
     
-    day_names = ['Sunday', 'Monday', 'Tuesday', 'Wednesday', 'Thursday']
-    teacher_entries = []
     teacher_lower = teacher_name.lower().strip()
-    
+    teacher_entries = []
     for row in rows:
-        data = row['schedule_data']
-        if isinstance(data, str):
-            data = json.loads(data)
-        if not data:
-            continue
-            
-        for entry in data:
-            if entry.get('isBreak'):
-                continue
+        for entry in _schedule_entries(row):
             # Check if teacher matches in theory or practical teacher fields
-            entry_teacher = (entry.get('teacher') or '').lower().strip()
-            practical_teacher = (entry.get('practicalTeacher') or '').lower().strip()
-            
-            if teacher_lower in (entry_teacher, practical_teacher) or \
-               entry_teacher == teacher_lower or practical_teacher == teacher_lower:
-                col = entry.get('col', 0)
-                day = day_names[col] if col < len(day_names) else f'Day {col}'
-                
-                # Determine time based on lecture type
-                lecture_type = entry.get('lectureType', 'theory')
-                if lecture_type == 'practical':
-                    start_time = entry.get('practicalStartTime') or entry.get('startTime', '')
-                    end_time = entry.get('practicalEndTime') or entry.get('endTime', '')
-                else:
-                    start_time = entry.get('theoryStartTime') or entry.get('startTime', '')
-                    end_time = entry.get('theoryEndTime') or entry.get('endTime', '')
-                
-                teacher_entries.append({
-                    'day_of_week': day,
-                    'start_time': start_time,
-                    'end_time': end_time,
-                    'subject_name': entry.get('subject', ''),
-                    'lecture_type': lecture_type,
-                    'room': entry.get('room', ''),
-                    'semester': row['semester'],
-                    'shift': row['shift'],
-                    'section': row['section'],
-                    'class_label': f"Sem {row['semester']} - {row['shift'].title()} - Class {row['section']}"
-                })
-    
-    # Sort by day order, then start_time
-    day_order = {d: i for i, d in enumerate(day_names)}
-    teacher_entries.sort(key=lambda x: (day_order.get(x['day_of_week'], 99), x['start_time']))
-    
-    return teacher_entries
+            if teacher_lower in (entry['teacher'].lower().strip(), entry['practical_teacher'].lower().strip()):
+                teacher_entries.append(entry)
+    
+    return _sort_schedule_entries(teacher_entries)
+
+
+def get_room_schedule_from_builder(room):
+    """Get all schedule entries held in a room, across every saved schedule"""
+    query = """
+        SELECT semester, shift, section, schedule_data
+        FROM class_schedules
+        WHERE schedule_data IS NOT NULL
+    """
+    rows = execute_query(query, fetch_all=True) or []
+    room_lower = room.lower().strip()
+    entries = [e for row in rows for e in _schedule_entries(row)
+               if (e['room'] or '').lower().strip() == room_lower]
+    return _sort_schedule_entries(entries)
+
+
+def get_class_schedule_entries(semester, shift, section):
+    """Get a single class's schedule as flattened entries"""
+    schedule = get_schedule(semester, shift, section)
+    if not schedule or not schedule.get('schedule_data'):
+        return []
+    return _sort_schedule_entries(_schedule_entries(schedule))
+
+
+def get_schedule_rooms():
+    """Get the distinct rooms used in any saved schedule"""
+    query = """
+        SELECT DISTINCT TRIM(e->>'room') AS room
+        FROM class_schedules cs,
+             jsonb_array_elements(CASE WHEN jsonb_typeof(cs.schedule_data) = 'array'
+                                       THEN cs.schedule_data ELSE '[]'::jsonb END) e
+        WHERE COALESCE(TRIM(e->>'room'), '') <> ''
+        ORDER BY room
+    """
+    return [r['room'] for r in execute_query(query, fetch_all=True) or []]
+
+
+def get_schedule_versions():
+    """Get the version of every saved schedule - a cheap key for caching feeds"""
+    query = """
+        SELECT semester, shift, section, version
+        FROM class_schedules
+        ORDER BY semester, shift, section
+    """
+    return execute_query(query, fetch_all=True) or []
 
 
 def save_schedule(semester, shift, section, schedule_data):
@@ -1701,12 +2805,101 @@ def save_schedule(semester, shift, section, schedule_data):
         INSERT INTO class_schedules (semester, shift, section, schedule_data, updated_at)
         VALUES (%s, %s, %s, %s::jsonb, CURRENT_TIMESTAMP)
         ON CONFLICT (semester, shift, section)
-        DO UPDATE SET schedule_data = EXCLUDED.schedule_data, updated_at = CURRENT_TIMESTAMP
+        DO UPDATE SET schedule_data = EXCLUDED.schedule_data,
+                      version = class_schedules.version + 1,
+                      updated_at = CURRENT_TIMESTAMP
         RETURNING id
     """
     return execute_insert_returning(query, (semester, shift, section, schedule_data))
 
 
+def _schedule_patch_expression(operations):
+    """Build a SQL expression applying JSON Patch operations to schedule_data.
+
+    Supports add/replace/remove on block paths ("/3", "/3/room", "/-" to append)
+    and replace on "" for the whole timetable. Raises ValueError on anything else.
+    """
+    import json
+    expr = "schedule_data"
+    params = []
+    for op in operations:
+        kind = op.get('op')
+        path = op.get('path')
+        if kind not in ('add', 'replace', 'remove') or not isinstance(path, str):
+            raise ValueError(f"Unsupported patch operation: {op}")
+        if path == '':
+            if kind != 'replace' or not isinstance(op.get('value'), list):
+                raise ValueError("Only a list can replace the whole schedule")
+            expr = "%s::jsonb"
+            params = [json.dumps(op['value'])]
+            continue
+        parts = path.lstrip('/').split('/')
+        if not path.startswith('/') or len(parts) > 2 or not (parts[0].isdigit() or path == '/-'):
+            raise ValueError(f"Unsupported patch path: {path}")
+        if path == '/-':
+            if kind != 'add':
+                raise ValueError("'/-' can only be used to add a block")
+            expr = f"({expr} || jsonb_build_array(%s::jsonb))"
+            params.append(json.dumps(op.get('value')))
+        elif kind == 'remove':
+            expr = f"({expr} #- %s::text[])"
+            params.append(parts)
+        elif kind == 'add' and len(parts) == 1:
+            expr = f"jsonb_insert({expr}, %s::text[], %s::jsonb)"
+            params.extend([parts, json.dumps(op.get('value'))])
+        else:
+            expr = f"jsonb_set({expr}, %s::text[], %s::jsonb, true)"
+            params.extend([parts, json.dumps(op.get('value'))])
+    return expr, params
+
+
+def patch_schedule(semester, shift, section, operations, base_version):
+    """Apply JSON Patch operations to a schedule if it is still at base_version.
+
+    The patch is applied inside Postgres so only the changed blocks travel over
+    the wire. Returns {'status': 'ok', 'version': n} on success,
+    {'status': 'conflict', 'version': n, 'data': [...]} if someone saved first,
+    or None on error.
+    """
+    import json
+    try:
+        expr, params = _schedule_patch_expression(operations)
+    except ValueError as e:
+        print(f"Invalid schedule patch: {e}")
+        return None
+
+    def work(cursor):
+        if base_version == 0:
+            # First save for this class - create an empty version-0 row to patch
+            cursor.execute("""
+                INSERT INTO class_schedules (semester, shift, section, schedule_data, version)
+                VALUES (%s, %s, %s, '[]'::jsonb, 0)
+                ON CONFLICT (semester, shift, section) DO NOTHING
+            """, (semester, shift, section))
+
+        cursor.execute(f"""
+            UPDATE class_schedules
+            SET schedule_data = {expr}, version = version + 1, updated_at = CURRENT_TIMESTAMP
+            WHERE semester = %s AND shift = %s AND section = %s AND version = %s
+            RETURNING version
+        """, tuple(params) + (semester, shift, section, base_version))
+        row = cursor.fetchone()
+        if row:
+            return {'status': 'ok', 'version': row[0]}
+
+        cursor.execute("""
+            SELECT version, schedule_data FROM class_schedules
+            WHERE semester = %s AND shift = %s AND section = %s
+        """, (semester, shift, section))
+        current = cursor.fetchone()
+        data = current[1] if current else []
+        if isinstance(data, str):
+            data = json.loads(data)
+        return {'status': 'conflict', 'version': current[0] if current else 0, 'data': data or []}
+
+    return run_transaction(work)
+
+
 def delete_schedule(semester, shift, section):
     """Delete a schedule"""
     query = """
@@ -1725,3 +2918,905 @@ def get_all_schedules():
     return execute_query(query, fetch_all=True)
 
 
+def get_schedule_builder_bootstrap(semester):
+    """Get everything the schedule builder needs for a semester in one round trip:
+    subjects, teacher assignments (one row per subject/shift/teacher), teachers
+    and the six shift/section schedules with their versions."""
+    query = """
+        SELECT
+            COALESCE((
+                SELECT json_agg(json_build_object(
+                           'id', s.id, 'name', s.name, 'description', COALESCE(s.description, ''))
+                       ORDER BY s.name)
+                FROM subjects s
+                WHERE s.semester = %s AND s.deleted_at IS NULL
+            ), '[]'::json) AS subjects,
+            COALESCE((
+                SELECT json_agg(json_build_object(
+                           'subject_id', a.subject_id, 'subject_name', a.subject_name,
+                           'shift', a.shift, 'teacher_id', a.teacher_id, 'teacher_name', a.teacher_name)
+                       ORDER BY a.subject_name, a.shift, a.teacher_name)
+                FROM (
+                    SELECT DISTINCT ta.subject_id, s.name AS subject_name, COALESCE(ta.shift, '') AS shift,
+                           t.id AS teacher_id, COALESCE(u.full_name, '') AS teacher_name
+                    FROM teacher_assignments ta
+                    JOIN subjects s ON ta.subject_id = s.id
+                    JOIN teachers t ON ta.teacher_id = t.id
+                    JOIN users u ON t.user_id = u.id
+                    LEFT JOIN classes c ON ta.class_id = c.id
+                    WHERE s.semester = %s AND s.deleted_at IS NULL AND c.deleted_at IS NULL
+                ) a
+            ), '[]'::json) AS assignments,
+            COALESCE((
+                SELECT json_agg(json_build_object('id', t.id, 'name', u.full_name) ORDER BY u.full_name)
+                FROM teachers t
+                JOIN users u ON t.user_id = u.id
+            ), '[]'::json) AS teachers,
+            COALESCE((
+                SELECT json_agg(json_build_object(
+                           'shift', cs.shift, 'section', cs.section, 'version', cs.version,
+                           'data', COALESCE(cs.schedule_data, '[]'::jsonb))
+                       ORDER BY cs.shift, cs.section)
+                FROM class_schedules cs
+                WHERE cs.semester = %s
+            ), '[]'::json) AS schedules
+    """
+    result = execute_query(query, (semester, semester, semester), fetch_one=True)
+    if not result:
+        return None
+
+    import json
+    for key in ('subjects', 'assignments', 'teachers', 'schedules'):
+        if isinstance(result[key], str):
+            result[key] = json.loads(result[key])
+
+    # Key schedules by shift/section so the builder can look them up directly
+    schedules = {}
+    for shift in ('morning', 'night'):
+        for section in ('A', 'B', 'C'):
+            schedules[f"{shift}_{section}"] = {'version': 0, 'data': []}
+    for sched in result['schedules']:
+        data = sched['data']
+        if isinstance(data, str):
+            data = json.loads(data)
+        schedules[f"{sched['shift']}_{sched['section']}"] = {'version': sched['version'], 'data': data or []}
+    result['schedules'] = schedules
+    result['semester'] = semester
+    return result
+
+
+# =============================================
+# CYCLE ROLLOVER
+# =============================================
+
+# Source semester -> target semester, with source subjects matched to
+# same-named target subjects
+_ROLLOVER_SUBJECT_MAP = """
+    WITH sem_map AS (
+        SELECT * FROM unnest(%s::int[], %s::int[]) AS m(source_semester, target_semester)
+    ),
+    subject_map AS (
+        SELECT m.source_semester, m.target_semester,
+               src.id AS source_subject_id, tgt.id AS target_subject_id, tgt.name AS target_name
+        FROM sem_map m
+        JOIN subjects src ON src.semester = m.source_semester AND src.deleted_at IS NULL
+        JOIN subjects tgt ON tgt.semester = m.target_semester AND LOWER(tgt.name) = LOWER(src.name)
+                         AND tgt.deleted_at IS NULL
+    )
+"""
+
+
+def _rollover_semester_pairs(source_cycle, target_cycle):
+    """Pair each year's semester in the source cycle with its target-cycle semester"""
+    return [(get_semester_for_year(year, source_cycle), get_semester_for_year(year, target_cycle))
+            for year in (1, 2)]
+
+
+def rollover_cycle(source_cycle, target_cycle, dry_run=True):
+    """
+    Clone schedules, grade rubrics and weekly topic plans from one cycle's
+    semesters onto the other's, matching subjects by name and sections by
+    shift/section. Only empty targets are filled, so re-running is safe; a
+    schedule holding nothing but breaks counts as empty.
+    
+    A schedule none of whose subjects exist in the target semester is not
+    copied (it would be breaks only) but listed under 'skipped_schedules',
+    next to the 'unmatched_subjects' to create or rename first.
+    
+    Everything runs as set-based statements in one transaction; a dry run
+    executes the same statements and rolls back, so the returned diff is exact.
+    
+    Returns:
+        Dict with 'schedules', 'skipped_schedules', 'rubrics', 'topics' and
+        'unmatched_subjects' lists, or None on error
+    """
+    pairs = _rollover_semester_pairs(source_cycle, target_cycle)
+    params = ([p[0] for p in pairs], [p[1] for p in pairs])
+    
+    def work(cursor):
+        diff = {'source_cycle': source_cycle, 'target_cycle': target_cycle, 'dry_run': dry_run}
+        
+        cursor.execute(_ROLLOVER_SUBJECT_MAP + """
+            SELECT src.semester, src.name
+            FROM sem_map m
+            JOIN subjects src ON src.semester = m.source_semester AND src.deleted_at IS NULL
+            WHERE NOT EXISTS (SELECT 1 FROM subject_map sm WHERE sm.source_subject_id = src.id)
+            ORDER BY src.semester, src.name
+        """, params)
+        diff['unmatched_subjects'] = rows_to_dicts(cursor)
+        
+        cursor.execute(_ROLLOVER_SUBJECT_MAP + """
+            SELECT m.target_semester AS semester, cs.shift, cs.section
+            FROM sem_map m
+            JOIN class_schedules cs ON cs.semester = m.source_semester
+            WHERE jsonb_typeof(cs.schedule_data) = 'array'
+              AND NOT EXISTS (
+                  SELECT 1 FROM jsonb_array_elements(cs.schedule_data) AS e(block)
+                  JOIN subjects tgt ON tgt.semester = m.target_semester
+                                   AND LOWER(tgt.name) = LOWER(e.block->>'subject')
+                                   AND tgt.deleted_at IS NULL
+              )
+            ORDER BY m.target_semester, cs.shift, cs.section
+        """, params)
+        diff['skipped_schedules'] = rows_to_dicts(cursor)
+        
+        # Timetables: keep breaks and blocks whose subject exists in the target
+        # semester, for schedules with at least one such block
+        cursor.execute(_ROLLOVER_SUBJECT_MAP + """
+            , cloned AS (
+                INSERT INTO class_schedules (semester, shift, section, schedule_data, updated_at)
+                SELECT m.target_semester, cs.shift, cs.section, blocks.data, CURRENT_TIMESTAMP
+                FROM sem_map m
+                JOIN class_schedules cs ON cs.semester = m.source_semester
+                CROSS JOIN LATERAL (
+                    SELECT jsonb_agg(CASE WHEN tgt.id IS NULL THEN e.block
+                                          ELSE jsonb_set(e.block, '{subject}', to_jsonb(tgt.name)) END
+                                     ORDER BY e.ord) AS data,
+                           bool_or(tgt.id IS NOT NULL) AS has_subjects
+                    FROM jsonb_array_elements(cs.schedule_data) WITH ORDINALITY AS e(block, ord)
+                    LEFT JOIN subjects tgt ON tgt.semester = m.target_semester
+                                          AND LOWER(tgt.name) = LOWER(e.block->>'subject')
+                                          AND tgt.deleted_at IS NULL
+                    WHERE e.block->>'isBreak' = 'true' OR tgt.id IS NOT NULL
+                ) blocks
+                WHERE jsonb_typeof(cs.schedule_data) = 'array' AND blocks.has_subjects
+                ON CONFLICT (semester, shift, section) DO UPDATE
+                    SET schedule_data = EXCLUDED.schedule_data,
+                        version = class_schedules.version + 1,
+                        updated_at = CURRENT_TIMESTAMP
+                    WHERE class_schedules.schedule_data IS NULL
+                       OR class_schedules.schedule_data = '[]'::jsonb
+                       OR CASE WHEN jsonb_typeof(class_schedules.schedule_data) = 'array'
+                               THEN NOT EXISTS (
+                                   SELECT 1 FROM jsonb_array_elements(class_schedules.schedule_data) AS b(block)
+                                   WHERE b.block->>'isBreak' IS DISTINCT FROM 'true')
+                               ELSE false END
+                RETURNING semester, shift, section, jsonb_array_length(schedule_data) AS blocks
+            )
+            SELECT * FROM cloned ORDER BY semester, shift, section
+        """, params)
+        diff['schedules'] = rows_to_dicts(cursor)
+        
+        # Grade rubrics: copy onto target subjects that have no components yet
+        cursor.execute(_ROLLOVER_SUBJECT_MAP + """
+            , cloned AS (
+                INSERT INTO grade_components
+                    (subject_id, component_type, component_name, max_score, weight_percentage, display_order)
+                SELECT sm.target_subject_id, gc.component_type, gc.component_name,
+                       gc.max_score, gc.weight_percentage, gc.display_order
+                FROM subject_map sm
+                JOIN grade_components gc ON gc.subject_id = sm.source_subject_id
+                WHERE NOT EXISTS (SELECT 1 FROM grade_components x WHERE x.subject_id = sm.target_subject_id)
+                RETURNING subject_id
+            )
+            SELECT s.semester, s.id AS subject_id, s.name AS subject_name, COUNT(*) AS components
+            FROM cloned JOIN subjects s ON s.id = cloned.subject_id
+            GROUP BY s.semester, s.id, s.name
+            ORDER BY s.semester, s.name
+        """, params)
+        diff['rubrics'] = rows_to_dicts(cursor)
+        
+        # Weekly topic plans: same shift/section in the target semester, taught by
+        # whoever is assigned there; dates are left for the new term
+        cursor.execute(_ROLLOVER_SUBJECT_MAP + """
+            , cloned AS (
+                INSERT INTO weekly_topics (class_id, subject_id, teacher_id, week_number, topic, description)
+                SELECT tc.id, sm.target_subject_id, ta.teacher_id, wt.week_number, wt.topic, wt.description
+                FROM weekly_topics wt
+                JOIN classes sc ON wt.class_id = sc.id AND sc.deleted_at IS NULL
+                JOIN subject_map sm ON sm.source_subject_id = wt.subject_id AND sm.source_semester = sc.semester
+                JOIN classes tc ON tc.semester = sm.target_semester
+                               AND tc.shift = sc.shift AND tc.section = sc.section
+                               AND tc.deleted_at IS NULL
+                LEFT JOIN LATERAL (
+                    SELECT teacher_id FROM teacher_assignments
+                    WHERE subject_id = sm.target_subject_id AND class_id = tc.id
+                    ORDER BY id LIMIT 1
+                ) ta ON true
+                ON CONFLICT (class_id, subject_id, week_number) DO NOTHING
+                RETURNING class_id, subject_id
+            )
+            SELECT c.semester, c.shift, c.section, s.name AS subject_name, COUNT(*) AS topics
+            FROM cloned
+            JOIN classes c ON c.id = cloned.class_id
+            JOIN subjects s ON s.id = cloned.subject_id
+            GROUP BY c.semester, c.shift, c.section, s.name
+            ORDER BY c.semester, c.shift, c.section, s.name
+        """, params)
+        diff['topics'] = rows_to_dicts(cursor)
+        
+        return diff
+    
+    return run_transaction(work, commit=not dry_run)
+
+
+# =============================================
+# STUDENT PROMOTION
+# =============================================
+
+def get_promotion_plan(target_cycle):
+    """Semester moves for switching to target_cycle: {from_semester: to_semester}.
+    Mid-year (to cycle 2) moves Sem 1 -> 2 and 3 -> 4; year end (to cycle 1)
+    moves Sem 2 -> 3 and graduates Sem 4 (None)."""
+    if target_cycle == 2:
+        return {1: 2, 3: 4}
+    return {2: 3, 4: None}
+
+
+def promote_students(dry_run=True):
+    """
+    Move whole cohorts into the current cycle's semesters in one transaction.
+    
+    Run after switching the current cycle (see rollover_cycle). The cycle
+    students were last promoted into is recorded in system_settings, so
+    repeating the call does nothing until the cycle is switched again. With
+    no record yet, students are taken to be in the current cycle already.
+    
+    class_id is re-linked to the matching active class for the new
+    semester/shift/section, and Semester 4 graduates are archived. A dry run
+    executes the same statements and rolls back, so the preview is exact.
+    
+    Returns:
+        Dict with 'target_cycle', 'already_promoted', 'promoted' (counts per
+        source class) and 'graduated' (counts per class), or None on error
+    """
+    def work(cursor):
+        # Serialize promotions so two admins cannot both pass the check below
+        cursor.execute("SELECT pg_advisory_xact_lock(hashtext('promote_students'))")
+        cursor.execute("SELECT value FROM system_settings WHERE key = 'current_cycle'")
+        row = cursor.fetchone()
+        target_cycle = int(row[0]) if row else 1
+        
+        cursor.execute("SELECT value FROM system_settings WHERE key = 'last_promoted_cycle'")
+        row = cursor.fetchone()
+        last_promoted = int(row[0]) if row else target_cycle
+        
+        result = {'target_cycle': target_cycle, 'dry_run': dry_run,
+                  'already_promoted': last_promoted == target_cycle, 'graduated': [], 'promoted': []}
+        
+        cursor.execute("""
+            INSERT INTO system_settings (key, value, description, updated_at)
+            VALUES ('last_promoted_cycle', %s, 'Cycle students were last promoted into', CURRENT_TIMESTAMP)
+            ON CONFLICT (key) DO UPDATE SET value = EXCLUDED.value, updated_at = CURRENT_TIMESTAMP
+        """, (str(target_cycle),))
+        if result['already_promoted']:
+            return result
+        
+        plan = get_promotion_plan(target_cycle)
+        moves = {src: dst for src, dst in plan.items() if dst is not None}
+        graduating = [src for src, dst in plan.items() if dst is None]
+        
+        if graduating:
+            cursor.execute("""
+                WITH archived AS (
+                    INSERT INTO student_archive (student_id, user_id, student_number, year, semester, shift, section, class_id)
+                    SELECT id, user_id, student_number, year, semester, shift, section, class_id
+                    FROM students
+                    WHERE semester = ANY(%s::int[]) AND graduated_at IS NULL AND deleted_at IS NULL
+                    RETURNING student_id, semester, shift, section
+                ),
+                graduated AS (
+                    UPDATE students s
+                    SET graduated_at = CURRENT_TIMESTAMP, semester = NULL, section = NULL, class_id = NULL
+                    FROM archived a
+                    WHERE s.id = a.student_id
+                    RETURNING s.id
+                )
+                SELECT a.semester, a.shift, a.section, COUNT(*) AS count
+                FROM archived a
+                JOIN graduated g ON g.id = a.student_id
+                GROUP BY a.semester, a.shift, a.section
+                ORDER BY a.semester, a.shift, a.section
+            """, (graduating,))
+            result['graduated'] = rows_to_dicts(cursor)
+        
+        if moves:
+            cursor.execute("""
+                WITH sem_map AS (
+                    SELECT * FROM unnest(%s::int[], %s::int[]) AS m(from_semester, to_semester)
+                ),
+                promoted AS (
+                    UPDATE students s
+                    SET semester = m.to_semester,
+                        year = CASE WHEN m.to_semester <= 2 THEN 1 ELSE 2 END,
+                        class_id = (
+                            SELECT c.id FROM classes c
+                            WHERE c.semester = m.to_semester AND c.shift = s.shift
+                              AND c.section = s.section AND c.is_active = true
+                            ORDER BY c.id LIMIT 1
+                        )
+                    FROM sem_map m
+                    WHERE s.semester = m.from_semester AND s.graduated_at IS NULL AND s.deleted_at IS NULL
+                    RETURNING m.from_semester, s.semester AS to_semester, s.shift, s.section, s.class_id
+                )
+                SELECT from_semester, to_semester, shift, section, class_id, COUNT(*) AS count
+                FROM promoted
+                GROUP BY from_semester, to_semester, shift, section, class_id
+                ORDER BY from_semester, shift, section
+            """, (list(moves.keys()), list(moves.values())))
+            result['promoted'] = rows_to_dicts(cursor)
+        
+        return result
+    
+    return run_transaction(work, commit=not dry_run)
+
+
+# =============================================
+# SEARCH
+# =============================================
+
+# ts_headline match markers; plain text so snippets can be HTML-escaped safely
+SEARCH_MATCH_START = '[[['
+SEARCH_MATCH_STOP = ']]]'
+
+# Rows a user may see: students their own class, teachers the subject/class
+# pairs they are assigned to, admins everything. "x" is the searched table.
+_SEARCH_SCOPE = """
+    (me.role = 'admin'
+     OR (me.role = 'student' AND x.class_id = me.class_id)
+     OR (me.role = 'teacher' AND EXISTS (
+            SELECT 1 FROM teacher_assignments ta
+            WHERE ta.teacher_id = me.teacher_id
+              AND ta.subject_id = x.subject_id AND ta.class_id = x.class_id)))
+"""
+
+
+def search_content(user_id, role, text, limit=30):
+    """
+    Full-text search over lecture files (including their extracted document
+    text), homework and weekly topics the user may see, best matches first.
+    
+    Matching uses the GIN-indexed search_vector columns; snippets are only
+    built for the rows that make the cut. Files matching on their own
+    metadata and files matching on document text are found separately (an
+    OR across the blob join could use neither index) and merged by id.
+    
+    Returns:
+        List of dicts with kind ('file', 'homework' or 'topic'), id, title,
+        subject_id, subject_name, class_id, week_number, due_date, rank and
+        snippet (matches wrapped in SEARCH_MATCH_START/STOP)
+    """
+    query = f"""
+        WITH q AS (
+            SELECT websearch_to_tsquery('english', %s) AS query
+        ), me AS (
+            SELECT %s::text AS role,
+                   (SELECT class_id FROM students WHERE user_id = %s AND deleted_at IS NULL) AS class_id,
+                   (SELECT id FROM teachers WHERE user_id = %s) AS teacher_id
+        ), file_matches AS (
+            SELECT lf.id FROM lecture_files lf, q WHERE lf.search_vector @@ q.query
+            UNION
+            SELECT lf.id
+            FROM file_blobs fb
+            JOIN lecture_files lf ON lf.blob_hash = fb.sha256
+            CROSS JOIN q
+            WHERE fb.content_vector @@ q.query
+        ), hits AS (
+            SELECT 'file' AS kind, x.id, x.title,
+                   concat_ws(' ', x.description, left(fb.content_text, 5000)) AS body, x.subject_id, x.class_id,
+                   x.week_number, NULL::date AS due_date,
+                   ts_rank(x.search_vector || coalesce(fb.content_vector, ''::tsvector), q.query) AS rank
+            FROM file_matches m
+            JOIN lecture_files x ON x.id = m.id
+            LEFT JOIN file_blobs fb ON fb.sha256 = x.blob_hash
+            CROSS JOIN q CROSS JOIN me
+            WHERE {_SEARCH_SCOPE}
+            UNION ALL
+            SELECT 'homework', x.id, x.title, x.description, x.subject_id, x.class_id,
+                   NULL, x.due_date, ts_rank(x.search_vector, q.query)
+            FROM homework x, q, me
+            WHERE x.search_vector @@ q.query AND {_SEARCH_SCOPE}
+            UNION ALL
+            SELECT 'topic', x.id, x.topic, x.description, x.subject_id, x.class_id,
+                   x.week_number, NULL, ts_rank(x.search_vector, q.query)
+            FROM weekly_topics x, q, me
+            WHERE x.search_vector @@ q.query AND {_SEARCH_SCOPE}
+        ), top AS (
+            SELECT * FROM hits ORDER BY rank DESC LIMIT %s
+        )
+        SELECT top.kind, top.id, top.title, top.subject_id, s.name as subject_name, top.class_id,
+               top.week_number, top.due_date, top.rank,
+               ts_headline('english', coalesce(top.body, ''), q.query, %s) as snippet
+        FROM top
+        JOIN subjects s ON s.id = top.subject_id AND s.deleted_at IS NULL
+        CROSS JOIN q
+        ORDER BY top.rank DESC
+    """
+    options = f'MaxWords=25, MinWords=10, MaxFragments=2, StartSel="{SEARCH_MATCH_START}", StopSel="{SEARCH_MATCH_STOP}"'
+    return execute_query(query, (text, role, user_id, user_id, limit, options), fetch_all=True)
+
+
+# =============================================
+# DUPLICATE STUDENTS
+# =============================================
+# Candidate pairs come from blocking keys - same email, same phone (last 9
+# digits) or a trigram-similar name - so each student is only compared with
+# the few records sharing a key, using the indexes from
+# add_duplicate_detection.sql instead of comparing every pair.
+
+def find_duplicate_students(name_threshold=0.6):
+    """
+    Refresh the pending duplicate_candidates queue.
+    
+    Pairs an admin dismissed stay dismissed; pending pairs that no longer
+    match are removed.
+    
+    Returns:
+        Number of pending candidate pairs, or None on error
+    """
+    def work(cursor):
+        cursor.execute("SELECT set_config('pg_trgm.similarity_threshold', %s, true)", (str(name_threshold),))
+        cursor.execute(r"""
+            WITH pairs AS (
+                SELECT sa.id AS a, sb.id AS b, 'email' AS reason
+                FROM students sa
+                JOIN users ua ON ua.id = sa.user_id
+                JOIN users ub ON lower(trim(ub.email)) = lower(trim(ua.email)) AND ub.id <> ua.id
+                JOIN students sb ON sb.user_id = ub.id AND sb.id > sa.id AND sb.deleted_at IS NULL
+                WHERE sa.deleted_at IS NULL AND ua.email IS NOT NULL AND trim(ua.email) <> ''
+                UNION ALL
+                SELECT sa.id, sb.id, 'phone'
+                FROM students sa
+                JOIN students sb ON right(regexp_replace(sb.phone, '\D', '', 'g'), 9)
+                                  = right(regexp_replace(sa.phone, '\D', '', 'g'), 9)
+                                AND sb.id > sa.id AND sb.deleted_at IS NULL
+                WHERE sa.deleted_at IS NULL AND sa.phone IS NOT NULL AND length(regexp_replace(sa.phone, '\D', '', 'g')) >= 7
+                UNION ALL
+                SELECT sa.id, sb.id, 'name'
+                FROM students sa
+                JOIN users ua ON ua.id = sa.user_id
+                JOIN users ub ON lower(ub.full_name) %% lower(ua.full_name) AND ub.id <> ua.id
+                JOIN students sb ON sb.user_id = ub.id AND sb.id > sa.id AND sb.deleted_at IS NULL
+                WHERE sa.deleted_at IS NULL
+            )
+            INSERT INTO duplicate_candidates AS dc (student_a_id, student_b_id, reasons, score)
+            SELECT p.a, p.b, array_agg(DISTINCT p.reason ORDER BY p.reason),
+                   -- Name similarity (0-1) plus one point per shared email/phone
+                   similarity(lower(ua.full_name), lower(ub.full_name))
+                     + COUNT(DISTINCT p.reason) FILTER (WHERE p.reason <> 'name')
+            FROM pairs p
+            JOIN students sa ON sa.id = p.a JOIN users ua ON ua.id = sa.user_id
+            JOIN students sb ON sb.id = p.b JOIN users ub ON ub.id = sb.user_id
+            GROUP BY p.a, p.b, ua.full_name, ub.full_name
+            ON CONFLICT (student_a_id, student_b_id) DO UPDATE
+            SET reasons = EXCLUDED.reasons, score = EXCLUDED.score, detected_at = now()
+            WHERE dc.status = 'pending'
+        """)
+        # Anything pending that this scan did not touch no longer matches
+        cursor.execute("DELETE FROM duplicate_candidates WHERE status = 'pending' AND detected_at < now()")
+        cursor.execute("SELECT COUNT(*) FROM duplicate_candidates WHERE status = 'pending'")
+        return cursor.fetchone()[0]
+    
+    return run_transaction(work)
+
+
+def get_duplicate_candidates(limit=100):
+    """Pending candidate pairs, most likely first, with both students side by side (a_*, b_*)"""
+    sides = []
+    for side in ('a', 'b'):
+        sides.append(f"""
+            s{side}.id AS {side}_id, u{side}.full_name AS {side}_name, s{side}.student_number AS {side}_number,
+            u{side}.username AS {side}_username, u{side}.email AS {side}_email, s{side}.phone AS {side}_phone,
+            s{side}.semester AS {side}_semester, s{side}.shift AS {side}_shift, s{side}.section AS {side}_section,
+            u{side}.created_at AS {side}_created_at,
+            (SELECT COUNT(*) FROM attendance WHERE student_id = s{side}.id) AS {side}_attendance,
+            (SELECT COUNT(*) FROM grades WHERE student_id = s{side}.id) AS {side}_grades""")
+    query = f"""
+        SELECT dc.id, dc.reasons, dc.score, dc.detected_at, {','.join(sides)}
+        FROM duplicate_candidates dc
+        JOIN students sa ON sa.id = dc.student_a_id JOIN users ua ON ua.id = sa.user_id
+        JOIN students sb ON sb.id = dc.student_b_id JOIN users ub ON ub.id = sb.user_id
+        WHERE dc.status = 'pending' AND sa.deleted_at IS NULL AND sb.deleted_at IS NULL
+        ORDER BY dc.score DESC, dc.id
+        LIMIT %s
+    """
+    return execute_query(query, (limit,), fetch_all=True)
+
+
+def get_duplicate_candidate(candidate_id):
+    """One pending candidate pair"""
+    return execute_query(
+        "SELECT * FROM duplicate_candidates WHERE id = %s AND status = 'pending'",
+        (candidate_id,), fetch_one=True
+    )
+
+
+def dismiss_duplicate_candidate(candidate_id):
+    """Mark a pair as not a duplicate so later scans skip it"""
+    return execute_query(
+        "UPDATE duplicate_candidates SET status = 'dismissed', resolved_at = now() WHERE id = %s AND status = 'pending'",
+        (candidate_id,)
+    )
+
+
+def merge_students(keep_id, drop_id):
+    """
+    Merge a duplicate student into the one being kept, in one transaction.
+    
+    Attendance, grades, archive rows and file access counts move to the kept
+    student (where both have attendance for the same subject and day, the
+    kept record wins). Missing email/phone are taken from the duplicate, then
+    the duplicate's user account is deleted.
+    
+    Returns:
+        Dict of moved row counts, or None on error (nothing is changed)
+    """
+    def work(cursor):
+        cursor.execute(
+            "SELECT id, user_id FROM students WHERE id IN (%s, %s) AND deleted_at IS NULL ORDER BY id FOR UPDATE",
+            (keep_id, drop_id)
+        )
+        user_ids = {row[0]: row[1] for row in cursor.fetchall()}
+        if keep_id == drop_id or len(user_ids) != 2:
+            raise ValueError(f"cannot merge student {drop_id} into {keep_id}")
+        keep_user, drop_user = user_ids[keep_id], user_ids[drop_id]
+        moved = {}
+        
+        cursor.execute("""
+            UPDATE attendance a SET student_id = %s
+            WHERE a.student_id = %s
+              AND NOT EXISTS (SELECT 1 FROM attendance k
+                              WHERE k.student_id = %s AND k.subject_id = a.subject_id AND k.date = a.date)
+        """, (keep_id, drop_id, keep_id))
+        moved['attendance'] = cursor.rowcount
+        
+        cursor.execute("UPDATE grades SET student_id = %s WHERE student_id = %s", (keep_id, drop_id))
+        moved['grades'] = cursor.rowcount
+        
+        cursor.execute(
+            "UPDATE student_archive SET student_id = %s, user_id = %s WHERE student_id = %s",
+            (keep_id, keep_user, drop_id)
+        )
+        moved['archive'] = cursor.rowcount
+        
+        cursor.execute("""
+            INSERT INTO lecture_file_access AS a (file_id, user_id, access_date, hits, first_at, last_at)
+            SELECT file_id, %s, access_date, hits, first_at, last_at
+            FROM lecture_file_access WHERE user_id = %s
+            ORDER BY file_id, access_date
+            ON CONFLICT (file_id, user_id, access_date) DO UPDATE
+            SET hits = a.hits + EXCLUDED.hits,
+                first_at = LEAST(a.first_at, EXCLUDED.first_at),
+                last_at = GREATEST(a.last_at, EXCLUDED.last_at)
+        """, (keep_user, drop_user))
+        moved['file_access'] = cursor.rowcount
+        
+        cursor.execute("""
+            UPDATE students k SET phone = COALESCE(k.phone, d.phone)
+            FROM students d WHERE k.id = %s AND d.id = %s
+        """, (keep_id, drop_id))
+        cursor.execute("""
+            UPDATE users k SET email = COALESCE(NULLIF(trim(k.email), ''), d.email)
+            FROM users d WHERE k.id = %s AND d.id = %s
+        """, (keep_user, drop_user))
+        
+        # Cascades to the student row, leftover attendance and candidate pairs
+        cursor.execute("DELETE FROM users WHERE id = %s", (drop_user,))
+        return moved
+    
+    return run_transaction(work)
+
+
+# =============================================
+# SOFT DELETE AND PURGE
+# =============================================
+# Deleting a student, subject or class sets deleted_at (every listing skips
+# it from then on) and queues a purge job; purge.py then deletes the
+# dependent rows in small batches and finally the entity itself.
+
+def soft_delete(entity_type, entity_id, requested_by=None):
+    """
+    Hide a student, subject or class and queue its purge.
+    
+    Returns:
+        Purge job ID, or None if it was not found (or already deleted)
+    """
+    name_queries = {
+        'student': """
+            UPDATE students s SET deleted_at = now()
+            FROM users u
+            WHERE s.id = %s AND u.id = s.user_id AND s.deleted_at IS NULL
+            RETURNING u.full_name
+        """,
+        'subject': "UPDATE subjects SET deleted_at = now() WHERE id = %s AND deleted_at IS NULL RETURNING name",
+        'class': """
+            UPDATE classes SET deleted_at = now(), is_active = false
+            WHERE id = %s AND deleted_at IS NULL
+            RETURNING name
+        """,
+    }
+    
+    def work(cursor):
+        cursor.execute(name_queries[entity_type], (entity_id,))
+        row = cursor.fetchone()
+        if not row:
+            return None
+        cursor.execute("""
+            INSERT INTO purge_jobs (entity_type, entity_id, entity_name, requested_by)
+            VALUES (%s, %s, %s, %s)
+            RETURNING id
+        """, (entity_type, entity_id, row[0], requested_by))
+        return cursor.fetchone()[0]
+    
+    return run_transaction(work)
+
+
+def claim_purge_job(stale_minutes=10):
+    """
+    Take the oldest pending purge job (or one whose worker stopped reporting
+    progress) and mark it running.
+    
+    Returns:
+        Job dict, or None if there is nothing to do
+    """
+    def work(cursor):
+        cursor.execute("""
+            UPDATE purge_jobs SET status = 'running', updated_at = now()
+            WHERE id = (
+                SELECT id FROM purge_jobs
+                WHERE status = 'pending'
+                   OR (status = 'running' AND updated_at < now() - make_interval(mins => %s))
+                ORDER BY id
+                LIMIT 1
+                FOR UPDATE SKIP LOCKED
+            )
+            RETURNING *
+        """, (stale_minutes,))
+        rows = rows_to_dicts(cursor)
+        return rows[0] if rows else None
+    
+    return run_transaction(work)
+
+
+def update_purge_job(job_id, step, rows_deleted=0, files_removed=0):
+    """Record purge progress (also tells other workers the job is alive)"""
+    return execute_query("""
+        UPDATE purge_jobs
+        SET step = %s, rows_deleted = rows_deleted + %s, files_removed = files_removed + %s, updated_at = now()
+        WHERE id = %s
+    """, (step, rows_deleted, files_removed, job_id))
+
+
+def finish_purge_job(job_id, error=None):
+    """Mark a purge job done, or failed with the error"""
+    return execute_query("""
+        UPDATE purge_jobs
+        SET status = %s, error = %s, step = NULL, updated_at = now(), finished_at = now()
+        WHERE id = %s
+    """, ('failed' if error else 'done', error, job_id))
+
+
+def get_purge_jobs(limit=50):
+    """Most recent purge jobs"""
+    query = """
+        SELECT pj.*, u.full_name AS requested_by_name
+        FROM purge_jobs pj
+        LEFT JOIN users u ON u.id = pj.requested_by
+        ORDER BY pj.id DESC
+        LIMIT %s
+    """
+    return execute_query(query, (limit,), fetch_all=True)
+
+
+def purge_rows(table, condition, params, limit):
+    """
+    Delete at most limit rows of table matching condition in one short
+    transaction. table and condition come from purge.PURGE_PLAN, never from
+    user input.
+    
+    Returns:
+        Number of rows deleted, or None on error
+    """
+    def work(cursor):
+        cursor.execute(f"""
+            DELETE FROM {table}
+            WHERE ctid = ANY(ARRAY(SELECT ctid FROM {table} WHERE {condition} LIMIT %s))
+        """, tuple(params) + (limit,))
+        return cursor.rowcount
+    
+    return run_transaction(work)
+
+
+def get_lecture_file_ids(condition, params, limit):
+    """IDs of lecture files matching a purge condition, or None on error
+    (never an empty list the purge would take for "no files left")"""
+    def work(cursor):
+        cursor.execute(f"SELECT id FROM lecture_files WHERE {condition} ORDER BY id LIMIT %s",
+                       tuple(params) + (limit,))
+        return [row[0] for row in cursor.fetchall()]
+    
+    return run_transaction(work, commit=False)
+
+
+def delete_purged_entity(entity_type, entity_id):
+    """
+    Delete a soft-deleted student (with their user account), subject or class
+    once its large dependents are gone.
+    
+    Returns:
+        Number of rows deleted, or None on error
+    """
+    queries = {
+        'student': """
+            DELETE FROM users WHERE id = (
+                SELECT user_id FROM students WHERE id = %s AND deleted_at IS NOT NULL
+            )
+        """,
+        'subject': "DELETE FROM subjects WHERE id = %s AND deleted_at IS NOT NULL",
+        'class': "DELETE FROM classes WHERE id = %s AND deleted_at IS NOT NULL",
+    }
+    
+    def work(cursor):
+        cursor.execute(queries[entity_type], (entity_id,))
+        return cursor.rowcount
+    
+    return run_transaction(work)
+
+
+# =============================================
+# SCHEMA MIGRATIONS
+# =============================================
+# Bookkeeping for migrations.py: which versions are applied and how far
+# each backfill got, so an interrupted run resumes where it stopped.
+
+def ensure_migration_tables():
+    """Create the migration bookkeeping tables if needed"""
+    def work(cursor):
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migrations (
+                version VARCHAR(20) PRIMARY KEY,
+                name VARCHAR(200) NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor.execute("""
+            CREATE TABLE IF NOT EXISTS backfill_progress (
+                name VARCHAR(200) PRIMARY KEY,
+                last_id BIGINT NOT NULL DEFAULT 0,
+                rows_updated BIGINT NOT NULL DEFAULT 0,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                finished_at TIMESTAMP
+            )
+        """)
+        return True
+    
+    return run_transaction(work)
+
+
+def get_applied_migrations():
+    """Versions already applied, or None on error"""
+    def work(cursor):
+        cursor.execute("SELECT version FROM schema_migrations")
+        return {row[0] for row in cursor.fetchall()}
+    
+    return run_transaction(work)
+
+
+def record_migration(version, name):
+    """Mark a migration version as applied"""
+    return execute_query(
+        "INSERT INTO schema_migrations (version, name) VALUES (%s, %s) ON CONFLICT (version) DO NOTHING",
+        (version, name)
+    )
+
+
+def get_backfill_progress(name):
+    """Checkpoint of a backfill (last_id, rows_updated, finished_at), or None if not started"""
+    return execute_query("SELECT * FROM backfill_progress WHERE name = %s", (name,), fetch_one=True)
+
+
+_CONCURRENT_INDEX = re.compile(
+    r'CREATE\s+(?:UNIQUE\s+)?INDEX\s+CONCURRENTLY\s+IF\s+NOT\s+EXISTS\s+("?[\w.]+"?)', re.IGNORECASE
+)
+
+
+def run_schema_statements(statements, lock_timeout='3s', transactional=True):
+    """
+    Run DDL statements. With transactional=False each statement runs on its
+    own in autocommit mode (needed for CREATE INDEX CONCURRENTLY).
+    
+    A CREATE INDEX CONCURRENTLY that failed (lock timeout, duplicate key)
+    leaves an INVALID index behind, which IF NOT EXISTS would then skip. Such
+    an index is dropped (concurrently) before the statement is run again.
+    
+    lock_timeout makes a statement give up instead of queueing behind a long
+    query while every other query queues behind it.
+    
+    Returns:
+        True, or None on error
+    """
+    if transactional:
+        def work(cursor):
+            cursor.execute(f"SET LOCAL lock_timeout = '{lock_timeout}'")
+            for statement in statements:
+                cursor.execute(statement)
+            return True
+        
+        return run_transaction(work)
+    
+    conn = get_db_connection()
+    if not conn:
+        return None
+    try:
+        conn.autocommit = True
+        cursor = conn.cursor()
+        cursor.execute(f"SET lock_timeout = '{lock_timeout}'")
+        for statement in statements:
+            index = _CONCURRENT_INDEX.search(statement)
+            if index:
+                cursor.execute("SELECT indisvalid FROM pg_index WHERE indexrelid = to_regclass(%s)",
+                               (index.group(1),))
+                row = cursor.fetchone()
+                if row and not row[0]:
+                    print(f"Dropping invalid index {index.group(1)} left by an earlier attempt")
+                    cursor.execute(f"DROP INDEX CONCURRENTLY IF EXISTS {index.group(1)}")
+            cursor.execute(statement)
+        cursor.close()
+        return True
+    except Exception as e:
+        print(f"Schema statement error: {e}")
+        return None
+    finally:
+        conn.close()
+
+
+def backfill_batch(name, table, assignments, condition, last_id, batch_size):
+    """
+    Update one keyset batch of a backfill and save the checkpoint with it.
+    
+    The next batch_size ids after last_id are taken in id order; rows among
+    them matching condition get assignments. Table, assignments and condition
+    come from migrations.py, never from user input; the table is aliased t.
+    
+    Returns:
+        Dict with 'last_id', 'updated' and 'done', or None on error
+    """
+    def work(cursor):
+        cursor.execute(f"""
+            SELECT max(id), count(*) FROM (
+                SELECT id FROM {table} WHERE id > %s ORDER BY id LIMIT %s
+            ) batch
+        """, (last_id, batch_size))
+        upper, found = cursor.fetchone()
+        
+        updated = 0
+        if found:
+            cursor.execute(f"""
+                UPDATE {table} t SET {assignments}
+                WHERE t.id > %s AND t.id <= %s AND ({condition})
+            """, (last_id, upper))
+            updated = cursor.rowcount
+        
+        done = found < batch_size
+        cursor.execute("""
+            INSERT INTO backfill_progress (name, last_id, rows_updated, updated_at, finished_at)
+            VALUES (%s, %s, %s, now(), CASE WHEN %s THEN now() END)
+            ON CONFLICT (name) DO UPDATE
+            SET last_id = EXCLUDED.last_id,
+                rows_updated = backfill_progress.rows_updated + EXCLUDED.rows_updated,
+                updated_at = now(),
+                finished_at = EXCLUDED.finished_at
+        """, (name, upper or last_id, updated, done))
+        return {'last_id': upper or last_id, 'updated': updated, 'done': done}
+    
+    return run_transaction(work)
@@ -0,0 +1,62 @@
+"""
+Document Text Backfill
+Extract searchable text from lecture files uploaded before text extraction
+existed (or whose extraction was interrupted or failed - each blob is tried
+up to extraction.MAX_ATTEMPTS times, an hour apart). New uploads are extracted
+automatically. Each blob is extracted once, however many classes share it.
+
+Usage:
+    python extract_documents.py               # show how many files are pending
+    python extract_documents.py --apply       # extract them (4 processes)
+    python extract_documents.py --apply --workers 8
+"""
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import db
+import extraction
+import storage
+
+BATCH_SIZE = 500
+
+
+if __name__ == "__main__":
+    apply = '--apply' in sys.argv
+    workers = int(sys.argv[sys.argv.index('--workers') + 1]) if '--workers' in sys.argv else 4
+
+    print("=" * 60)
+    print("DOCUMENT TEXT EXTRACTION" + ("" if apply else " (DRY RUN)"))
+    print("=" * 60)
+
+    pending = db.get_blobs_pending_extraction(extraction.EXTRACTABLE_TYPES, extraction.MAX_ATTEMPTS, BATCH_SIZE)
+    print(f"\n📄 {len(pending)}{'+' if len(pending) == BATCH_SIZE else ''} files waiting for extraction")
+
+    if not apply:
+        print("\nRun with --apply to extract.")
+        sys.exit(0)
+
+    done = 0
+    chars = 0
+    with ProcessPoolExecutor(max_workers=workers) as executor:
+        while pending:
+            futures = [
+                executor.submit(extraction.extract_blob, b['sha256'],
+                                storage.to_key(b['file_path'], extraction.UPLOAD_FOLDER),
+                                b['compressed'], b['file_type'])
+                for b in pending
+            ]
+            batch_done = 0
+            for future in as_completed(futures):
+                result = future.result()
+                if result is not None:
+                    batch_done += 1
+                    chars += result
+            done += batch_done
+            print(f"   ... {done} extracted")
+            # Extracted blobs drop out of the pending list; stop if a whole
+            # batch made no progress (e.g. the database is unreachable)
+            if not batch_done:
+                break
+            pending = db.get_blobs_pending_extraction(extraction.EXTRACTABLE_TYPES, extraction.MAX_ATTEMPTS, BATCH_SIZE)
+
+    print(f"\n✅ Extracted text from {done} files ({chars:,} characters)")
@@ -0,0 +1,171 @@
+"""
+Plain-text extraction from uploaded lecture files for full-text search.
+
+Text is stored once per blob (file_blobs.content_text), so deduplicated uploads
+are only extracted once. Extraction runs in a small process pool so parsing
+large documents never blocks a web worker. PDF text comes from pdftotext
+(poppler-utils) when it is installed; DOCX, PPTX and XLSX are read with the
+standard library; TXT is decoded as UTF-8.
+"""
+import multiprocessing
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+
+import db
+import storage
+from config import config
+
+UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+
+# Bounded so one huge document cannot bloat the search index
+MAX_TEXT_CHARS = 100000
+PDF_MAX_PAGES = 50
+PDF_TIMEOUT = 60
+MAX_WORKERS = 2
+# A blob whose extraction keeps failing is given up on after this many tries
+MAX_ATTEMPTS = 3
+
+EXTRACTABLE_TYPES = {'pdf', 'docx', 'pptx', 'xlsx', 'txt'}
+
+_executor = None
+
+
+def can_extract(file_type):
+    """Whether text is extracted from this file type"""
+    return file_type in EXTRACTABLE_TYPES
+
+
+def _get_executor():
+    """Process pool, started on first use. Spawned (not forked) so children do
+    not inherit the web server's threads and sockets."""
+    global _executor
+    if _executor is None:
+        _executor = ProcessPoolExecutor(max_workers=MAX_WORKERS,
+                                        mp_context=multiprocessing.get_context('spawn'))
+    return _executor
+
+
+def schedule_extraction(blob, file_type):
+    """Queue text extraction for a newly stored blob"""
+    if can_extract(file_type):
+        _get_executor().submit(extract_blob, blob['sha256'], blob['key'], blob['compressed'], file_type)
+
+
+def extract_blob(sha256, key, compressed, file_type):
+    """
+    Extract and store the text of one blob unless another worker already did.
+
+    A failure (unreadable storage, a pdftotext timeout, a broken document)
+    stores nothing: the attempt is counted and the blob is retried after the
+    claim expires, up to MAX_ATTEMPTS times.
+
+    Returns:
+        Number of characters stored, or None if the blob was already handled
+        or extraction failed
+    """
+    if not db.claim_blob_extraction(sha256, MAX_ATTEMPTS):
+        return None
+
+    backend = storage.create_backend(config, UPLOAD_FOLDER)
+    try:
+        with _local_file(backend, key, compressed) as path:
+            text = extract_text(path, file_type)
+    except Exception as e:
+        print(f"Text extraction failed for {key}: {e}")
+        db.record_extraction_failure(sha256)
+        return None
+
+    # Stored even when empty so the blob is not picked up again
+    db.save_blob_content(sha256, text)
+    return len(text)
+
+
+@contextmanager
+def _local_file(backend, key, compressed):
+    """Local path with the original bytes of a blob"""
+    if not compressed:
+        with backend.local_copy(key) as path:
+            yield path
+        return
+
+    os.makedirs(backend.staging_dir, exist_ok=True)
+    fd, path = tempfile.mkstemp(dir=backend.staging_dir)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            for chunk in storage.iter_blob(backend, key, compressed=True):
+                out.write(chunk)
+        yield path
+    finally:
+        os.remove(path)
+
+
+def extract_text(path, file_type):
+    """Plain text of a document, at most MAX_TEXT_CHARS long"""
+    if file_type == 'pdf':
+        text = _pdf_text(path)
+    elif file_type == 'txt':
+        with open(path, 'rb') as f:
+            text = f.read(MAX_TEXT_CHARS * 4).decode('utf-8', errors='replace')
+    elif file_type == 'docx':
+        text = _ooxml_text(path, ['word/document.xml'], paragraph_tag='p')
+    elif file_type == 'pptx':
+        text = _ooxml_text(path, _numbered_parts(path, 'ppt/slides/slide'), paragraph_tag='p')
+    elif file_type == 'xlsx':
+        text = _ooxml_text(path, ['xl/sharedStrings.xml'], paragraph_tag='si')
+    else:
+        text = ''
+
+    # Postgres text cannot hold NUL; collapse runs of whitespace
+    text = re.sub(r'\s+', ' ', text.replace('\x00', ' ')).strip()
+    return text[:MAX_TEXT_CHARS]
+
+
+def _pdf_text(path):
+    pdftotext = shutil.which('pdftotext')
+    if not pdftotext:
+        return ''
+    result = subprocess.run(
+        [pdftotext, '-l', str(PDF_MAX_PAGES), '-enc', 'UTF-8', '-q', path, '-'],
+        capture_output=True, timeout=PDF_TIMEOUT
+    )
+    return result.stdout[:MAX_TEXT_CHARS * 4].decode('utf-8', errors='replace')
+
+
+def _numbered_parts(path, prefix):
+    """Part names like ppt/slides/slide12.xml in slide order"""
+    with zipfile.ZipFile(path) as archive:
+        names = [n for n in archive.namelist() if n.startswith(prefix) and n.endswith('.xml')]
+    return sorted(names, key=lambda n: int(re.sub(r'\D', '', n[len(prefix):]) or 0))
+
+
+def _ooxml_text(path, parts, paragraph_tag):
+    """
+    Collect the text runs (<*:t>) of Office Open XML parts, streaming the XML
+    and stopping as soon as MAX_TEXT_CHARS is reached.
+    """
+    pieces = []
+    length = 0
+    with zipfile.ZipFile(path) as archive:
+        names = set(archive.namelist())
+        for part in parts:
+            if part not in names:
+                continue
+            with archive.open(part) as f:
+                for _, element in ET.iterparse(f):
+                    tag = element.tag.rsplit('}', 1)[-1]
+                    if tag == 't' and element.text:
+                        pieces.append(element.text)
+                        length += len(element.text)
+                    elif tag == paragraph_tag:
+                        pieces.append('\n')
+                        element.clear()
+                    if length >= MAX_TEXT_CHARS:
+                        return ''.join(pieces)
+    return ''.join(pieces)
@@ -0,0 +1,38 @@
+"""
+Find Duplicate Students
+Refresh the duplicate review queue (Admin → Students → Duplicates) and list
+the most likely pairs. Students are matched on email, phone number and
+similar names via the indexes from database/add_duplicate_detection.sql,
+so this is fast even with many students. Nothing is merged here - merging is
+done by an admin in the review queue.
+
+Usage:
+    python find_duplicates.py                  # scan and show the top 20 pairs
+    python find_duplicates.py --threshold 0.5  # looser name matching (default 0.6)
+"""
+import sys
+
+import db
+
+
+if __name__ == "__main__":
+    threshold = float(sys.argv[sys.argv.index('--threshold') + 1]) if '--threshold' in sys.argv else 0.6
+
+    print("=" * 60)
+    print("FIND DUPLICATE STUDENTS")
+    print("=" * 60)
+
+    pending = db.find_duplicate_students(threshold)
+    if pending is None:
+        print("\n❌ Scan failed! Has database/add_duplicate_detection.sql been run?")
+        sys.exit(1)
+
+    print(f"\n🔎 {pending} possible duplicate pairs waiting for review")
+    for c in db.get_duplicate_candidates(limit=20) or []:
+        print(f"\n   [{', '.join(c['reasons'])}] score {c['score']:.2f}")
+        for side in ('a', 'b'):
+            print(f"     {c[side + '_number'] or '-':<14} {c[side + '_name']:<30} "
+                  f"{c[side + '_email'] or '-':<28} {c[side + '_phone'] or '-'}")
+
+    if pending:
+        print("\n✅ Review and merge them in the admin panel under Students → Duplicates.")
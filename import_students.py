@@ -0,0 +1,87 @@
+"""
+Import Students
+Enrol a whole intake from a CSV or XLSX file (same format as the admin
+"Import Students" page): passwords are hashed in parallel and all students are
+inserted in one transaction, so either every row goes in or none does.
+
+Usage:
+    python import_students.py intake.csv                          # dry run - validate only
+    python import_students.py intake.xlsx --apply                 # import
+    python import_students.py intake.csv --apply --skip-invalid   # import the valid rows only
+    python import_students.py intake.csv --apply --report out.csv # also write the per-row report
+"""
+import csv
+import os
+import sys
+import time
+
+import student_import
+
+
+def write_report(path, report):
+    """Per-row result as CSV: line, full_name, status, student_number, username, message"""
+    rows = [(r['line'], r['full_name'], 'imported', r['student_number'], r['username'], '')
+            for r in report['imported']]
+    rows += [(r['line'], r['full_name'], 'error', '', '', r['message']) for r in report['errors']]
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        writer = csv.writer(f)
+        writer.writerow(['line', 'full_name', 'status', 'student_number', 'username', 'message'])
+        writer.writerows(sorted(rows))
+
+
+if __name__ == "__main__":
+    args = [a for a in sys.argv[1:] if not a.startswith('--')]
+    apply = '--apply' in sys.argv
+    skip_invalid = '--skip-invalid' in sys.argv
+    report_path = sys.argv[sys.argv.index('--report') + 1] if '--report' in sys.argv else None
+    if report_path in args:
+        args.remove(report_path)
+
+    if len(args) != 1 or not os.path.isfile(args[0]):
+        print(__doc__)
+        sys.exit(1)
+    path = args[0]
+
+    print("=" * 60)
+    print(f"IMPORT STUDENTS: {os.path.basename(path)}" + ("" if apply else " (DRY RUN)"))
+    print("=" * 60)
+
+    with open(path, 'rb') as f:
+        report = student_import.import_file(f, path, dry_run=True, skip_invalid=skip_invalid)
+
+    valid = report['total'] - len(report['errors'])
+    print(f"\n📄 {report['total']} rows, {valid} valid, {len(report['errors'])} invalid")
+    for e in report['errors'][:50]:
+        print(f"   ❌ line {e['line']} ({e['full_name'] or '-'}): {e['message']}")
+    if len(report['errors']) > 50:
+        print(f"   ... and {len(report['errors']) - 50} more")
+
+    if report['failed']:
+        print(f"\n❌ {report['failed']}")
+        if report_path:
+            write_report(report_path, report)
+        sys.exit(1)
+
+    if not apply:
+        print("\nRun with --apply to import.")
+        sys.exit(0)
+
+    response = input(f"\nContinue importing {valid} students? (yes/no): ")
+    if response.lower() != 'yes':
+        print("\n❌ Import cancelled.")
+        sys.exit(1)
+
+    started = time.time()
+    with open(path, 'rb') as f:
+        report = student_import.import_file(f, path, skip_invalid=skip_invalid)
+    if report_path:
+        write_report(report_path, report)
+        print(f"\n📝 Report written to {report_path}")
+
+    if report['failed']:
+        print(f"\n❌ {report['failed']}")
+        sys.exit(1)
+
+    first, last = report['imported'][0], report['imported'][-1]
+    print(f"\n✅ Imported {len(report['imported'])} students in {time.time() - started:.1f}s "
+          f"({first['student_number']} - {last['student_number']})")
@@ -0,0 +1,77 @@
+"""
+Schema Migrations
+Apply the versioned migrations from migrations.py. Safe to run during term:
+DDL gives up quickly instead of blocking other queries, and data backfills
+run in small checkpointed batches with pauses in between. Stop it at any
+time (Ctrl+C) and run it again to resume.
+
+Usage:
+    python migrate.py                                 # show applied/pending migrations
+    python migrate.py --apply                         # apply pending migrations
+    python migrate.py --apply --batch-size 5000       # rows per batch (default 1000)
+    python migrate.py --apply --pause 1               # at least 1s between batches (default 0.1)
+    python migrate.py --apply --duty 0.25             # spend at most 25% of the time in batches (default 0.5)
+"""
+import sys
+
+import db
+import migrations
+
+
+def option(name, default, cast):
+    return cast(sys.argv[sys.argv.index(name) + 1]) if name in sys.argv else default
+
+
+if __name__ == "__main__":
+    apply = '--apply' in sys.argv
+    batch_size = option('--batch-size', migrations.BATCH_SIZE, int)
+    pause = option('--pause', migrations.PAUSE, float)
+    duty = option('--duty', migrations.DUTY_CYCLE, float)
+
+    print("=" * 60)
+    print("SCHEMA MIGRATIONS" + ("" if apply else " (STATUS)"))
+    print("=" * 60)
+
+    pending = migrations.pending_migrations()
+    if pending is None:
+        print("\n❌ Could not read schema_migrations!")
+        sys.exit(1)
+
+    pending_versions = {m.version for m in pending}
+    print()
+    for m in sorted(migrations.MIGRATIONS, key=lambda m: m.version):
+        mark = "⏳" if m.version in pending_versions else "✅"
+        print(f"{mark} {m.version}  {m.name}")
+        if m.version in pending_versions:
+            for backfill in m.backfills:
+                progress = db.get_backfill_progress(backfill.name)
+                if progress:
+                    state = "done" if progress['finished_at'] else f"at id {progress['last_id']}"
+                    print(f"        {backfill.name}: {state}, {progress['rows_updated']} rows updated")
+
+    if not pending:
+        print("\n✅ Database is up to date.")
+        sys.exit(0)
+
+    if not apply:
+        print(f"\n{len(pending)} pending. Run with --apply to migrate.")
+        sys.exit(0)
+
+    response = input(f"\nContinue applying {len(pending)} migrations? (yes/no): ")
+    if response.lower() != 'yes':
+        print("\n❌ Migration cancelled.")
+        sys.exit(1)
+
+    for m in pending:
+        print(f"\n▶ {m.version} {m.name}")
+        try:
+            ok = migrations.apply(m, batch_size, pause, duty)
+        except KeyboardInterrupt:
+            print("\n⏸  Stopped. Run again to resume from the last batch.")
+            sys.exit(1)
+        if not ok:
+            print(f"\n❌ {m.version} failed - later migrations were not run.")
+            sys.exit(1)
+        print(f"✅ {m.version} applied")
+
+    print("\n✅ All migrations applied!")
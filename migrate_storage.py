@@ -0,0 +1,112 @@
+"""
+Storage Migration
+Copy lecture files (and their previews) from the local uploads folder into the
+storage backend selected in config (STORAGE_BACKEND) and store plain storage
+keys in lecture_files.file_path instead of absolute local paths.
+
+Files are copied in parallel. Objects already in the target with the same size
+are skipped, so an interrupted run can simply be started again. Local files are
+left in place; remove them once the app runs against the new backend.
+
+Usage:
+    python migrate_storage.py                      # dry run - show what would happen
+    python migrate_storage.py --apply              # copy files and update lecture_files
+    python migrate_storage.py --apply --workers 16 # more parallel copies (default 8)
+"""
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import db
+import previews
+import storage
+from config import config
+
+UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+
+
+def copy_object(source, target, key):
+    """Copy one object unless the target already has it. Returns a status word."""
+    if not source.exists(key):
+        return 'missing'
+    if target.exists(key) and target.size(key) == source.size(key):
+        return 'skipped'
+    target.put_file(key, source.path(key), compressed=key.endswith('.gz'), keep_source=True)
+    return 'copied'
+
+
+def copy_all(source, target, keys, workers):
+    """Copy keys in parallel; returns (status counts, set of keys now in the target)"""
+    counts = {'copied': 0, 'skipped': 0, 'missing': 0, 'failed': 0}
+    done = set()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = {executor.submit(copy_object, source, target, key): key for key in keys}
+        for i, future in enumerate(as_completed(futures), 1):
+            key = futures[future]
+            try:
+                status = future.result()
+            except Exception as e:
+                print(f"   ❌ {key}: {e}")
+                status = 'failed'
+            counts[status] += 1
+            if status in ('copied', 'skipped'):
+                done.add(key)
+            if i % 100 == 0:
+                print(f"   ... {i}/{len(keys)}")
+    return counts, done
+
+
+if __name__ == "__main__":
+    apply = '--apply' in sys.argv
+    workers = int(sys.argv[sys.argv.index('--workers') + 1]) if '--workers' in sys.argv else 8
+
+    print("=" * 60)
+    print(f"STORAGE MIGRATION → {config.STORAGE_BACKEND}" + ("" if apply else " (DRY RUN)"))
+    print("=" * 60)
+
+    rows = db.get_lecture_file_paths()
+    if rows is None:
+        print("\n❌ Could not read lecture_files!")
+        sys.exit(1)
+
+    source = storage.LocalBackend(UPLOAD_FOLDER)
+    target = storage.create_backend(config, UPLOAD_FOLDER)
+    copy_needed = not isinstance(target, storage.LocalBackend)
+
+    keys = sorted({storage.to_key(row['file_path'], UPLOAD_FOLDER) for row in rows})
+    preview_keys = [previews.preview_key(key) for key in keys if source.exists(previews.preview_key(key))]
+    renames = {row['file_path']: storage.to_key(row['file_path'], UPLOAD_FOLDER) for row in rows}
+    renames = {old: new for old, new in renames.items() if old != new}
+
+    print(f"\n📁 {len(rows)} lecture file rows, {len(keys)} stored files, {len(preview_keys)} previews")
+    print(f"🔑 {len(renames)} paths to rewrite as storage keys")
+    if not copy_needed:
+        print("   Target is the local uploads folder - nothing to copy")
+
+    if not apply:
+        print("\nRun with --apply to migrate.")
+        sys.exit(0)
+
+    response = input("\nContinue with migration? (yes/no): ")
+    if response.lower() != 'yes':
+        print("\n❌ Migration cancelled.")
+        sys.exit(1)
+
+    if copy_needed:
+        print(f"\n📤 Copying with {workers} workers...")
+        counts, done = copy_all(source, target, keys + preview_keys, workers)
+        print(f"   Copied: {counts['copied']}, already there: {counts['skipped']}, "
+              f"missing locally: {counts['missing']}, failed: {counts['failed']}")
+        # Only rows whose file made it across are switched over
+        renames = {old: new for old, new in renames.items() if new in done}
+
+    if renames:
+        updated = db.update_lecture_file_paths(list(renames), list(renames.values()))
+        if updated is None:
+            print("\n❌ Could not update lecture_files!")
+            sys.exit(1)
+        print(f"\n✅ Updated {updated} lecture file rows")
+
+    print("\n✅ Migration complete!")
+    if copy_needed:
+        print(f"   Set STORAGE_BACKEND={config.STORAGE_BACKEND} on every app node before removing local files.")
@@ -0,0 +1,220 @@
+"""
+Versioned schema migrations with batched, throttled backfills.
+
+Each migration has a version, optional DDL statements and optional backfills.
+DDL runs with a short lock_timeout (and is retried) so it never queues behind
+a long query with every other query queued behind it; index builds use
+CREATE INDEX CONCURRENTLY outside a transaction. Backfills walk the table in
+id order, a batch at a time, each batch in its own short transaction that
+also saves a checkpoint - so a backfill can be stopped at any point (Ctrl+C)
+and resumes from the last batch on the next run. Between batches the runner
+sleeps so the database spends at most DUTY_CYCLE of its time on the backfill.
+
+A migration is recorded in schema_migrations once its DDL and all its
+backfills have finished. Run them with migrate.py.
+
+To add a migration, append to MIGRATIONS with the next version number.
+"""
+import time
+
+import db
+
+BATCH_SIZE = 1000
+PAUSE = 0.1  # minimum seconds between batches
+DUTY_CYCLE = 0.5  # at most this share of wall time spent inside batches
+LOCK_TIMEOUT = '3s'
+DDL_RETRIES = 5
+
+
+class Backfill:
+    """UPDATE <table> t SET <assignments> WHERE <condition>, in keyset batches"""
+
+    def __init__(self, name, table, assignments, condition):
+        self.name = name
+        self.table = table
+        self.assignments = assignments
+        self.condition = condition
+
+
+class Migration:
+    """
+    One schema version.
+
+    Args:
+        version: Sortable version string, e.g. '0003'
+        name: Short description
+        statements: DDL run in one transaction
+        concurrent: Statements that cannot run in a transaction
+                    (CREATE INDEX CONCURRENTLY), run after statements
+        backfills: Backfill objects, run after the DDL
+    """
+
+    def __init__(self, version, name, statements=(), concurrent=(), backfills=()):
+        self.version = version
+        self.name = name
+        self.statements = list(statements)
+        self.concurrent = list(concurrent)
+        self.backfills = list(backfills)
+
+
+MIGRATIONS = [
+    Migration(
+        '0001', 'Link grades to grade components',
+        statements=[
+            "ALTER TABLE grades ADD COLUMN IF NOT EXISTS component_id INTEGER "
+            "REFERENCES grade_components(id) ON DELETE SET NULL",
+        ],
+        concurrent=[
+            # upsert_grade looks grades up by student and component
+            "CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_grades_student_component "
+            "ON grades(student_id, component_id)",
+        ],
+        backfills=[
+            # Grades entered before components were linked carry the
+            # component's type and name
+            Backfill(
+                'grades.component_id', 'grades',
+                assignments="component_id = (SELECT gc.id FROM grade_components gc "
+                            "WHERE gc.subject_id = t.subject_id AND gc.component_type = t.grade_type "
+                            "AND gc.component_name = t.title ORDER BY gc.id LIMIT 1)",
+                condition="t.component_id IS NULL AND EXISTS (SELECT 1 FROM grade_components gc "
+                          "WHERE gc.subject_id = t.subject_id AND gc.component_type = t.grade_type "
+                          "AND gc.component_name = t.title)",
+            ),
+        ],
+    ),
+    Migration(
+        '0002', 'Link students to the class of their semester, shift and section',
+        backfills=[
+            Backfill(
+                'students.class_id', 'students',
+                assignments="class_id = (SELECT c.id FROM classes c "
+                            "WHERE c.semester = t.semester AND c.shift = t.shift AND c.section = t.section "
+                            "AND c.is_active = true ORDER BY c.id LIMIT 1)",
+                condition="t.class_id IS NULL AND t.section IS NOT NULL AND EXISTS (SELECT 1 FROM classes c "
+                          "WHERE c.semester = t.semester AND c.shift = t.shift AND c.section = t.section "
+                          "AND c.is_active = true)",
+            ),
+        ],
+    ),
+    Migration(
+        '0003', 'Rubric templates',
+        statements=[
+            """CREATE TABLE IF NOT EXISTS rubric_templates (
+                id SERIAL PRIMARY KEY,
+                name VARCHAR(100) NOT NULL UNIQUE,
+                description TEXT,
+                version INTEGER NOT NULL DEFAULT 1,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""",
+            """CREATE TABLE IF NOT EXISTS rubric_template_items (
+                id SERIAL PRIMARY KEY,
+                template_id INTEGER NOT NULL REFERENCES rubric_templates(id) ON DELETE CASCADE,
+                component_type VARCHAR(50) NOT NULL,
+                component_name VARCHAR(100) NOT NULL,
+                max_score DECIMAL(5,2) NOT NULL CHECK (max_score > 0),
+                weight_percentage DECIMAL(5,2) NOT NULL CHECK (weight_percentage >= 0 AND weight_percentage <= 100),
+                display_order INTEGER DEFAULT 0
+            )""",
+            "CREATE INDEX IF NOT EXISTS idx_rubric_template_items_template ON rubric_template_items(template_id)",
+            # Which template (and version of it) a subject's rubric was built from;
+            # the row is removed once the rubric is edited by hand
+            """CREATE TABLE IF NOT EXISTS subject_rubrics (
+                subject_id INTEGER PRIMARY KEY REFERENCES subjects(id) ON DELETE CASCADE,
+                template_id INTEGER NOT NULL REFERENCES rubric_templates(id) ON DELETE CASCADE,
+                template_version INTEGER NOT NULL,
+                applied_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )""",
+            "CREATE INDEX IF NOT EXISTS idx_subject_rubrics_template ON subject_rubrics(template_id)",
+        ],
+    ),
+    Migration(
+        '0004', 'Count failed document text extractions',
+        statements=[
+            # A failed extraction leaves content_text NULL so the blob is retried;
+            # this caps the retries for documents that can never be read
+            "ALTER TABLE file_blobs ADD COLUMN IF NOT EXISTS extract_attempts INTEGER NOT NULL DEFAULT 0",
+        ],
+    ),
+    Migration(
+        '0005', 'Allow re-creating a deleted class',
+        statements=[
+            # A soft-deleted class keeps its row until the purge finishes; only
+            # live classes need a unique year/semester/section/shift. classes is
+            # small, so the index is built inside the transaction - there is
+            # never a moment without the constraint.
+            "CREATE UNIQUE INDEX IF NOT EXISTS uq_classes_combo_live "
+            "ON classes(year, semester, section, shift) WHERE deleted_at IS NULL",
+            # schema.sql and migrate_classes.sql name it differently
+            "ALTER TABLE classes DROP CONSTRAINT IF EXISTS classes_year_semester_section_shift_key",
+            "ALTER TABLE classes DROP CONSTRAINT IF EXISTS unique_class_combo",
+        ],
+    ),
+]
+
+
+def pending_migrations():
+    """Migrations not applied yet, in version order (None if the database is unreachable)"""
+    if not db.ensure_migration_tables():
+        return None
+    applied = db.get_applied_migrations()
+    if applied is None:
+        return None
+    return [m for m in sorted(MIGRATIONS, key=lambda m: m.version) if m.version not in applied]
+
+
+def run_statements(statements, transactional=True):
+    """Run DDL, retrying when it times out waiting for a lock"""
+    for attempt in range(1, DDL_RETRIES + 1):
+        if db.run_schema_statements(statements, LOCK_TIMEOUT, transactional):
+            return True
+        if attempt < DDL_RETRIES:
+            print(f"   ⏳ Retrying in {attempt * 2}s ({attempt}/{DDL_RETRIES})")
+            time.sleep(attempt * 2)
+    return False
+
+
+def run_backfill(backfill, batch_size=BATCH_SIZE, pause=PAUSE, duty_cycle=DUTY_CYCLE):
+    """
+    Run a backfill from its last checkpoint to the end of the table.
+
+    Returns:
+        Rows updated by this run, or None if a batch failed
+    """
+    progress = db.get_backfill_progress(backfill.name)
+    if progress and progress['finished_at']:
+        return 0
+    last_id = progress['last_id'] if progress else 0
+    if last_id:
+        print(f"   ↪ Resuming {backfill.name} after id {last_id}")
+
+    total = 0
+    while True:
+        started = time.time()
+        result = db.backfill_batch(backfill.name, backfill.table, backfill.assignments,
+                                   backfill.condition, last_id, batch_size)
+        if result is None:
+            return None
+        total += result['updated']
+        last_id = result['last_id']
+        if result['done']:
+            return total
+
+        print(f"   ... {backfill.name}: up to id {last_id}, {total} rows updated")
+        elapsed = time.time() - started
+        time.sleep(max(pause, elapsed * (1 - duty_cycle) / duty_cycle))
+
+
+def apply(migration, batch_size=BATCH_SIZE, pause=PAUSE, duty_cycle=DUTY_CYCLE):
+    """Apply one migration. Returns True when it is fully applied."""
+    if migration.statements and not run_statements(migration.statements):
+        return False
+    if migration.concurrent and not run_statements(migration.concurrent, transactional=False):
+        return False
+    for backfill in migration.backfills:
+        updated = run_backfill(backfill, batch_size, pause, duty_cycle)
+        if updated is None:
+            return False
+        print(f"   ✓ {backfill.name}: {updated} rows updated")
+    return db.record_migration(migration.version, migration.name) is not None
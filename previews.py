@@ -0,0 +1,158 @@
+"""
+Thumbnail previews for lecture files.
+
+A preview is a small JPEG stored next to the file it belongs to
+(blobs/<aa>/<sha256>.preview.jpg), so every lecture_files row that shares a
+blob also shares its preview. Previews are rendered in a background thread
+after upload. Images need Pillow; the first page of a PDF is rendered with
+pdftoppm (poppler-utils) when it is installed.
+
+A file that cannot be rendered (corrupt image, broken PDF) gets an empty
+<key>.preview.failed marker instead, so it is not queued again on every
+listing.
+"""
+import os
+import shutil
+import subprocess
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+PREVIEW_SIZE = (320, 320)
+PREVIEW_QUALITY = 75
+PDF_RENDER_TIMEOUT = 30
+
+IMAGE_TYPES = {'jpg', 'jpeg', 'png', 'gif'}
+PDF_TYPES = {'pdf'}
+PREVIEW_TYPES = IMAGE_TYPES | PDF_TYPES
+
+_executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix='preview')
+_queued = set()
+_queued_lock = threading.Lock()
+
+
+def can_preview(file_type):
+    """Whether previews are generated for this file type"""
+    return file_type in PREVIEW_TYPES
+
+
+def preview_key(key):
+    """Storage key of the preview for a stored file (blob or legacy upload).
+    Built from the whole key: legacy uploads a.pdf and a.png must not share one."""
+    return key + '.preview.jpg'
+
+
+def failed_key(key):
+    """Storage key of the marker left when a file's preview could not be rendered"""
+    return key + '.preview.failed'
+
+
+def can_render(key, file_type):
+    """Whether a preview can be rendered here: a previewable type, stored
+    uncompressed, with its renderer installed - checked before fetching the file"""
+    if not can_preview(file_type) or key.endswith('.gz'):
+        return False
+    if file_type in PDF_TYPES:
+        return shutil.which('pdftoppm') is not None
+    return Image is not None
+
+
+def generate_preview(backend, key, file_type):
+    """
+    Render the preview for a stored file unless it already exists.
+
+    A rendering error leaves the failed marker; an error reading or writing
+    storage does not, so that is tried again on a later request.
+
+    Returns:
+        Key of the preview, or None if it could not be rendered
+    """
+    target = preview_key(key)
+    if backend.exists(target):
+        return target
+    if not can_render(key, file_type) or backend.exists(failed_key(key)):
+        return None
+
+    os.makedirs(backend.staging_dir, exist_ok=True)
+    fd, rendered_path = tempfile.mkstemp(dir=backend.staging_dir, suffix='.jpg')
+    os.close(fd)
+    try:
+        with backend.local_copy(key) as source:
+            try:
+                if file_type in PDF_TYPES:
+                    _render_pdf(source, rendered_path)
+                else:
+                    _render_image(source, rendered_path)
+            except Exception as e:
+                print(f"Preview rendering failed for {key}: {e}")
+                _mark_failed(backend, key, rendered_path)
+                return None
+        backend.put_file(target, rendered_path)
+        return target
+    except Exception as e:
+        print(f"Preview generation failed for {key}: {e}")
+        return None
+    finally:
+        if os.path.exists(rendered_path):
+            os.remove(rendered_path)
+
+
+def _mark_failed(backend, key, scratch_path):
+    """Store the empty failed marker for key (scratch_path is reused for it)"""
+    open(scratch_path, 'wb').close()
+    backend.put_file(failed_key(key), scratch_path)
+
+
+def _render_image(file_path, target):
+    """Downscale an image to a JPEG thumbnail"""
+    with Image.open(file_path) as image:
+        # Let the JPEG decoder skip detail we are about to throw away
+        image.draft('RGB', PREVIEW_SIZE)
+        image.thumbnail(PREVIEW_SIZE)
+        image.convert('RGB').save(target, 'JPEG', quality=PREVIEW_QUALITY, optimize=True)
+
+
+def _render_pdf(file_path, target):
+    """Render the first page of a PDF with pdftoppm"""
+    pdftoppm = shutil.which('pdftoppm')
+    with tempfile.TemporaryDirectory(dir=os.path.dirname(target)) as tmp_dir:
+        prefix = os.path.join(tmp_dir, 'page')
+        subprocess.run(
+            [pdftoppm, '-f', '1', '-l', '1', '-singlefile', '-jpeg',
+             '-jpegopt', f'quality={PREVIEW_QUALITY}', '-scale-to', str(max(PREVIEW_SIZE)),
+             file_path, prefix],
+            check=True, capture_output=True, timeout=PDF_RENDER_TIMEOUT
+        )
+        os.replace(prefix + '.jpg', target)
+
+
+def schedule_preview(backend, key, file_type):
+    """Queue preview generation in the background, unless it cannot be
+    rendered, failed before or is already queued"""
+    if not can_render(key, file_type):
+        return
+    with _queued_lock:
+        if key in _queued:
+            return
+        _queued.add(key)
+    _executor.submit(_generate_queued, backend, key, file_type)
+
+
+def _generate_queued(backend, key, file_type):
+    try:
+        generate_preview(backend, key, file_type)
+    finally:
+        with _queued_lock:
+            _queued.discard(key)
+
+
+def remove_preview(backend, key):
+    """Delete the preview (or failed marker) of a stored file that is being removed"""
+    if key:
+        backend.delete(preview_key(key))
+        backend.delete(failed_key(key))
@@ -0,0 +1,65 @@
+"""
+Semester Promotion
+Move every cohort forward into the current cycle - run it after switching
+the cycle with rollover_cycle.py:
+  - into cycle 2 (mid-year): Sem 1 → 2, Sem 3 → 4
+  - into cycle 1 (year end): Sem 2 → 3, Sem 4 → graduated (archived)
+class_id is re-linked to the new semester's class. Runs in one transaction,
+once per cycle switch - running it again changes nothing.
+
+Usage:
+    python promote_students.py            # dry run - show counts per class
+    python promote_students.py --apply    # promote
+"""
+import sys
+import db
+
+
+def print_result(result):
+    print(f"\n📋 Promoted ({sum(r['count'] for r in result['promoted'])} students):")
+    for r in result['promoted']:
+        link = f"class #{r['class_id']}" if r['class_id'] else "⚠️  no matching class"
+        print(f"   Sem {r['from_semester']} → {r['to_semester']} - {r['shift'].title()} - "
+              f"Class {r['section'] or '-'}: {r['count']} ({link})")
+    
+    if result['graduated']:
+        print(f"\n🎓 Graduated ({sum(r['count'] for r in result['graduated'])} students):")
+        for r in result['graduated']:
+            print(f"   Sem {r['semester']} - {r['shift'].title()} - Class {r['section'] or '-'}: {r['count']}")
+
+
+if __name__ == "__main__":
+    apply = '--apply' in sys.argv
+    
+    result = db.promote_students(dry_run=True)
+    if result is None:
+        print("\n❌ Promotion failed!")
+        sys.exit(1)
+    
+    print("=" * 60)
+    print(f"SEMESTER PROMOTION → cycle {result['target_cycle']}" + ("" if apply else " (DRY RUN)"))
+    print("=" * 60)
+    
+    if result['already_promoted']:
+        print(f"\n✅ Students are already in cycle {result['target_cycle']}. "
+              "Switch the cycle with rollover_cycle.py first.")
+        sys.exit(0)
+    print_result(result)
+    
+    if not apply:
+        print("\nRun with --apply to promote.")
+        sys.exit(0)
+    
+    response = input("\nContinue with promotion? (yes/no): ")
+    if response.lower() != 'yes':
+        print("\n❌ Promotion cancelled.")
+        sys.exit(1)
+    
+    result = db.promote_students(dry_run=False)
+    if result is None:
+        print("\n❌ Promotion failed! Nothing was changed.")
+        sys.exit(1)
+    if result['already_promoted']:
+        print("\n⚠️  Someone else promoted the students in the meantime. Nothing was changed.")
+        sys.exit(1)
+    print("\n✅ Promotion complete!")
@@ -0,0 +1,140 @@
+"""
+Background purge of soft-deleted students, subjects and classes.
+
+db.soft_delete hides the entity at once and queues a purge job. A worker
+thread then removes the dependent rows in small batches, each in its own
+short transaction with a pause in between, so a subject with a semester of
+attendance never holds locks long enough to stall teachers. Lecture files go
+through db.delete_lecture_file so shared blobs keep correct reference counts
+and unused files and previews are removed from storage. The entity row itself
+is deleted last, when only a handful of cascading rows are left.
+
+Jobs survive restarts: a job whose worker stopped reporting progress is
+picked up again by the next worker.
+"""
+import os
+import threading
+import time
+
+import db
+import previews
+import storage
+
+UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+
+BATCH_SIZE = 500
+FILE_BATCH_SIZE = 20
+PAUSE = 0.2  # seconds between batches
+
+# Attendance and grades of a class: its students in the subjects assigned to it
+_CLASS_RECORDS = ("student_id IN (SELECT id FROM students WHERE class_id = %s) "
+                  "AND subject_id IN (SELECT subject_id FROM teacher_assignments WHERE class_id = %s)")
+
+# Dependents removed before the entity itself, largest tables first.
+# Every %s is the entity ID.
+PURGE_PLAN = {
+    'student': [
+        ('attendance', "student_id = %s"),
+        ('grades', "student_id = %s"),
+        ('lecture_file_access', "user_id = (SELECT user_id FROM students WHERE id = %s)"),
+    ],
+    'subject': [
+        ('lecture_files', "subject_id = %s"),
+        ('attendance', "subject_id = %s"),
+        ('grades', "subject_id = %s"),
+        ('homework', "subject_id = %s"),
+        ('weekly_topics', "subject_id = %s"),
+        ('timetable', "subject_id = %s"),
+    ],
+    'class': [
+        ('lecture_files', "class_id = %s"),
+        ('attendance', _CLASS_RECORDS),
+        ('grades', _CLASS_RECORDS),
+        ('homework', "class_id = %s"),
+        ('weekly_topics', "class_id = %s"),
+        ('timetable', "class_id = %s"),
+        # Last: the attendance and grades conditions above look assignments up
+        ('teacher_assignments', "class_id = %s"),
+    ],
+}
+
+_lock = threading.Lock()
+_worker = None
+
+
+class PurgeError(Exception):
+    """A purge step failed; the job is marked failed with this message"""
+
+
+def start(backend):
+    """Run queued purge jobs in a background thread unless one already is"""
+    global _worker
+    with _lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=run_pending, args=(backend,), daemon=True, name='purge')
+            _worker.start()
+
+
+def run_pending(backend):
+    """Work through purge jobs until none are left. Returns the number run."""
+    count = 0
+    while True:
+        job = db.claim_purge_job()
+        if not job:
+            return count
+        run_job(job, backend)
+        count += 1
+
+
+def run_job(job, backend):
+    """Purge one entity; failures are recorded on the job"""
+    try:
+        for table, condition in PURGE_PLAN[job['entity_type']]:
+            params = (job['entity_id'],) * condition.count('%s')
+            if table == 'lecture_files':
+                _purge_files(job, backend, condition, params)
+            else:
+                _purge_table(job, table, condition, params)
+
+        db.update_purge_job(job['id'], job['entity_type'])
+        if db.delete_purged_entity(job['entity_type'], job['entity_id']) is None:
+            raise PurgeError(f"could not delete {job['entity_type']} {job['entity_id']}")
+        db.finish_purge_job(job['id'])
+    except Exception as e:
+        print(f"Purge job {job['id']} failed: {e}")
+        db.finish_purge_job(job['id'], error=str(e))
+
+
+def _purge_table(job, table, condition, params):
+    while True:
+        deleted = db.purge_rows(table, condition, params, BATCH_SIZE)
+        if deleted is None:
+            raise PurgeError(f"could not delete from {table}")
+        db.update_purge_job(job['id'], table, rows_deleted=deleted)
+        if deleted < BATCH_SIZE:
+            return
+        time.sleep(PAUSE)
+
+
+def _remove_file(backend, file_path):
+    key = storage.to_key(file_path, UPLOAD_FOLDER)
+    storage.remove_blob(backend, key)
+    previews.remove_preview(backend, key)
+
+
+def _purge_files(job, backend, condition, params):
+    while True:
+        file_ids = db.get_lecture_file_ids(condition, params, FILE_BATCH_SIZE)
+        if file_ids is None:
+            raise PurgeError("could not list lecture files")
+        removed = 0
+        for file_id in file_ids:
+            released = db.delete_lecture_file(file_id, lambda path: _remove_file(backend, path))
+            if released is None:
+                raise PurgeError(f"could not delete lecture file {file_id}")
+            if released['removed']:
+                removed += 1
+        db.update_purge_job(job['id'], 'lecture_files', rows_deleted=len(file_ids), files_removed=removed)
+        if len(file_ids) < FILE_BATCH_SIZE:
+            return
+        time.sleep(PAUSE)
@@ -0,0 +1,258 @@
+"""
+Storage Reconciler
+Compare the uploads folder with lecture_files and report:
+  - orphans: files on disk that no lecture file uses (e.g. left behind when a
+    subject was deleted and its lecture_files rows cascaded away, or abandoned
+    resumable uploads in uploads/tmp)
+  - missing: lecture_files rows whose file is gone
+
+The walk is incremental: the listing of every directory is kept in a checkpoint
+(uploads/.reconcile_state.json) and a directory is only listed again when its
+mtime changed. Meant to run from cron at low priority, outside the web workers.
+Only the local storage backend is walked; a bucket is reconciled by its own
+lifecycle rules.
+
+Usage:
+    python reconcile_storage.py                    # report only
+    python reconcile_storage.py --quarantine       # move orphans to uploads/quarantine/<run>/
+    python reconcile_storage.py --purge-days 30    # delete quarantine runs older than 30 days
+    add --yes to skip the confirmation (for cron)
+"""
+import json
+import os
+import shutil
+import sys
+import time
+from datetime import datetime
+
+import db
+import previews
+import storage
+from config import config
+
+UPLOAD_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'uploads')
+STATE_FILE = '.reconcile_state.json'
+QUARANTINE_DIR = 'quarantine'
+
+# Files younger than this may belong to an upload whose row is not committed yet
+GRACE_SECONDS = 60 * 60
+# Resumable uploads untouched for this long are abandoned
+TMP_MAX_AGE_SECONDS = 24 * 60 * 60
+# Pause after listing this many directories so the disk stays responsive
+THROTTLE_EVERY = 200
+THROTTLE_SLEEP = 0.05
+
+
+def load_state():
+    path = os.path.join(UPLOAD_FOLDER, STATE_FILE)
+    if os.path.exists(path):
+        with open(path) as f:
+            return json.load(f)
+    return {'dirs': {}}
+
+
+def save_state(state):
+    path = os.path.join(UPLOAD_FOLDER, STATE_FILE)
+    with open(path + '.part', 'w') as f:
+        json.dump(state, f)
+    os.replace(path + '.part', path)
+
+
+def list_dir(rel_dir):
+    """List one directory: its mtime, files (name -> mtime) and subdirectories"""
+    abs_dir = os.path.join(UPLOAD_FOLDER, rel_dir)
+    listing = {'mtime': os.stat(abs_dir).st_mtime, 'files': {}, 'dirs': []}
+    with os.scandir(abs_dir) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                listing['dirs'].append(entry.name)
+            elif entry.is_file(follow_symlinks=False):
+                listing['files'][entry.name] = entry.stat().st_mtime
+    return listing
+
+
+def scan(state):
+    """
+    Walk the uploads tree, re-listing only directories whose mtime changed.
+    uploads/tmp is always re-listed since chunks are appended in place.
+
+    Returns:
+        (files, rescanned) where files maps relative path -> mtime
+    """
+    cached_dirs = state.get('dirs', {})
+    new_dirs = {}
+    files = {}
+    rescanned = 0
+    pending = ['']
+
+    while pending:
+        rel_dir = pending.pop()
+        cached = cached_dirs.get(rel_dir)
+        mtime = os.stat(os.path.join(UPLOAD_FOLDER, rel_dir)).st_mtime
+
+        if cached and cached['mtime'] == mtime and rel_dir != storage.TMP_DIR_NAME:
+            listing = cached
+        else:
+            listing = list_dir(rel_dir)
+            rescanned += 1
+            if rescanned % THROTTLE_EVERY == 0:
+                time.sleep(THROTTLE_SLEEP)
+
+        new_dirs[rel_dir] = listing
+        for name, file_mtime in listing['files'].items():
+            files[os.path.join(rel_dir, name)] = file_mtime
+        for name in listing['dirs']:
+            if rel_dir == '' and name == QUARANTINE_DIR:
+                continue
+            pending.append(os.path.join(rel_dir, name))
+
+    state['dirs'] = new_dirs
+    return files, rescanned
+
+
+def reconcile(files, rows):
+    """Split into orphaned files and rows with missing files"""
+    now = time.time()
+    referenced = {}
+    for row in rows:
+        rel = storage.to_key(row['file_path'], UPLOAD_FOLDER)
+        referenced.setdefault(rel, []).append(row['id'])
+
+    keep = set(referenced)
+    keep.update(previews.preview_key(rel) for rel in referenced)
+    keep.update(previews.failed_key(rel) for rel in referenced)
+
+    orphans = []
+    for rel, mtime in sorted(files.items()):
+        if rel == STATE_FILE or rel in keep:
+            continue
+        in_tmp = rel.startswith(storage.TMP_DIR_NAME + os.sep)
+        max_age = TMP_MAX_AGE_SECONDS if in_tmp else GRACE_SECONDS
+        if now - mtime > max_age:
+            orphans.append(rel)
+
+    missing = [{'path': rel, 'file_ids': ids} for rel, ids in sorted(referenced.items()) if rel not in files]
+    return orphans, missing
+
+
+def quarantine(orphans, missing):
+    """Move orphans into a quarantine run folder and record the missing rows there"""
+    # A blob can be picked up again by a new upload of the same content after
+    # the report was made; check once more (as key and as legacy absolute path)
+    # right before moving anything
+    candidates = set(orphans) | {os.path.join(UPLOAD_FOLDER, rel) for rel in orphans}
+    in_use = db.get_referenced_file_paths(candidates) if orphans else set()
+    if in_use is None:
+        return None
+    in_use = {storage.to_key(path, UPLOAD_FOLDER) for path in in_use}
+    orphans = [rel for rel in orphans if rel not in in_use]
+
+    run_dir = os.path.join(UPLOAD_FOLDER, QUARANTINE_DIR, datetime.now().strftime('%Y%m%d_%H%M%S'))
+    os.makedirs(run_dir, exist_ok=True)
+    for rel in orphans:
+        target = os.path.join(run_dir, rel)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        shutil.move(os.path.join(UPLOAD_FOLDER, rel), target)
+    with open(os.path.join(run_dir, 'missing.json'), 'w') as f:
+        json.dump(missing, f, indent=2)
+    return run_dir
+
+
+def purge_quarantine(days):
+    """Delete quarantine runs older than the given number of days"""
+    root = os.path.join(UPLOAD_FOLDER, QUARANTINE_DIR)
+    if not os.path.isdir(root):
+        return 0
+    cutoff = time.time() - days * 24 * 60 * 60
+    purged = 0
+    for name in sorted(os.listdir(root)):
+        path = os.path.join(root, name)
+        if os.path.isdir(path) and os.stat(path).st_mtime < cutoff:
+            shutil.rmtree(path)
+            purged += 1
+    return purged
+
+
+def format_size(total):
+    return f"{total / (1024 * 1024):.1f} MB"
+
+
+if __name__ == "__main__":
+    apply = '--quarantine' in sys.argv
+    confirmed = '--yes' in sys.argv
+
+    if hasattr(os, 'nice'):
+        os.nice(10)
+
+    print("=" * 60)
+    print("STORAGE RECONCILER" + ("" if apply else " (REPORT ONLY)"))
+    print("=" * 60)
+
+    if '--purge-days' in sys.argv:
+        days = int(sys.argv[sys.argv.index('--purge-days') + 1])
+        print(f"\n🗑️  Purged {purge_quarantine(days)} quarantine run(s) older than {days} days")
+
+    if config.STORAGE_BACKEND != 'local':
+        print(f"\n❌ Only the local storage backend can be reconciled (STORAGE_BACKEND={config.STORAGE_BACKEND})")
+        sys.exit(1)
+
+    if not os.path.isdir(UPLOAD_FOLDER):
+        print(f"\n❌ Uploads folder not found: {UPLOAD_FOLDER}")
+        sys.exit(1)
+
+    rows = db.get_lecture_file_paths()
+    if rows is None:
+        print("\n❌ Could not read lecture_files!")
+        sys.exit(1)
+
+    state = load_state()
+    files, rescanned = scan(state)
+    orphans, missing = reconcile(files, rows)
+    blobs = db.reconcile_file_blobs(dry_run=True)
+
+    print(f"\n📁 {len(files)} files on disk ({rescanned} directories re-listed), {len(rows)} lecture file rows")
+
+    orphan_size = sum(os.path.getsize(os.path.join(UPLOAD_FOLDER, rel)) for rel in orphans
+                      if os.path.exists(os.path.join(UPLOAD_FOLDER, rel)))
+    print(f"\n🧹 Orphaned files: {len(orphans)} ({format_size(orphan_size)})")
+    for rel in orphans[:20]:
+        print(f"   {rel}")
+    if len(orphans) > 20:
+        print(f"   ... and {len(orphans) - 20} more")
+
+    print(f"\n⚠️  Rows with missing files: {len(missing)}")
+    for m in missing[:20]:
+        print(f"   {m['path']} (file ids: {', '.join(str(i) for i in m['file_ids'])})")
+    if len(missing) > 20:
+        print(f"   ... and {len(missing) - 20} more")
+
+    if blobs:
+        print(f"\n🔢 Blob reference counts off: {blobs['recounted']}, unused blob rows: {len(blobs['released'])}")
+
+    if not apply:
+        save_state(state)
+        print("\nRun with --quarantine to move orphans aside.")
+        sys.exit(0)
+
+    if not orphans and not missing and not (blobs and (blobs['recounted'] or blobs['released'])):
+        save_state(state)
+        print("\n✅ Nothing to do.")
+        sys.exit(0)
+
+    if not confirmed:
+        response = input("\nContinue with quarantine? (yes/no): ")
+        if response.lower() != 'yes':
+            print("\n❌ Quarantine cancelled.")
+            sys.exit(1)
+
+    if db.reconcile_file_blobs(dry_run=False) is None:
+        print("\n❌ Could not repair file_blobs!")
+        sys.exit(1)
+    run_dir = quarantine(orphans, missing)
+    if run_dir is None:
+        print("\n❌ Could not re-check orphans against lecture_files!")
+        sys.exit(1)
+
+    # Moving files changed directory mtimes; those get re-listed next run
+    save_state(state)
+    print(f"\n✅ Quarantined orphans to {run_dir}")
@@ -1,6 +1,8 @@
 """
 Redistribute students across all 24 classes naturally.
 
+Graduates (graduated_at set) and deleted students are never touched.
+
 Steps:
 1. Students WITH class_id but WITHOUT semester → derive semester/shift/section from their class
 2. Students WITH semester/shift/section but WITHOUT class_id → look up and set class_id
@@ -28,7 +30,7 @@ def main():
     
     # ── Step 1: Students WITH class_id but WITHOUT semester ──
     step1 = db.execute_query(
-        "SELECT s.id, s.class_id FROM students s WHERE s.class_id IS NOT NULL AND s.semester IS NULL",
+        "SELECT s.id, s.class_id FROM students s WHERE s.class_id IS NOT NULL AND s.semester IS NULL AND s.graduated_at IS NULL AND s.deleted_at IS NULL",
         fetch_all=True
     ) or []
     print(f"\nStep 1: {len(step1)} students have class_id but no semester")
@@ -46,7 +48,7 @@ def main():
     
     # ── Step 2: Students WITH semester/shift/section but WITHOUT class_id ──
     step2 = db.execute_query(
-        "SELECT id, semester, shift, section FROM students WHERE class_id IS NULL AND semester IS NOT NULL AND shift IS NOT NULL AND section IS NOT NULL",
+        "SELECT id, semester, shift, section FROM students WHERE class_id IS NULL AND semester IS NOT NULL AND shift IS NOT NULL AND section IS NOT NULL AND graduated_at IS NULL AND deleted_at IS NULL",
         fetch_all=True
     ) or []
     print(f"\nStep 2: {len(step2)} students have semester but no class_id")
@@ -62,7 +64,7 @@ def main():
     
     # ── Step 3: Students with NEITHER semester NOR class_id ──
     step3 = db.execute_query(
-        "SELECT id FROM students WHERE class_id IS NULL AND semester IS NULL",
+        "SELECT id FROM students WHERE class_id IS NULL AND semester IS NULL AND graduated_at IS NULL AND deleted_at IS NULL",
         fetch_all=True
     ) or []
     print(f"\nStep 3: {len(step3)} students have neither → distributing randomly")
@@ -85,7 +87,7 @@ def main():
     # Get current counts per class
     counts = db.execute_query("""
         SELECT c.id, c.name, c.year, c.semester, c.shift, c.section, COUNT(s.id) as cnt
-        FROM classes c LEFT JOIN students s ON s.class_id = c.id
+        FROM classes c LEFT JOIN students s ON s.class_id = c.id AND s.graduated_at IS NULL AND s.deleted_at IS NULL
         WHERE c.is_active = true
         GROUP BY c.id, c.name, c.year, c.semester, c.shift, c.section
         ORDER BY cnt DESC
@@ -108,7 +110,7 @@ def main():
         if excess > 0:
             # Get random students from this overpopulated class
             moveable = db.execute_query(
-                "SELECT id FROM students WHERE class_id = %s ORDER BY RANDOM() LIMIT %s",
+                "SELECT id FROM students WHERE class_id = %s AND graduated_at IS NULL AND deleted_at IS NULL ORDER BY RANDOM() LIMIT %s",
                 (r['id'], excess), fetch_all=True
             ) or []
             for s in moveable:
@@ -140,7 +142,7 @@ def main():
     
     final = db.execute_query("""
         SELECT c.name, c.semester, c.shift, c.section, COUNT(s.id) as cnt
-        FROM classes c LEFT JOIN students s ON s.class_id = c.id
+        FROM classes c LEFT JOIN students s ON s.class_id = c.id AND s.graduated_at IS NULL AND s.deleted_at IS NULL
         WHERE c.is_active = true
         GROUP BY c.id, c.name, c.semester, c.shift, c.section
         ORDER BY c.semester, c.shift, c.section
@@ -155,8 +157,8 @@ def main():
             print(f"    {r['shift']:7s} {r['section']}: {r['cnt']:3d} {bar}")
     
     # Check for any remaining orphans
-    orphans = db.execute_query("SELECT COUNT(*) as cnt FROM students WHERE class_id IS NULL", fetch_one=True)
-    no_sem = db.execute_query("SELECT COUNT(*) as cnt FROM students WHERE semester IS NULL", fetch_one=True)
+    orphans = db.execute_query("SELECT COUNT(*) as cnt FROM students WHERE class_id IS NULL AND graduated_at IS NULL AND deleted_at IS NULL", fetch_one=True)
+    no_sem = db.execute_query("SELECT COUNT(*) as cnt FROM students WHERE semester IS NULL AND graduated_at IS NULL AND deleted_at IS NULL", fetch_one=True)
     print(f"\n  Remaining: {orphans['cnt']} without class, {no_sem['cnt']} without semester")
 
 
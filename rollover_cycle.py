@@ -0,0 +1,67 @@
+"""
+Cycle Rollover
+Clone class schedules, grade rubrics and weekly topic plans from the current
+cycle's semesters (Sem 1+3 or Sem 2+4) onto the other cycle's, then switch
+the current cycle. Only empty targets are filled, so it is safe to re-run.
+
+Usage:
+    python rollover_cycle.py            # dry run - show what would be cloned
+    python rollover_cycle.py --apply    # clone and switch the current cycle
+"""
+import sys
+import db
+
+
+def print_diff(diff):
+    print(f"\n📋 Schedules ({len(diff['schedules'])}):")
+    for s in diff['schedules']:
+        print(f"   Sem {s['semester']} - {s['shift'].title()} - Class {s['section']}: {s['blocks']} blocks")
+    
+    print(f"\n📋 Grade rubrics ({len(diff['rubrics'])} subjects):")
+    for r in diff['rubrics']:
+        print(f"   Sem {r['semester']} - {r['subject_name']}: {r['components']} components")
+    
+    print(f"\n📋 Weekly topics ({sum(t['topics'] for t in diff['topics'])} topics):")
+    for t in diff['topics']:
+        print(f"   Sem {t['semester']} - {t['shift'].title()} - Class {t['section']} - {t['subject_name']}: {t['topics']} weeks")
+    
+    if diff['skipped_schedules']:
+        print(f"\n⚠️  Schedules not copied - none of their subjects exist in the target semester ({len(diff['skipped_schedules'])}):")
+        for s in diff['skipped_schedules']:
+            print(f"   Sem {s['semester']} - {s['shift'].title()} - Class {s['section']}")
+    
+    if diff['unmatched_subjects']:
+        print(f"\n⚠️  No same-named subject in the target semester ({len(diff['unmatched_subjects'])}):")
+        for u in diff['unmatched_subjects']:
+            print(f"   Sem {u['semester']} - {u['name']}")
+
+
+if __name__ == "__main__":
+    apply = '--apply' in sys.argv
+    source_cycle = db.get_current_cycle()
+    target_cycle = 2 if source_cycle == 1 else 1
+    
+    print("=" * 60)
+    print(f"CYCLE ROLLOVER: {source_cycle} → {target_cycle}" + ("" if apply else " (DRY RUN)"))
+    print("=" * 60)
+    
+    diff = db.rollover_cycle(source_cycle, target_cycle, dry_run=True)
+    if diff is None:
+        print("\n❌ Rollover failed!")
+        sys.exit(1)
+    print_diff(diff)
+    
+    if not apply:
+        print("\nRun with --apply to clone and switch the current cycle.")
+        sys.exit(0)
+    
+    response = input("\nContinue with rollover? (yes/no): ")
+    if response.lower() != 'yes':
+        print("\n❌ Rollover cancelled.")
+        sys.exit(1)
+    
+    if db.rollover_cycle(source_cycle, target_cycle, dry_run=False) is None:
+        print("\n❌ Rollover failed! Nothing was changed.")
+        sys.exit(1)
+    db.set_current_cycle(target_cycle)
+    print(f"\n✅ Rollover complete! Current cycle is now {target_cycle}.")
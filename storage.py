@@ -0,0 +1,448 @@
+"""
+Content-addressed storage for uploaded lecture files.
+
+Uploads are streamed to a local staging folder in chunks while being hashed,
+then stored once under the key blobs/<aa>/<sha256>. Every lecture_files row for
+the same content points at the same blob; file_blobs.ref_count tracks how many.
+
+lecture_files.file_path holds the storage key (relative to the storage root).
+Rows from before the storage backends hold an absolute path under the uploads
+folder; to_key() maps those to the same key.
+
+Where blobs live is up to the backend: LocalBackend keeps them in the uploads
+folder, S3Backend in an S3-compatible bucket (AWS, MinIO, ...) so several app
+nodes can share them.
+"""
+import fcntl
+import gzip
+import hashlib
+import json
+import os
+import re
+import secrets
+import shutil
+import tempfile
+import zipfile
+import zlib
+from contextlib import contextmanager
+
+CHUNK_SIZE = 64 * 1024
+
+# Types that are not already compressed (Office XML formats, images, archives
+# and most PDFs are) and are worth gzipping at rest
+COMPRESSIBLE_TYPES = {'txt', 'doc', 'xls', 'ppt'}
+
+BLOB_DIR_NAME = 'blobs'
+TMP_DIR_NAME = 'tmp'
+
+UPLOAD_ID_PATTERN = re.compile(r'[0-9a-f]{32}')
+
+
+class LocalBackend:
+    """Stores objects as files under a local root directory"""
+
+    def __init__(self, root):
+        self.root = os.path.abspath(root)
+        self.staging_dir = os.path.join(self.root, TMP_DIR_NAME)
+
+    def path(self, key):
+        """Absolute path of a key, or None if it points outside the root"""
+        path = os.path.normpath(os.path.join(self.root, key))
+        return path if path.startswith(self.root + os.sep) else None
+
+    def local_path(self, key):
+        """Path that can be handed to send_file / X-Sendfile"""
+        return self.path(key)
+
+    def put_file(self, key, local_path, compressed=False, keep_source=False):
+        """Store a local file under key (moved in unless keep_source)"""
+        target = self.path(key)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        if keep_source:
+            shutil.copyfile(local_path, target + '.part')
+            os.replace(target + '.part', target)
+        else:
+            os.replace(local_path, target)
+
+    def exists(self, key):
+        path = self.path(key)
+        return path is not None and os.path.exists(path)
+
+    def size(self, key):
+        return os.path.getsize(self.path(key))
+
+    def delete(self, key):
+        path = self.path(key)
+        if path and os.path.exists(path):
+            os.remove(path)
+
+    def iter_raw(self, key):
+        """Yield the stored bytes of an object in chunks"""
+        with open(self.path(key), 'rb') as f:
+            while True:
+                chunk = f.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    @contextmanager
+    def local_copy(self, key):
+        """A local file with the object's stored bytes (the file itself here)"""
+        yield self.path(key)
+
+    def url(self, key, filename=None, as_attachment=False, content_type=None, expires=300):
+        """Direct download URL - none, local files are sent by the app"""
+        return None
+
+
+class S3Backend:
+    """Stores objects in an S3-compatible bucket. Needs boto3."""
+
+    def __init__(self, bucket, staging_dir, endpoint_url=None, region=None,
+                 access_key=None, secret_key=None, prefix=''):
+        import boto3
+        from botocore.config import Config as BotoConfig
+        self.bucket = bucket
+        self.prefix = prefix
+        self.staging_dir = staging_dir
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url or None,
+            region_name=region or None,
+            aws_access_key_id=access_key or None,
+            aws_secret_access_key=secret_key or None,
+            config=BotoConfig(signature_version='s3v4', max_pool_connections=32)
+        )
+
+    def _key(self, key):
+        return self.prefix + key
+
+    def local_path(self, key):
+        return None
+
+    def put_file(self, key, local_path, compressed=False, keep_source=False):
+        """Upload a local file under key (the local file is removed unless keep_source)"""
+        extra = {'ContentEncoding': 'gzip'} if compressed else {}
+        self.client.upload_file(local_path, self.bucket, self._key(key), ExtraArgs=extra)
+        if not keep_source:
+            os.remove(local_path)
+
+    def _head(self, key):
+        from botocore.exceptions import ClientError
+        try:
+            return self.client.head_object(Bucket=self.bucket, Key=self._key(key))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+
+    def exists(self, key):
+        return self._head(key) is not None
+
+    def size(self, key):
+        return self._head(key)['ContentLength']
+
+    def delete(self, key):
+        self.client.delete_object(Bucket=self.bucket, Key=self._key(key))
+
+    def iter_raw(self, key):
+        """Yield the stored bytes of an object in chunks"""
+        body = self.client.get_object(Bucket=self.bucket, Key=self._key(key))['Body']
+        try:
+            for chunk in body.iter_chunks(CHUNK_SIZE):
+                yield chunk
+        finally:
+            body.close()
+
+    @contextmanager
+    def local_copy(self, key):
+        """Download the object to a temporary file for tools that need a path"""
+        os.makedirs(self.staging_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.staging_dir)
+        os.close(fd)
+        try:
+            self.client.download_file(self.bucket, self._key(key), path)
+            yield path
+        finally:
+            os.remove(path)
+
+    def url(self, key, filename=None, as_attachment=False, content_type=None, expires=300):
+        """Presigned GET URL; the bucket then serves the bytes (and Range requests)"""
+        params = {'Bucket': self.bucket, 'Key': self._key(key)}
+        if filename:
+            disposition = 'attachment' if as_attachment else 'inline'
+            params['ResponseContentDisposition'] = f'{disposition}; filename="{filename}"'
+        if content_type:
+            params['ResponseContentType'] = content_type
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires)
+
+
+def create_backend(config, upload_folder):
+    """Build the backend selected by config.STORAGE_BACKEND ('local' or 's3')"""
+    if config.STORAGE_BACKEND == 's3':
+        return S3Backend(
+            config.S3_BUCKET,
+            staging_dir=os.path.join(upload_folder, TMP_DIR_NAME),
+            endpoint_url=config.S3_ENDPOINT_URL,
+            region=config.S3_REGION,
+            access_key=config.S3_ACCESS_KEY,
+            secret_key=config.S3_SECRET_KEY,
+            prefix=config.S3_PREFIX
+        )
+    return LocalBackend(upload_folder)
+
+
+def to_key(file_path, upload_folder):
+    """Storage key of a lecture_files.file_path (a key, or a legacy absolute path)"""
+    if os.path.isabs(file_path):
+        file_path = os.path.relpath(os.path.normpath(file_path), os.path.abspath(upload_folder))
+    return file_path.replace(os.sep, '/')
+
+
+def blob_key(sha256, compressed=False):
+    """Key of a blob, sharded by the first two hex digits"""
+    name = sha256 + ('.gz' if compressed else '')
+    return '/'.join((BLOB_DIR_NAME, sha256[:2], name))
+
+
+@contextmanager
+def staged_stream(backend, stream):
+    """
+    Stream an upload to the staging folder while hashing it.
+
+    Args:
+        backend: Storage backend
+        stream: File-like object to read from (e.g. FileStorage.stream)
+
+    Yields:
+        Dict with path, sha256 and size of the staged file. Whatever
+        store_file did not move into the blob store is removed on exit.
+    """
+    os.makedirs(backend.staging_dir, exist_ok=True)
+
+    digest = hashlib.sha256()
+    size = 0
+    fd, tmp_path = tempfile.mkstemp(dir=backend.staging_dir)
+    try:
+        with os.fdopen(fd, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                digest.update(chunk)
+                size += len(chunk)
+                out.write(chunk)
+        yield {'path': tmp_path, 'sha256': digest.hexdigest(), 'size': size}
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def store_file(backend, staged, file_type, existing=None, compress=True):
+    """
+    Move a staged, hashed file into the blob store.
+
+    Only the caller knows whether the content is stored already: it takes the
+    file_blobs reference first (see db.create_lecture_files_for_blob) and
+    passes the compressed flag of the surviving row as existing. The staged
+    copy is then dropped and the stored one reused.
+
+    Returns:
+        Dict with sha256, size, compressed and key
+    """
+    sha256, size = staged['sha256'], staged['size']
+    if existing is not None:
+        os.remove(staged['path'])
+        return {'sha256': sha256, 'size': size, 'compressed': existing, 'key': blob_key(sha256, existing)}
+
+    compressed = compress and file_type in COMPRESSIBLE_TYPES
+    key = blob_key(sha256, compressed)
+    if compressed:
+        gz_path = staged['path'] + '.gz'
+        with open(staged['path'], 'rb') as src, gzip.open(gz_path, 'wb') as dst:
+            shutil.copyfileobj(src, dst, CHUNK_SIZE)
+        os.remove(staged['path'])
+        backend.put_file(key, gz_path, compressed=True)
+    else:
+        backend.put_file(key, staged['path'])
+    return {'sha256': sha256, 'size': size, 'compressed': compressed, 'key': key}
+
+
+def _upload_paths(backend, upload_id):
+    """Data and metadata files of a resumable upload"""
+    base = os.path.join(backend.staging_dir, 'upload_' + upload_id)
+    return base + '.part', base + '.json'
+
+
+def create_upload(backend, meta):
+    """
+    Start a resumable upload. Chunks are staged on this node's disk until
+    finalize moves the file into the backend.
+
+    Args:
+        backend: Storage backend
+        meta: JSON-serializable details kept until finalize (owner, expected
+              size, file name, target assignments, ...)
+
+    Returns:
+        The new upload id
+    """
+    upload_id = secrets.token_hex(16)
+    part_path, meta_path = _upload_paths(backend, upload_id)
+    os.makedirs(os.path.dirname(part_path), exist_ok=True)
+    open(part_path, 'wb').close()
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f)
+    return upload_id
+
+
+def get_upload(backend, upload_id):
+    """Metadata of a resumable upload plus its current 'offset', or None"""
+    if not UPLOAD_ID_PATTERN.fullmatch(upload_id or ''):
+        return None
+    part_path, meta_path = _upload_paths(backend, upload_id)
+    if not os.path.exists(meta_path) or not os.path.exists(part_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    meta['offset'] = os.path.getsize(part_path)
+    return meta
+
+
+def append_upload(backend, upload_id, offset, stream, max_size):
+    """
+    Append a chunk to a resumable upload, straight from the request stream.
+
+    The chunk is only accepted at the current end of the file, so a client
+    that lost track (or retried a chunk that did arrive) is told where to
+    continue instead of corrupting the file. The file is locked while the
+    offset is checked and the chunk written, so two concurrent requests for
+    the same upload cannot both pass the check.
+
+    Returns:
+        The new offset
+
+    Raises:
+        ValueError: offset does not match the data received so far, or the
+                    upload would grow past max_size
+    """
+    part_path, _ = _upload_paths(backend, upload_id)
+    with open(part_path, 'ab') as out:
+        fcntl.flock(out, fcntl.LOCK_EX)
+        current = out.seek(0, os.SEEK_END)
+        if offset != current:
+            raise ValueError(current)
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if current + len(chunk) > max_size:
+                out.truncate(offset)
+                raise ValueError(offset)
+            out.write(chunk)
+            current += len(chunk)
+    return current
+
+
+def check_upload(backend, upload_id, expected_sha256=None):
+    """
+    Hash a completed resumable upload.
+
+    Returns:
+        Same dict as staged_stream yields, or None if the checksum does not
+        match (the upload is left in place so the client can start over).
+        Pass it to store_file, then abort_upload to drop what is left.
+    """
+    part_path, _ = _upload_paths(backend, upload_id)
+    digest = hashlib.sha256()
+    size = 0
+    with open(part_path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            digest.update(chunk)
+            size += len(chunk)
+
+    sha256 = digest.hexdigest()
+    if expected_sha256 and expected_sha256.lower() != sha256:
+        return None
+    return {'path': part_path, 'sha256': sha256, 'size': size}
+
+
+def abort_upload(backend, upload_id):
+    """Discard a resumable upload"""
+    for path in _upload_paths(backend, upload_id):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def iter_blob(backend, key, compressed=False):
+    """Yield the original bytes of a blob in chunks"""
+    if not compressed:
+        yield from backend.iter_raw(key)
+        return
+    inflater = zlib.decompressobj(16 + zlib.MAX_WBITS)
+    for chunk in backend.iter_raw(key):
+        data = inflater.decompress(chunk)
+        if data:
+            yield data
+    tail = inflater.flush()
+    if tail:
+        yield tail
+
+
+def remove_blob(backend, key):
+    """Delete a blob whose last reference is gone"""
+    if key:
+        backend.delete(key)
+
+
+class _ZipStream:
+    """Write-only file object that collects what zipfile writes so a generator
+    can hand it on. It has no seek(), so zipfile writes a streamable archive."""
+
+    def __init__(self):
+        self._buffer = bytearray()
+        self._offset = 0
+
+    def write(self, data):
+        self._buffer += data
+        self._offset += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._offset
+
+    def flush(self):
+        pass
+
+    def pop(self):
+        data = bytes(self._buffer)
+        self._buffer.clear()
+        return data
+
+
+def iter_zip(backend, entries):
+    """
+    Yield a ZIP archive of stored files chunk by chunk, without a temporary
+    file and without holding more than one chunk in memory.
+
+    Args:
+        backend: Storage backend
+        entries: Iterable of (arcname, key, compressed, date_time) where
+                 compressed says the blob is gzipped at rest
+    """
+    stream = _ZipStream()
+    with zipfile.ZipFile(stream, 'w', allowZip64=True) as archive:
+        for arcname, key, compressed, date_time in entries:
+            info = zipfile.ZipInfo(arcname, date_time=date_time)
+            # Text-like blobs were worth compressing at rest; the rest
+            # (PDF, Office XML, images, archives) already are
+            info.compress_type = zipfile.ZIP_DEFLATED if compressed else zipfile.ZIP_STORED
+            with archive.open(info, 'w') as member:
+                for chunk in iter_blob(backend, key, compressed):
+                    member.write(chunk)
+                    yield stream.pop()
+            yield stream.pop()
+    yield stream.pop()
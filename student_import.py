@@ -0,0 +1,247 @@
+"""
+Bulk student import from CSV or XLSX.
+
+Rows are streamed from the uploaded file and validated one by one, then the
+passwords of all valid rows are hashed in a process pool (scrypt is CPU bound,
+so threads would not help) and every student is inserted in one transaction by
+db.import_students. Nothing is written when any row is invalid unless
+skip_invalid is set.
+
+Expected columns (header row, case-insensitive):
+    full_name, password, semester, shift   - required
+    email, section, phone                  - optional
+"""
+import csv
+import io
+import multiprocessing
+import os
+import re
+import zipfile
+import xml.etree.ElementTree as ET
+from concurrent.futures import ProcessPoolExecutor
+
+from werkzeug.security import generate_password_hash
+
+import db
+
+MAX_IMPORT_ROWS = 5000
+# Below this the pool start-up costs more than it saves
+PARALLEL_HASH_MIN = 20
+
+COLUMNS = ['full_name', 'password', 'email', 'semester', 'shift', 'section', 'phone']
+REQUIRED_COLUMNS = ['full_name', 'password', 'semester', 'shift']
+SHIFTS = {'morning', 'night'}
+SECTIONS = {'A', 'B', 'C'}
+
+EMAIL_RE = re.compile(r'^[^@\s]+@[^@\s]+\.[^@\s]+$')
+
+
+def _column_name(header):
+    """'Full Name' -> 'full_name'"""
+    return re.sub(r'[\s\-]+', '_', (header or '').strip().lower())
+
+
+def read_rows(stream, filename, required=REQUIRED_COLUMNS):
+    """
+    Yield (line_number, row dict) from an uploaded CSV or XLSX file.
+    Line numbers match what the admin sees in a spreadsheet (header is line 1).
+    """
+    extension = filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+    if extension == 'csv':
+        rows = csv.reader(io.TextIOWrapper(stream, encoding='utf-8-sig', newline=''))
+    elif extension == 'xlsx':
+        rows = _xlsx_rows(stream)
+    else:
+        raise ValueError('Only .csv and .xlsx files can be imported')
+
+    header = None
+    for line_number, values in enumerate(rows, 1):
+        if header is None:
+            header = [_column_name(v) for v in values]
+            missing = [c for c in required if c not in header]
+            if missing:
+                raise ValueError(f"Missing column(s): {', '.join(missing)}")
+            continue
+        if not any((v or '').strip() for v in values):
+            continue
+        yield line_number, {name: (values[i] if i < len(values) else '') for i, name in enumerate(header)}
+
+
+def _xlsx_rows(stream):
+    """Cell values of the first worksheet, streamed row by row"""
+    with zipfile.ZipFile(stream) as archive:
+        names = set(archive.namelist())
+        shared = []
+        if 'xl/sharedStrings.xml' in names:
+            with archive.open('xl/sharedStrings.xml') as f:
+                for _, element in ET.iterparse(f):
+                    if element.tag.rsplit('}', 1)[-1] == 'si':
+                        shared.append(''.join(t.text or '' for t in element.iter() if t.tag.rsplit('}', 1)[-1] == 't'))
+                        element.clear()
+
+        sheets = sorted(n for n in names if re.match(r'xl/worksheets/sheet\d+\.xml$', n))
+        if not sheets:
+            raise ValueError('The workbook has no worksheet')
+        sheet = min(sheets, key=lambda n: int(re.sub(r'\D', '', n)))
+
+        with archive.open(sheet) as f:
+            row_number = 0
+            for _, element in ET.iterparse(f):
+                if element.tag.rsplit('}', 1)[-1] != 'row':
+                    continue
+                # Empty rows are left out of the file; keep line numbers in step
+                reference = int(element.get('r') or row_number + 1)
+                while row_number + 1 < reference:
+                    row_number += 1
+                    yield []
+                row_number += 1
+                values = []
+                for cell in element:
+                    if cell.tag.rsplit('}', 1)[-1] != 'c':
+                        continue
+                    column = _column_index(cell.get('r'), len(values))
+                    values.extend([''] * (column - len(values)))
+                    values.append(_cell_value(cell, shared))
+                element.clear()
+                yield values
+
+
+def _column_index(reference, default):
+    """'C7' -> 2"""
+    letters = re.match(r'[A-Z]+', reference or '')
+    if not letters:
+        return default
+    index = 0
+    for letter in letters.group():
+        index = index * 26 + ord(letter) - ord('A') + 1
+    return index - 1
+
+
+def _cell_value(cell, shared):
+    kind = cell.get('t')
+    if kind == 'inlineStr':
+        return ''.join(t.text or '' for t in cell.iter() if t.tag.rsplit('}', 1)[-1] == 't')
+    value = next((v.text for v in cell if v.tag.rsplit('}', 1)[-1] == 'v'), None) or ''
+    if kind == 's' and value:
+        return shared[int(value)]
+    # Numbers typed into Excel come back as '3.0' or '7501234567.0'
+    if kind is None and value.endswith('.0'):
+        return value[:-2]
+    return value
+
+
+def validate_row(row):
+    """
+    Clean one row.
+
+    Returns:
+        (student dict, list of error messages)
+    """
+    errors = []
+    full_name = (row.get('full_name') or '').strip()
+    password = (row.get('password') or '').strip()
+    email = (row.get('email') or '').strip() or None
+    shift = (row.get('shift') or '').strip().lower()
+    section = (row.get('section') or '').strip().upper() or None
+    phone = (row.get('phone') or '').strip() or None
+
+    if not full_name:
+        errors.append('full_name is required')
+    elif len(full_name) > 100:
+        errors.append('full_name is longer than 100 characters')
+    if not password:
+        errors.append('password is required')
+    if email and (len(email) > 100 or not EMAIL_RE.match(email)):
+        errors.append(f'invalid email "{email}"')
+    try:
+        semester = int((row.get('semester') or '').strip())
+        if semester not in (1, 2, 3, 4):
+            raise ValueError
+    except ValueError:
+        semester = None
+        errors.append('semester must be 1-4')
+    if shift not in SHIFTS:
+        errors.append('shift must be morning or night')
+    if section and section not in SECTIONS:
+        errors.append('section must be A, B or C')
+    if phone and len(phone) > 20:
+        errors.append('phone is longer than 20 characters')
+
+    student = {
+        'full_name': full_name,
+        'password': password,
+        'email': email,
+        'semester': semester,
+        'year': 1 if semester and semester <= 2 else 2,
+        'shift': shift,
+        'section': section,
+        'phone': phone,
+    }
+    return student, errors
+
+
+def hash_passwords(passwords):
+    """generate_password_hash for every password, spread over all CPUs"""
+    if len(passwords) < PARALLEL_HASH_MIN:
+        return [generate_password_hash(p) for p in passwords]
+    workers = min(os.cpu_count() or 1, 8)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn')) as executor:
+        return list(executor.map(generate_password_hash, passwords, chunksize=max(1, len(passwords) // (workers * 4))))
+
+
+def import_file(stream, filename, dry_run=False, skip_invalid=False):
+    """
+    Validate and import students from an uploaded file.
+
+    Args:
+        stream: Binary file object (seekable for XLSX)
+        filename: Original file name, used to tell CSV from XLSX
+        dry_run: Only validate, write nothing
+        skip_invalid: Import the valid rows even if some rows are invalid
+
+    Returns:
+        Dict with 'total', 'imported' (line, full_name, student_number,
+        username), 'errors' (line, full_name, message) and 'failed' (a
+        message when nothing could be imported, else None)
+    """
+    report = {'total': 0, 'imported': [], 'errors': [], 'failed': None}
+    students = []
+    try:
+        for line_number, row in read_rows(stream, filename):
+            report['total'] += 1
+            if report['total'] > MAX_IMPORT_ROWS:
+                report['failed'] = f'Too many rows - at most {MAX_IMPORT_ROWS} students per file'
+                return report
+            student, errors = validate_row(row)
+            student['line'] = line_number
+            if errors:
+                report['errors'].append({'line': line_number, 'full_name': student['full_name'],
+                                         'message': '; '.join(errors)})
+            else:
+                students.append(student)
+    except (ValueError, csv.Error, zipfile.BadZipFile, ET.ParseError, UnicodeDecodeError) as e:
+        report['failed'] = f'Could not read file: {e}'
+        return report
+
+    if not students:
+        report['failed'] = report['failed'] or 'No valid student rows found'
+        return report
+    if report['errors'] and not skip_invalid:
+        report['failed'] = 'Fix the rows below (or skip invalid rows) - nothing was imported'
+        return report
+    if dry_run:
+        return report
+
+    hashes = hash_passwords([s['password'] for s in students])
+    for student, password_hash in zip(students, hashes):
+        student['password_hash'] = password_hash
+
+    created = db.import_students(students)
+    if created is None:
+        report['failed'] = 'Database error - nothing was imported'
+        return report
+
+    for student, (student_number, username) in zip(students, created):
+        report['imported'].append({'line': student['line'], 'full_name': student['full_name'],
+                                   'student_number': student_number, 'username': username})
+    return report
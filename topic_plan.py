@@ -0,0 +1,96 @@
+"""
+Semester topic plans from CSV or XLSX.
+
+One row per week; the plan is published to any number of the teacher's
+classes in one statement by db.create_weekly_topics_bulk, replacing the
+topics already entered for those weeks.
+
+Expected columns (header row, case-insensitive):
+    week, topic           - required
+    description, date     - optional (date as YYYY-MM-DD)
+"""
+import csv
+import zipfile
+import xml.etree.ElementTree as ET
+from datetime import date, timedelta
+
+from student_import import read_rows
+
+REQUIRED_COLUMNS = ['week', 'topic']
+MAX_WEEKS = 52
+EXCEL_EPOCH = date(1899, 12, 30)
+
+
+def parse_week(row):
+    """
+    Clean one plan row (from a file or a JSON list).
+
+    Returns:
+        (week dict, list of error messages)
+    """
+    errors = []
+    topic = str(row.get('topic') or '').strip()
+    description = str(row.get('description') or '').strip() or None
+    date_covered = str(row.get('date') or '').strip() or None
+
+    try:
+        # Spreadsheets hand whole numbers over as 3.0; 2.5 is not a week
+        week = float(str(row.get('week') or '').strip())
+        if not week.is_integer():
+            raise ValueError
+        week_number = int(week)
+        if not 1 <= week_number <= MAX_WEEKS:
+            raise ValueError
+    except (ValueError, OverflowError):
+        # OverflowError: 'inf' parses as a float but not as an int
+        week_number = None
+        errors.append(f'week must be a whole number 1-{MAX_WEEKS}')
+    if not topic:
+        errors.append('topic is required')
+    elif len(topic) > 255:
+        errors.append('topic is longer than 255 characters')
+    if date_covered:
+        try:
+            if date_covered.replace('.', '', 1).isdigit():
+                # XLSX stores dates as days since 1899-12-30
+                date_covered = (EXCEL_EPOCH + timedelta(days=int(float(date_covered)))).isoformat()
+            else:
+                date_covered = date.fromisoformat(date_covered).isoformat()
+        except (ValueError, OverflowError):
+            errors.append(f'invalid date "{date_covered}" (use YYYY-MM-DD)')
+
+    week = {
+        'week_number': week_number,
+        'topic': topic,
+        'description': description,
+        'date_covered': date_covered,
+    }
+    return week, errors
+
+
+def parse_plan(rows):
+    """
+    Clean (line_number, row) pairs into one entry per week.
+
+    Returns:
+        (list of week dicts, list of 'Line N: message' errors)
+    """
+    weeks = {}
+    errors = []
+    for line_number, row in rows:
+        week, row_errors = parse_week(row)
+        if not row_errors and week['week_number'] in weeks:
+            row_errors = [f"week {week['week_number']} appears twice"]
+        if row_errors:
+            errors.append(f"Line {line_number}: {'; '.join(row_errors)}")
+        else:
+            weeks[week['week_number']] = week
+    return sorted(weeks.values(), key=lambda w: w['week_number']), errors
+
+
+def read_plan(stream, filename):
+    """Read and clean an uploaded plan file (see parse_plan); ValueError for unreadable files"""
+    try:
+        return parse_plan(read_rows(stream, filename, required=REQUIRED_COLUMNS))
+    except (csv.Error, zipfile.BadZipFile, ET.ParseError, UnicodeDecodeError) as e:
+        raise ValueError(str(e)) from e